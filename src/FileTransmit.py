@@ -1,18 +1,29 @@
 # FileTransmit.py
 
-from typing import List
+from typing import List, Optional
 import os
-import zipfile
-import io
+import asyncio
+import hashlib
+import tempfile
 from datetime import datetime
 import json
 
 from fastapi import HTTPException, BackgroundTasks
-from fastapi import APIRouter, File, UploadFile, HTTPException
+from fastapi import APIRouter, File, UploadFile, HTTPException, Header, Request
 from fastapi.responses import JSONResponse, FileResponse
 from fastapi.responses import StreamingResponse
 from fastapi.responses import Response
 
+try:
+    from python_multipart.multipart import MultipartParser, parse_options_header
+    from python_multipart.exceptions import MultipartParseError
+except ImportError:  # python-multipart before 0.0.13
+    from multipart.multipart import MultipartParser, parse_options_header
+    from multipart.exceptions import MultipartParseError
+
+from zip_stream import UPLOAD_TEMP_PREFIX, list_files, files_etag, etag_matches, iter_zip
+from workspace_index import WorkspaceIndex, plan_sync
+
 
 # Create a router instance
 file_router = APIRouter()
@@ -31,53 +42,247 @@ def get_or_create_workspace(username: str) -> str:
 
 
 @file_router.get('/download/{username}')
-async def download_workspace(username: str):
+async def download_workspace(
+    username: str,
+    store_compressed: bool = True,
+    if_none_match: Optional[str] = Header(None)
+):
     try:
         user_workspace = get_or_create_workspace(username)
 
-        # Create a zip file from the user's workspace directory
-        zip_filename = f'{username}_workspace.zip'
-        zip_buffer = io.BytesIO()  # in-memory buffer to hold the zip file
-
-        # Create a ZipFile object in write mode
-        with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-            # Walk through the workspace directory and add files to the zip
-            for root, dirs, files in os.walk(user_workspace):
-                for file in files:
-                    file_path = os.path.join(root, file)
-                    arcname = os.path.relpath(file_path, user_workspace)  # Store files relative to the workspace
-                    zip_file.write(file_path, arcname)
-
-        # Seek to the beginning of the buffer before sending it
-        zip_buffer.seek(0)
-
-        # Return the zip file as a Response, without triggering stat checks
-        return Response(
-            zip_buffer.read(),  # Read the content of the BytesIO object
-            media_type="application/zip",  # Set the media type to zip file
-            headers={"Content-Disposition": f"attachment; filename={zip_filename}"}
-        )
-    
+        # The listing tells whether the client already has this workspace
+        entries = await asyncio.to_thread(list_files, user_workspace)
+        etag = files_etag(entries)
+        if etag_matches(if_none_match, etag):
+            return Response(status_code=304, headers={"ETag": etag})
+
     except Exception as e:
         print(f"Error creating zip: {e}")
         raise HTTPException(status_code=500, detail=f"Failed to create zip file: {str(e)}")
 
+    zip_filename = f'{username}_workspace.zip'
+
+    # The archive is written while it is sent (in the threadpool), a chunk at a time
+    return StreamingResponse(
+        iter_zip(user_workspace, entries, store_compressed),
+        media_type="application/zip",  # Set the media type to zip file
+        headers={"Content-Disposition": f"attachment; filename={zip_filename}", "ETag": etag}
+    )
+
+# Size limits of uploads, per file and for all files of one request
+UPLOAD_MAX_FILE_BYTES = int(float(os.environ.get("UPLOAD_MAX_FILE_MB", 100)) * 1024 * 1024)
+UPLOAD_MAX_REQUEST_BYTES = int(float(os.environ.get("UPLOAD_MAX_REQUEST_MB", 500)) * 1024 * 1024)
+
+
+class UploadTooLarge(Exception):
+    pass
+
+
+def resolve_workspace_path(workspace: str, relative_path: str) -> str:
+    """
+    Absolute path of `relative_path` inside `workspace`.
+    Raises HTTPException 400 for paths that lead out of it.
+    """
+    root = os.path.realpath(workspace)
+    path = os.path.realpath(os.path.join(root, relative_path))
+    if path == root or not path.startswith(root + os.sep):
+        raise HTTPException(status_code=400, detail=f"Invalid file path {relative_path}")
+    return path
+
+
+class UploadWriter:
+    """
+    Callbacks of python-multipart's parser for a multipart/form-data body:
+    each file part goes to a temporary file in the workspace as it streams
+    in, with the size limits applied on the way. Workspace files are only
+    replaced by commit(), once the whole request was accepted; discard()
+    drops everything a failed request wrote.
+    """
+
+    def __init__(self, workspace: str, max_file_bytes: int, max_request_bytes: int):
+        self.workspace = workspace
+        self.max_file_bytes = max_file_bytes
+        self.max_request_bytes = max_request_bytes
+        self.received = 0
+        # (filename, target path, temporary path, size, sha256) of the complete files
+        self.staged = []
+        self._headers = {}
+        self._field = b""
+        self._value = b""
+        self._file = None
+
+    def callbacks(self) -> dict:
+        return {
+            "on_part_begin": self.on_part_begin,
+            "on_header_field": self.on_header_field,
+            "on_header_value": self.on_header_value,
+            "on_header_end": self.on_header_end,
+            "on_headers_finished": self.on_headers_finished,
+            "on_part_data": self.on_part_data,
+            "on_part_end": self.on_part_end,
+        }
+
+    def count(self, size: int):
+        # Every byte of the body counts, whether or not it belongs to a file
+        self.received += size
+        if self.received > self.max_request_bytes:
+            raise UploadTooLarge(self._file["filename"] if self._file else None, "request")
+
+    def on_part_begin(self):
+        self._headers = {}
+        self._field = self._value = b""
+
+    def on_header_field(self, data: bytes, start: int, end: int):
+        self._field += data[start:end]
+
+    def on_header_value(self, data: bytes, start: int, end: int):
+        self._value += data[start:end]
+
+    def on_header_end(self):
+        self._headers[self._field.lower()] = self._value
+        self._field = self._value = b""
+
+    def on_headers_finished(self):
+        _, options = parse_options_header(self._headers.get(b"content-disposition", b""))
+        if b"filename" not in options:
+            return  # a plain form field, not stored
+        filename = options[b"filename"].decode("utf-8", "replace")
+        path = resolve_workspace_path(self.workspace, filename)
+        temp = tempfile.NamedTemporaryFile(dir=self.workspace, prefix=UPLOAD_TEMP_PREFIX, delete=False)
+        self._file = {"filename": filename, "path": path, "temp": temp, "size": 0, "digest": hashlib.sha256()}
+
+    def on_part_data(self, data: bytes, start: int, end: int):
+        if self._file is None:
+            return
+        file = self._file
+        file["size"] += end - start
+        if file["size"] > self.max_file_bytes:
+            raise UploadTooLarge(file["filename"], "file")
+        file["digest"].update(data[start:end])
+        file["temp"].write(data[start:end])
+
+    def on_part_end(self):
+        if self._file is None:
+            return
+        file, self._file = self._file, None
+        file["temp"].close()
+        self.staged.append((file["filename"], file["path"], file["temp"].name, file["size"], file["digest"].hexdigest()))
+
+    def commit(self) -> List[dict]:
+        """
+        Moves the staged files into place, returns filename, size and sha256 of each.
+        """
+        stored = []
+        for filename, path, temp_path, size, sha256 in self.staged:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(temp_path, path)
+            stored.append({"filename": filename, "path": path, "size": size, "sha256": sha256})
+        self.staged = []
+        return stored
+
+    def discard(self):
+        temp_paths = [temp_path for _, _, temp_path, _, _ in self.staged]
+        if self._file is not None:
+            self._file["temp"].close()
+            temp_paths.append(self._file["temp"].name)
+            self._file = None
+        for temp_path in temp_paths:
+            try:
+                os.remove(temp_path)
+            except FileNotFoundError:
+                pass
+        self.staged = []
+
+
 # Route to handle file uploads with username
 @file_router.post('/upload/{username}')
-async def upload_file(username: str, files: List[UploadFile] = File(...)):
+async def upload_file(request: Request, username: str):
+    user_workspace = get_or_create_workspace(username)
+
+    content_type, options = parse_options_header(request.headers.get("content-type", ""))
+    if content_type != b"multipart/form-data" or not options.get(b"boundary"):
+        raise HTTPException(status_code=400, detail="Uploads must be multipart/form-data")
+
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > UPLOAD_MAX_REQUEST_BYTES:
+        raise HTTPException(status_code=413, detail="Upload exceeds the request size limit")
+
+    # The body is parsed as it arrives, instead of being spooled whole first, so
+    # the limits also hold for chunked requests; files are written off the event loop
+    writer = UploadWriter(user_workspace, UPLOAD_MAX_FILE_BYTES, UPLOAD_MAX_REQUEST_BYTES)
+    parser = MultipartParser(options[b"boundary"], writer.callbacks())
+    try:
+        async for chunk in request.stream():
+            writer.count(len(chunk))
+            await asyncio.to_thread(parser.write, chunk)
+        await asyncio.to_thread(parser.finalize)
+        if not writer.staged:
+            raise HTTPException(status_code=400, detail="No files selected for uploading")
+        stored = await asyncio.to_thread(writer.commit)
+    except UploadTooLarge as e:
+        filename, limit = e.args
+        # Nothing of the request was kept
+        await asyncio.to_thread(writer.discard)
+        detail = f"{filename} exceeds the {limit} size limit" if filename else f"Upload exceeds the {limit} size limit"
+        raise HTTPException(status_code=413, detail=f"{detail}, no files were stored")
+    except MultipartParseError as e:
+        await asyncio.to_thread(writer.discard)
+        raise HTTPException(status_code=400, detail=f"Invalid multipart body: {e}")
+    except BaseException:
+        await asyncio.to_thread(writer.discard)
+        raise
+
+    # Keep the sync manifest current without hashing the files again
+    root = os.path.realpath(user_workspace)
+    index = WorkspaceIndex(username, user_workspace)
+    for file in stored:
+        await asyncio.to_thread(index.record, os.path.relpath(file.pop("path"), root), file["sha256"])
+        print(f"Uploaded file: {file['filename']} to {user_workspace}")
+
+    # The hashes let clients skip uploading files the workspace already has
+    return JSONResponse(content={"message": "Files successfully uploaded", "files": stored}, status_code=200)
+
+# Manifest of the workspace, for clients that sync only what changed
+@file_router.get('/manifest/{username}')
+async def workspace_manifest(username: str):
+    user_workspace = get_or_create_workspace(username)
+    files = await asyncio.to_thread(WorkspaceIndex(username, user_workspace).manifest)
+    return JSONResponse(content={"files": files}, status_code=200)
+
+
+# Tells a client which files to download and which to upload, given its own manifest
+@file_router.post('/sync/{username}/plan')
+async def sync_plan(request: Request, username: str):
+    data = await request.json()
+    client_files = data.get('files', [])
+    if not isinstance(client_files, list) or not all(isinstance(entry, dict) and "path" in entry for entry in client_files):
+        raise HTTPException(status_code=400, detail="files must be a list of {path, sha256, mtime}")
+
+    user_workspace = get_or_create_workspace(username)
+    for entry in client_files:
+        resolve_workspace_path(user_workspace, entry["path"])
+    server_files = await asyncio.to_thread(WorkspaceIndex(username, user_workspace).manifest)
+    return JSONResponse(content=plan_sync(server_files, client_files), status_code=200)
+
+
+# Zip of just the requested files, the download half of a sync (uploads go through /upload)
+@file_router.post('/sync/{username}/download')
+async def sync_download(request: Request, username: str, store_compressed: bool = True):
+    data = await request.json()
+    paths = data.get('paths', [])
+    if not isinstance(paths, list):
+        raise HTTPException(status_code=400, detail="paths must be a list")
+
     user_workspace = get_or_create_workspace(username)
+    root = os.path.realpath(user_workspace)
+    wanted = {os.path.relpath(resolve_workspace_path(user_workspace, path), root) for path in paths}
+    entries = [entry for entry in await asyncio.to_thread(list_files, user_workspace) if entry[0] in wanted]
 
-    if not files:
-        raise HTTPException(status_code=400, detail="No files selected for uploading")
-
-    # Save each uploaded file to the user's workspace
-    for file in files:
-        file_path = os.path.join(user_workspace, file.filename)
-        with open(file_path, 'wb') as f:
-            f.write(await file.read())
-        print(f"Uploaded file: {file.filename} to {user_workspace}")
-    
-    return JSONResponse(content={"message": "Files successfully uploaded"}, status_code=200)
+    return StreamingResponse(
+        iter_zip(user_workspace, entries, store_compressed),
+        media_type="application/zip",
+        headers={"Content-Disposition": f"attachment; filename={username}_sync.zip"}
+    )
 
 # Route to handle cleaning the user's workspace
 @file_router.post('/clean-cache/{username}')
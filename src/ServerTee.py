@@ -1,60 +1,258 @@
 # ServerTee.py
 
+import os
 import sys
+import time
+import atexit
+import asyncio
 import datetime
-from threading import Lock
-from queue import Queue, Empty
+from collections import deque
+from contextvars import ContextVar
+from threading import Condition, Thread
+from typing import Optional, Tuple
+
+from broadcast import Subscriber, END_OF_STREAM
+
+DROP_OLDEST = "drop_oldest"
+DROP_NEWEST = "drop_newest"
+
+# (username, run_id) the code printing right now works for, lets /logs/tail pick its lines
+log_context: ContextVar[Optional[Tuple[str, str]]] = ContextVar("log_context", default=None)
+
 
 class ServerTee:
-    def __init__(self, filename, mode='a'):
-        self.file = open(filename, mode)
+    """
+    Replaces sys.stdout: every line printed goes, timestamped, to the console
+    and to a log file. Lines are queued and written by a background thread in
+    batches, with one flush per batch, so printing never waits for the disk.
+
+    `filename` may contain strftime codes (e.g. "log/%Y-%m-%d.log"), a new file
+    is started whenever the formatted name changes. A file growing past
+    `max_bytes` is rotated to .1, .2, ... keeping `backup_count` of them.
+    At most `max_queue` lines wait for the writer, the policy decides which
+    lines are dropped beyond that.
+    """
+
+    def __init__(
+        self,
+        filename,
+        mode='a',
+        max_bytes=None,
+        backup_count=None,
+        max_queue=None,
+        policy=None,
+        flush_interval=None
+    ):
+        self.filename = filename
+        self.mode = mode
+        self.max_bytes = max_bytes if max_bytes is not None else int(float(os.environ.get("LOG_MAX_MB", 100)) * 1024 * 1024)
+        self.backup_count = backup_count if backup_count is not None else int(os.environ.get("LOG_BACKUP_COUNT", 5))
+        self.max_queue = max_queue if max_queue is not None else int(os.environ.get("LOG_QUEUE_SIZE", 10000))
+        self.policy = policy or os.environ.get("LOG_OVERFLOW", DROP_OLDEST)
+        self.flush_interval = flush_interval if flush_interval is not None else float(os.environ.get("LOG_FLUSH_INTERVAL", 0.2))
+
         self.stdout = sys.stdout
-        self.lock = Lock()
-        self.subscribers = []
+        self.file = None
+        self.path = None
+        self._open_file()
+
+        self._condition = Condition()
+        self._lines = deque()
+        self._partial = ""  # text of a line printed in pieces, waiting for its newline
+        self._dropped = 0
+        self._closed = False
+        # The timestamp is formatted once per second, not once per line
+        self._timestamp_second = None
+        self._timestamp = ""
+
+        # Live tails by ("user", username) or ("run", run_id), a line only visits its own
+        self.subscribers = {}
+        self.tail_buffer_size = int(os.environ.get("LOG_TAIL_BUFFER", 1000))
+        self._loop = None
+        self._writer = Thread(target=self._write_batches, name="ServerTee", daemon=True)
+        self._writer.start()
         sys.stdout = self
+        atexit.register(self.close)
+
+    def _current_path(self):
+        return datetime.datetime.now().strftime(self.filename)
+
+    def _open_file(self):
+        self.path = self._current_path()
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.file = open(self.path, self.mode)
+
+    def _rotate_if_needed(self):
+        if self._current_path() != self.path:
+            # New day (or whatever the file name pattern counts), new file
+            self.file.close()
+            self._open_file()
+            return
+
+        try:
+            on_disk = os.stat(self.path)
+        except FileNotFoundError:
+            on_disk = None
+        if on_disk is None or on_disk.st_ino != os.fstat(self.file.fileno()).st_ino:
+            # Another server worker rotated the file, follow it
+            self.file.close()
+            self._open_file()
+            return
+
+        if self.max_bytes and on_disk.st_size >= self.max_bytes:
+            self.file.close()
+            for i in range(self.backup_count - 1, 0, -1):
+                if os.path.exists(f"{self.path}.{i}"):
+                    os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+            if self.backup_count > 0:
+                os.replace(self.path, f"{self.path}.1")
+            else:
+                os.remove(self.path)
+            self._open_file()
+
+    def _stamp(self, line):
+        now = time.time()
+        second = int(now)
+        if second != self._timestamp_second:
+            self._timestamp_second = second
+            self._timestamp = datetime.datetime.fromtimestamp(second).strftime('%Y-%m-%d %H:%M:%S')
+        return f"{self._timestamp} - {line}\n"
 
     def write(self, message):
-        with self.lock:
-            timestamp = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            message_with_timestamp = f"{timestamp} - {message}\n"
-            # Ensure the final text ends with '\n'
-            if not message_with_timestamp.endswith(''):
-                message_with_timestamp += '\n'
-            self.stdout.write(message_with_timestamp)
-            self.stdout.flush()  # Ensure immediate output to console
-            self.file.write(message_with_timestamp)
-            self.file.flush()  # Ensure immediate write to file
+        if not message:
+            return 0
+        with self._condition:
+            text = self._partial + message
+            lines = text.split("\n")
+            self._partial = lines.pop()
+            stamped = [self._stamp(line) for line in lines]
+            for line in stamped:
+                self._enqueue(line)
+            if lines:
+                self._condition.notify()
 
-    def flush(self):
-        with self.lock:
+        if stamped and self.subscribers:
+            self._notify_tails(stamped)
+        return len(message)
+
+    def _enqueue(self, line):
+        # Called with the condition held
+        if len(self._lines) >= self.max_queue:
+            self._dropped += 1
+            if self.policy == DROP_NEWEST:
+                return
+            self._lines.popleft()
+        self._lines.append(line)
+
+    def _write_batches(self):
+        while True:
+            with self._condition:
+                if not self._lines and not self._closed:
+                    self._condition.wait(self.flush_interval)
+                lines = list(self._lines)
+                self._lines.clear()
+                dropped, self._dropped = self._dropped, 0
+                closed = self._closed
+            if dropped:
+                lines.append(self._stamp(f"[ServerTee] {dropped} log lines dropped, the log writer fell behind"))
+            if lines:
+                self._write_out("".join(lines))
+            if closed:
+                return
+
+    def _write_out(self, text):
+        try:
+            self.stdout.write(text)
             self.stdout.flush()
+        except Exception:
+            pass
+        try:
+            self._rotate_if_needed()
+            self.file.write(text)
             self.file.flush()
+        except Exception as e:
+            try:
+                self.stdout.write(f"[ServerTee] cannot write {self.path}: {e}\n")
+            except Exception:
+                pass
+
+    def flush(self):
+        # print(..., flush=True) calls this for every line, just wake the writer up
+        with self._condition:
+            self._condition.notify()
+
+    def isatty(self):
+        return False
 
     def close(self):
-        with self.lock:
+        with self._condition:
+            if self._closed:
+                return
+            if self._partial:
+                self._enqueue(self._stamp(self._partial))
+                self._partial = ""
+            self._closed = True
+            self._condition.notify()
+        self._writer.join()
+        if sys.stdout is self:
             sys.stdout = self.stdout
-            self.file.close()
+        self.file.close()
+
+    def _notify_tails(self, lines):
+        context = log_context.get()
+        if context is None:
+            return
+        username, run_id = context
+        targets = self.subscribers.get(("user", username), []) + self.subscribers.get(("run", run_id), [])
+        if not targets:
+            return
+        try:
+            on_loop = asyncio.get_running_loop() is self._loop
+        except RuntimeError:
+            on_loop = False
+        if on_loop:
+            self.notify_subscribers(targets, lines)
+        else:
+            self._loop.call_soon_threadsafe(self.notify_subscribers, targets, lines)
 
-    def notify_subscribers(self, message):
-        for subscriber in self.subscribers:
-            subscriber.put(message)
+    def notify_subscribers(self, targets, lines):
+        # Runs on the event loop, a slow reader loses its oldest lines
+        for subscriber in targets:
+            for line in lines:
+                subscriber.put_dropping_oldest(line)
 
-    def subscribe(self):
-        q = Queue()
-        self.subscribers.append(q)
-        return q
+    def subscribe(self, username=None, run_id=None):
+        """
+        Live tail of the lines printed for `username`'s runs, or for run `run_id`.
+        Call from the event loop.
+        """
+        self._loop = asyncio.get_running_loop()
+        key = ("run", run_id) if run_id else ("user", username)
+        subscriber = Subscriber(self.tail_buffer_size)
+        subscriber.key = key
+        self.subscribers[key] = self.subscribers.get(key, []) + [subscriber]
+        return subscriber
 
-    def unsubscribe(self, q):
-        self.subscribers.remove(q)
+    def unsubscribe(self, subscriber):
+        # Copy on write, writers on other threads may be iterating over the old list
+        remaining = [s for s in self.subscribers.get(subscriber.key, []) if s is not subscriber]
+        if remaining:
+            self.subscribers[subscriber.key] = remaining
+        else:
+            self.subscribers.pop(subscriber.key, None)
 
-    def stream_to_frontend(self):
-        q = self.subscribe()
+    async def stream_to_frontend(self, username=None, run_id=None):
+        subscriber = self.subscribe(username, run_id)
         try:
             while True:
-                try:
-                    message = q.get(timeout=1)
-                    yield message + "\n"
-                except Empty:
-                    continue
+                line = await subscriber.get()
+                dropped = subscriber.take_dropped()
+                if dropped:
+                    yield f"... {dropped} lines skipped, the reader fell behind\n"
+                if line is END_OF_STREAM:
+                    break
+                yield line
         finally:
-            self.unsubscribe(q)
\ No newline at end of file
+            self.unsubscribe(subscriber)
@@ -3,23 +3,40 @@
 import os
 import re
 import json
-from typing import Dict, List, TypedDict, Any, Annotated, Callable, Literal, Optional, Union
+import asyncio
+import hashlib
+from typing import Dict, List, Tuple, TypedDict, Any, Annotated, Callable, Literal, Optional, Union
 import operator
 import inspect
+from functools import partial
+from dataclasses import dataclass, field
+from types import CodeType
 
+from langchain_core.runnables import RunnableConfig
 from langgraph.graph import StateGraph, END, START
 
 from NodeData import NodeData
-from llm import get_llm, clip_history, create_llm_chain
+from llm import get_llm, create_llm_chain, acreate_llm_chain, new_history, history_prompt, ahistory_prompt, get_history_tokenizer, discard_generation
+from history import History, merge_history
 from util import flush_print
+from tracing import span, traced_node, annotate
+from structured_output import OutputError, parse_json, parse_tool_call, parse_switch
+from graph_cache import GraphCache, graph_cache_key
+from tool_pool import ToolSources, tool_sandbox_enabled, tool_stub, get_tool_pool
+from checkpoint import checkpoint_path, checkpoints_enabled, checkpoint_thread_id, clear_thread, open_checkpointer, aopen_checkpointer
 
 # Tool registry to hold information about tools
 tool_registry: Dict[str, Callable] = {}
 tool_info_registry: Dict[str, str] = {}
+# Code of the TOOL nodes, the tool pool runs the tools from it in worker processes
+tool_sources: ToolSources = []
 
 # Subgraph registry to hold all the subgraph
 subgraph_registry: Dict[str, Any] = {}
 
+# Compiled workflows kept alive between runs of a long-lived worker
+graph_cache = GraphCache()
+
 # Decorator to register tools
 def tool(func: Callable) -> Callable:
     signature = inspect.signature(func)
@@ -29,6 +46,15 @@ def tool(func: Callable) -> Callable:
     tool_info_registry[func.__name__] = tool_info
     return func
 
+def register_pooled_tools(sources: ToolSources):
+    """
+    Registers the tools of `sources` without running their code here: a tool
+    worker runs it and describes the tools, calls go to the tool pool.
+    """
+    for name, described in get_tool_pool().describe(sources).items():
+        tool_registry[name] = tool_stub(name, described["params"])
+        tool_info_registry[name] = described["info"]
+
 def parse_nodes_from_json(graph_data: Dict[str, Any]) -> Dict[str, NodeData]:
     """
     Parses node data from a subgraph's JSON structure.
@@ -48,99 +74,198 @@ def find_nodes_by_type(node_map: Dict[str, NodeData], node_type: str) -> List[No
     return [node for node in node_map.values() if node.type == node_type]
 
 
+def last_value(current: Any, update: Any) -> Any:
+    return update
+
+
+# Nodes return only what they add to the state. Branches of a fan-out run in
+# the same step, LangGraph hands their updates to these reducers in a fixed
+# task order, so the merged history does not depend on which branch finished first.
 class PipelineState(TypedDict):
-    history: Annotated[str, operator.add]
+    history: Annotated[History, merge_history]
     task: Annotated[str, operator.add]
-    condition: Annotated[bool, lambda x, y: y]
+    condition: Annotated[bool, last_value]
 
-def execute_step(name:str, state: PipelineState, prompt_template: str, llm) -> PipelineState:
-    flush_print(f"{name} is working...")
-    state["history"] = clip_history(state["history"])
+# Most re-prompts of a node whose LLM output is not usable JSON of the expected shape
+def json_retries() -> int:
+    return int(os.environ.get("WORKFLOW_JSON_RETRIES", 2))
 
-    generation = create_llm_chain(prompt_template, llm, state["history"])
-    data = json.loads(generation)
-    
-    state["history"] += "\n" + json.dumps(data)
-    state["history"] = clip_history(state["history"])
+def retry_template(name: str, prompt_template: str, template: str, llm, history: str, generation: str, error: OutputError) -> str:
+    """
+    Prompt asking again after `generation` was rejected with `error`. The
+    rejected answer leaves the response cache, a later run asks anew.
+    """
+    discard_generation(template, llm, history)
+    flush_print(f"{name} got an unusable reply: {error}, asking again")
+
+    # Braces of the rejected reply must not read as template variables
+    rejected = generation[:2000].replace("{", "{{").replace("}", "}}")
+    reason = str(error).replace("{", "{{").replace("}", "}}")
+    return prompt_template + f"""
+            your previous reply was rejected, {reason}:
+            {rejected}
+            reply again with only the json
+            """
 
-    flush_print(state["history"])
-    return state
+def generate_valid(name: str, prompt_template: str, llm, history: str, parse: Callable[[str], Any]) -> Any:
+    """
+    Asks the LLM until `parse` accepts its answer, returns what `parse` made of it.
+    Each OutputError is sent back with the prompt, at most json_retries() times.
+    """
+    retries = json_retries()
+    template = prompt_template
+    attempt = 0
+    try:
+        while True:
+            generation = create_llm_chain(template, llm, history, name)
+            try:
+                with span("parse", "json", chars=len(generation)):
+                    return parse(generation)
+            except OutputError as error:
+                if attempt >= retries:
+                    raise
+                template = retry_template(name, prompt_template, template, llm, history, generation, error)
+                attempt += 1
+    finally:
+        annotate(retries=attempt)
+
+async def agenerate_valid(name: str, prompt_template: str, llm, history: str, parse: Callable[[str], Any]) -> Any:
+    retries = json_retries()
+    template = prompt_template
+    attempt = 0
+    try:
+        while True:
+            generation = await acreate_llm_chain(template, llm, history, name)
+            try:
+                with span("parse", "json", chars=len(generation)):
+                    return parse(generation)
+            except OutputError as error:
+                if attempt >= retries:
+                    raise
+                template = retry_template(name, prompt_template, template, llm, history, generation, error)
+                attempt += 1
+    finally:
+        annotate(retries=attempt)
+
+def step_result(state: PipelineState, data: Any) -> Dict[str, Any]:
+    update = json.dumps(data)
+
+    flush_print(merge_history(state["history"], update).render())
+    return {"history": update}
+
+@traced_node("step")
+def execute_step(name:str, state: PipelineState, prompt_template: str, llm) -> Dict[str, Any]:
+    flush_print(f"{name} is working...")
 
-def execute_tool(name: str, state: PipelineState, prompt_template: str, llm) -> PipelineState:
+    data = generate_valid(name, prompt_template, llm, history_prompt(state["history"], llm), parse_json)
+    return step_result(state, data)
 
+@traced_node("step")
+async def aexecute_step(name:str, state: PipelineState, prompt_template: str, llm) -> Dict[str, Any]:
     flush_print(f"{name} is working...")
 
-    state["history"] = clip_history(state["history"])
-    
-    generation = create_llm_chain(prompt_template, llm, state["history"])
+    data = await agenerate_valid(name, prompt_template, llm, await ahistory_prompt(state["history"], llm), parse_json)
+    return step_result(state, data)
 
+def parse_tool_generation(generation: str) -> Tuple[str, List[Any]]:
     # Sanitize the generation output by removing invalid control characters
     sanitized_generation = re.sub(r'[\x00-\x1F\x7F]', '', generation)
 
     flush_print(sanitized_generation)
 
-    data = json.loads(sanitized_generation)
-    
-    choice = data
-    tool_name = choice["function"]
-    args = choice["args"]
-    
-    if tool_name not in tool_registry:
-        raise ValueError(f"Tool {tool_name} not found in registry.")
-    
-    result = tool_registry[tool_name](*args)
+    return parse_tool_call(sanitized_generation, tool_registry)
 
+def call_tool(tool_name: str, args: List[Any]) -> Any:
+    with span("tool", tool_name, sandboxed=tool_sandbox_enabled()):
+        if tool_sandbox_enabled():
+            return get_tool_pool().call(tool_sources, tool_name, args, os.getcwd())
+        return tool_registry[tool_name](*args)
+
+async def acall_tool(tool_name: str, args: List[Any]) -> Any:
+    with span("tool", tool_name, sandboxed=tool_sandbox_enabled()):
+        if tool_sandbox_enabled():
+            # Waits in a thread, other branches go on while the tool runs
+            return await asyncio.to_thread(get_tool_pool().call, tool_sources, tool_name, args, os.getcwd())
+        return tool_registry[tool_name](*args)
+
+def tool_result(state: PipelineState, tool_name: str, args: List[Any], result: Any) -> Dict[str, Any]:
     # Flatten args to a string
     flattened_args = ', '.join(map(str, args))
 
     flush_print(f"\nExecuted Tool: {tool_name}({flattened_args})  Result is: {result}")
 
 
-    state["history"] += f"\nExecuted {tool_name}({flattened_args})  Result is: {result}"
-    state["history"] = clip_history(state["history"])
+    return {"history": f"Executed {tool_name}({flattened_args})  Result is: {result}"}
 
-    return state
+@traced_node("tool")
+def execute_tool(name: str, state: PipelineState, prompt_template: str, llm) -> Dict[str, Any]:
 
-def condition_switch(name:str, state: PipelineState, prompt_template: str, llm) -> PipelineState:
     flush_print(f"{name} is working...")
+    
+    tool_name, args = generate_valid(name, prompt_template, llm, history_prompt(state["history"], llm), parse_tool_generation)
+    return tool_result(state, tool_name, args, call_tool(tool_name, args))
 
-    state["history"] = clip_history(state["history"])
+@traced_node("tool")
+async def aexecute_tool(name: str, state: PipelineState, prompt_template: str, llm) -> Dict[str, Any]:
 
-    generation = create_llm_chain(prompt_template, llm, state["history"])
-    data = json.loads(generation)
-    
-    condition = data["switch"]
-    state["condition"] = condition
+    flush_print(f"{name} is working...")
     
-    state["history"] += f"\nCondition is {condition}"
-    state["history"] = clip_history(state["history"])
+    tool_name, args = await agenerate_valid(name, prompt_template, llm, await ahistory_prompt(state["history"], llm), parse_tool_generation)
+    return tool_result(state, tool_name, args, await acall_tool(tool_name, args))
 
-    return state
+def condition_result(state: PipelineState, condition: bool) -> Dict[str, Any]:
+    return {"condition": condition, "history": f"Condition is {condition}"}
 
-def info_add(name: str, state: PipelineState, information: str, llm) -> PipelineState:
+@traced_node("condition")
+def condition_switch(name:str, state: PipelineState, prompt_template: str, llm) -> Dict[str, Any]:
+    flush_print(f"{name} is working...")
+
+    condition = generate_valid(name, prompt_template, llm, history_prompt(state["history"], llm), parse_switch)
+    return condition_result(state, condition)
+
+@traced_node("condition")
+async def acondition_switch(name:str, state: PipelineState, prompt_template: str, llm) -> Dict[str, Any]:
+    flush_print(f"{name} is working...")
+
+    condition = await agenerate_valid(name, prompt_template, llm, await ahistory_prompt(state["history"], llm), parse_switch)
+    return condition_result(state, condition)
+
+@traced_node("info")
+def info_add(name: str, state: PipelineState, information: str, llm) -> Dict[str, Any]:
     flush_print(f"{name} is adding information...")
 
     # Append the provided information to the history
-    state["history"] += "\n" + information
-    state["history"] = clip_history(state["history"])
+    return {"history": information}
+
 
-    return state
+def subgraph_input(state: PipelineState) -> PipelineState:
+    return PipelineState(
+        history=state["history"],
+        task=state["task"],
+        condition=state["condition"]
+    )
 
+def subgraph_result(state: PipelineState, response: PipelineState) -> Dict[str, Any]:
+    return {
+        # Only the entries the subgraph added, the parent history merges them in
+        "history": response["history"].entries_since(state["history"].seq),
+        "task": response["task"][len(state["task"]):],
+        "condition": response["condition"]
+    }
 
-def sg_add(name:str, state: PipelineState, sg_name: str) -> PipelineState:
+@traced_node("subgraph")
+def sg_add(name:str, state: PipelineState, sg_name: str, config: RunnableConfig) -> Dict[str, Any]:
     flush_print(f"{name} is working, it is a subgraph node call {sg_name} ...")
     subgraph = subgraph_registry[sg_name]
-    response = subgraph.invoke(
-        PipelineState(
-            history=state["history"],
-            task=state["task"],
-            condition=state["condition"]
-        )
-    )
-    state["history"] = response["history"]
-    state["task"] = response["task"]
-    state["condition"] = response["condition"]
-    return state
+    response = subgraph.invoke(subgraph_input(state), config)
+    return subgraph_result(state, response)
+
+@traced_node("subgraph")
+async def asg_add(name:str, state: PipelineState, sg_name: str, config: RunnableConfig) -> Dict[str, Any]:
+    flush_print(f"{name} is working, it is a subgraph node call {sg_name} ...")
+    subgraph = subgraph_registry[sg_name]
+    response = await subgraph.ainvoke(subgraph_input(state), config)
+    return subgraph_result(state, response)
 
 
 def conditional_edge(state: PipelineState) -> Literal["True", "False"]:
@@ -149,10 +274,16 @@ def conditional_edge(state: PipelineState) -> Literal["True", "False"]:
     else:
         return "False"
 
-def build_subgraph(node_map: Dict[str, NodeData], llm) -> StateGraph:
+def build_subgraph(node_map: Dict[str, NodeData], llm, use_async: bool = False) -> StateGraph:
     # Define the state machine
     subgraph = StateGraph(PipelineState)
 
+    # Node functions, coroutines when the graph is run with ainvoke/astream
+    if use_async:
+        step_fn, tool_fn, condition_fn, sg_fn = aexecute_step, aexecute_tool, acondition_switch, asg_add
+    else:
+        step_fn, tool_fn, condition_fn, sg_fn = execute_step, execute_tool, condition_switch, sg_add
+
     # Start node, only one start point
     start_node = find_nodes_by_type(node_map, "START")[0]
     flush_print(f"Start root ID: {start_node.uniq_id}")
@@ -173,7 +304,7 @@ def build_subgraph(node_map: Dict[str, NodeData], llm) -> StateGraph:
             """
             subgraph.add_node(
                 current_node.uniq_id, 
-                lambda state, template=prompt_template, llm=llm, name=current_node.name : execute_tool(name, state, template, llm)
+                partial(tool_fn, current_node.name, prompt_template=prompt_template, llm=llm)
             )
         else:
             prompt_template=f"""
@@ -183,7 +314,7 @@ def build_subgraph(node_map: Dict[str, NodeData], llm) -> StateGraph:
             """
             subgraph.add_node(
                 current_node.uniq_id, 
-                lambda state, template=prompt_template, llm=llm, name=current_node.name: execute_step(name, state, template, llm)
+                partial(step_fn, current_node.name, prompt_template=prompt_template, llm=llm)
             )
 
     # Add INFO nodes
@@ -192,7 +323,7 @@ def build_subgraph(node_map: Dict[str, NodeData], llm) -> StateGraph:
         # INFO nodes just append predefined information to the state history
         subgraph.add_node(
             info_node.uniq_id, 
-            lambda state, template=info_node.description, llm=llm, name=info_node.name: info_add(name, state, template, llm)
+            partial(info_add, info_node.name, information=info_node.description, llm=llm)
         )
     
     # Add SUBGRAPH nodes
@@ -200,7 +331,7 @@ def build_subgraph(node_map: Dict[str, NodeData], llm) -> StateGraph:
     for sg_node in subgraph_nodes:
         subgraph.add_node(
             sg_node.uniq_id, 
-            lambda state, llm=llm, name=sg_node.name, sg_name=sg_node.name: sg_add(name, state, sg_name)
+            partial(sg_fn, sg_node.name, sg_name=sg_node.name)
         )
 
     # Edges
@@ -229,7 +360,7 @@ def build_subgraph(node_map: Dict[str, NodeData], llm) -> StateGraph:
         """
         subgraph.add_node(
             condition.uniq_id, 
-            lambda state, template=condition_template, llm=llm, name=condition.name: condition_switch(name, state, template, llm)
+            partial(condition_fn, condition.name, prompt_template=condition_template, llm=llm)
         )
 
         flush_print(f"{condition.name} {condition.uniq_id}'s condition")
@@ -249,51 +380,225 @@ def build_subgraph(node_map: Dict[str, NodeData], llm) -> StateGraph:
 class MainGraphState(TypedDict):
     input: Union[str, None]
 
-def invoke_root(state: MainGraphState):
+def invoke_root(state: MainGraphState, config: RunnableConfig, llm):
     subgraph = subgraph_registry["root"]
     response = subgraph.invoke(
         PipelineState(
-            history="",
+            history=new_history(llm),
             task="",
             condition=False
-        )
+        ),
+        config
     )
     return  {"input": None}
 
+async def ainvoke_root(state: MainGraphState, config: RunnableConfig, llm):
+    subgraph = subgraph_registry["root"]
+    response = await subgraph.ainvoke(
+        PipelineState(
+            history=new_history(llm),
+            task="",
+            condition=False
+        ),
+        config
+    )
+    return  {"input": None}
+
+
+@dataclass
+class CompiledWorkflow:
+    # Compiled TOOL node code, re-run to register the tools again (empty with TOOL_SANDBOX)
+    tool_codes: List[CodeType] = field(default_factory=list)
+    # The same code as (node name, source), for the tool pool
+    tool_sources: ToolSources = field(default_factory=list)
+    # Compiled subgraphs by name
+    subgraphs: Dict[str, Any] = field(default_factory=dict)
+    main_graph: Any = None
+    # sha256 of graph.json, checkpoints of another graph are never resumed
+    graph_hash: str = ""
+
+
+def build_workflow(graphs: List[Dict[str, Any]], llm, use_async: bool = False) -> CompiledWorkflow:
+    workflow = CompiledWorkflow()
 
-def run_workflow_as_server(llm):
-    # Load subgraph data
-    with open("graph.json", 'r') as file:
-        graphs = json.load(file)
-    
     # Process each subgraph
     for graph in graphs:
         subgraph_name = graph.get("name")        
         node_map = parse_nodes_from_json(graph)
         
         # Register the tool functions dynamically if has tool node, must before build graph
-        for tool_node in find_nodes_by_type(node_map, "TOOL"):
-            tool_code = f"{tool_node.description}"
-            exec(tool_code, globals())
+        tool_nodes = find_nodes_by_type(node_map, "TOOL")
+        for tool_node in tool_nodes:
+            workflow.tool_sources.append((tool_node.name, tool_node.description))
+            tool_sources.append((tool_node.name, tool_node.description))
+            if not tool_sandbox_enabled():
+                tool_code = compile(f"{tool_node.description}", f"<tool {tool_node.name}>", "exec")
+                exec(tool_code, globals())
+                workflow.tool_codes.append(tool_code)
+        if tool_nodes and tool_sandbox_enabled():
+            # Not even the module level of the TOOL code runs in this process
+            register_pooled_tools(tool_sources)
 
         
-        subgraph = build_subgraph(node_map, llm)
+        subgraph = build_subgraph(node_map, llm, use_async)
         subgraph_registry[subgraph_name] = subgraph
+        workflow.subgraphs[subgraph_name] = subgraph
 
     
     # Main Graph
     main_graph = StateGraph(MainGraphState)
-    main_graph.add_node("subgraph", invoke_root)
+    main_graph.add_node("subgraph", partial(ainvoke_root if use_async else invoke_root, llm=llm))
     main_graph.set_entry_point("subgraph")
-    main_graph = main_graph.compile()
+    workflow.main_graph = main_graph.compile()
+
+    return workflow
+
+
+def activate_workflow(workflow: CompiledWorkflow):
+    """
+    Registers the tools and subgraphs of a cached workflow again.
+    """
+    for tool_code in workflow.tool_codes:
+        exec(tool_code, globals())
+    if workflow.tool_sources and not workflow.tool_codes:
+        register_pooled_tools(workflow.tool_sources)
+    subgraph_registry.update(workflow.subgraphs)
+    tool_sources[:] = workflow.tool_sources
+
+
+def load_workflow(llm, llm_config: Any = None, use_async: bool = False) -> CompiledWorkflow:
+    """
+    Builds the workflow of graph.json in the current directory. When `llm_config`
+    identifies the LLM, the compiled workflow is cached for the next run of the same graph.
+    """
+    # Load subgraph data
+    with open("graph.json", 'rb') as file:
+        raw_graph = file.read()
+
+    cache_key = graph_cache_key(raw_graph, [llm_config, use_async]) if llm_config is not None else None
+    workflow = graph_cache.get(cache_key) if cache_key else None
+
+    if workflow is None:
+        workflow = build_workflow(json.loads(raw_graph), llm, use_async)
+        workflow.graph_hash = hashlib.sha256(raw_graph).hexdigest()
+        if cache_key:
+            graph_cache.put(cache_key, workflow)
+    else:
+        flush_print("Reusing compiled graph")
+        activate_workflow(workflow)
+
+    if tool_sources and tool_sandbox_enabled():
+        # Tool workers start and load the code while the first nodes run
+        get_tool_pool().preload(tool_sources)
+
+    return workflow
+
+
+def run_config(max_concurrency: Optional[int] = None) -> RunnableConfig:
+    """
+    Config shared by the main graph and every subgraph of a run. `max_concurrency`
+    caps how many nodes of a fan-out run at once, WORKFLOW_MAX_CONCURRENCY by default.
+    """
+    if max_concurrency is None and os.environ.get("WORKFLOW_MAX_CONCURRENCY"):
+        max_concurrency = int(os.environ["WORKFLOW_MAX_CONCURRENCY"])
+    config: RunnableConfig = {}
+    if max_concurrency:
+        config["max_concurrency"] = max_concurrency
+    # Long chains and condition loops need more steps than LangGraph's default of 25
+    if os.environ.get("WORKFLOW_RECURSION_LIMIT"):
+        config["recursion_limit"] = int(os.environ["WORKFLOW_RECURSION_LIMIT"])
+    return config
+
+
+def checkpoint_config(workflow: CompiledWorkflow, llm_config: Any, config: RunnableConfig) -> RunnableConfig:
+    thread_id = checkpoint_thread_id(workflow.graph_hash, llm_config)
+    return {**config, "configurable": {"thread_id": thread_id}}
+
+
+def run_workflow_as_server(llm, llm_config: Any = None, max_concurrency: Optional[int] = None, resume: bool = False):
+    workflow = load_workflow(llm, llm_config)
+    config = run_config(max_concurrency)
 
+    if not checkpoints_enabled():
+        if resume:
+            flush_print("Checkpoints are off, running from the start")
+        for state in workflow.main_graph.stream({"input": None}, config):
+            flush_print(state)
+        return
 
     # ==========================
-    # Run
+    # Run, checkpointed after every step for the workspace
     # ==========================
-    for state in main_graph.stream(
-        {
-            "input": None,
-        }
-    ):
-        flush_print(state)
\ No newline at end of file
+    path = checkpoint_path(os.getcwd())
+    config = checkpoint_config(workflow, llm_config, config)
+    thread_id = config["configurable"]["thread_id"]
+    with open_checkpointer(path, get_history_tokenizer(llm)) as checkpointer:
+        main_graph = workflow.main_graph.copy({"checkpointer": checkpointer})
+        graph_input = {"input": None}
+        if resume and main_graph.get_state(config).next:
+            flush_print("Resuming from the last checkpoint")
+            graph_input = None
+        else:
+            clear_thread(path, thread_id)
+
+        for state in main_graph.stream(graph_input, config):
+            flush_print(state)
+
+    # Finished, the next run starts from START again
+    clear_thread(path, thread_id)
+
+
+async def arun_workflow_as_server(llm, llm_config: Any = None, max_concurrency: Optional[int] = None, resume: bool = False):
+    """
+    Async version of run_workflow_as_server, every LLM call and subgraph
+    is awaited so the run only holds the event loop while it computes.
+    """
+    workflow = load_workflow(llm, llm_config, use_async=True)
+    config = run_config(max_concurrency)
+
+    if not checkpoints_enabled():
+        if resume:
+            flush_print("Checkpoints are off, running from the start")
+        async for state in workflow.main_graph.astream({"input": None}, config):
+            flush_print(state)
+        return
+
+    path = checkpoint_path(os.getcwd())
+    config = checkpoint_config(workflow, llm_config, config)
+    thread_id = config["configurable"]["thread_id"]
+    async with aopen_checkpointer(path, get_history_tokenizer(llm)) as checkpointer:
+        main_graph = workflow.main_graph.copy({"checkpointer": checkpointer})
+        graph_input = {"input": None}
+        if resume and (await main_graph.aget_state(config)).next:
+            flush_print("Resuming from the last checkpoint")
+            graph_input = None
+        else:
+            clear_thread(path, thread_id)
+
+        async for state in main_graph.astream(graph_input, config):
+            flush_print(state)
+
+    clear_thread(path, thread_id)
+
+
+def reset_workflow_state():
+    """
+    Forgets the tools and subgraphs of the last run, including any names the
+    TOOL nodes exec'd into this module, so a long-lived worker can run the next
+    workflow as if it were a fresh process.
+    """
+    tool_registry.clear()
+    tool_info_registry.clear()
+    tool_sources.clear()
+    subgraph_registry.clear()
+
+    module_globals = globals()
+    for name in list(module_globals):
+        if name not in _module_snapshot:
+            del module_globals[name]
+    module_globals.update(_module_snapshot)
+
+
+# Module namespace as it is before any TOOL node code runs
+_module_snapshot: Dict[str, Any] = {}
+_module_snapshot.update(globals())
@@ -0,0 +1,336 @@
+# benchmark.py
+
+import os
+import io
+import sys
+import json
+import time
+import socket
+import asyncio
+import argparse
+import tempfile
+import statistics
+import contextlib
+import subprocess
+from typing import Any, Callable, Dict, List
+
+# Benchmarks measure the engine, not the answer cache
+os.environ["LLM_CACHE"] = "0"
+# Scaled up chains and loops take more steps than LangGraph allows by default
+os.environ.setdefault("WORKFLOW_RECURSION_LIMIT", "10000")
+
+import llm as llm_module
+from fake_llm import fake_llm_from_spec
+from util import parse_event
+from WorkFlow import build_workflow, run_workflow_as_server, arun_workflow_as_server, reset_workflow_state
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+
+TOOL_CODE = '''@tool
+def bench_tool(x: int = 1):
+    """Returns its argument"""
+    return x
+'''
+
+
+# ==========================
+# Generated graph.json workloads
+# ==========================
+
+def node(uniq_id: str, type: str, nexts: List[str] = (), **fields) -> Dict[str, Any]:
+    return {"uniq_id": uniq_id, "type": type, "name": fields.pop("name", uniq_id), "nexts": list(nexts), **fields}
+
+def chain_graph(length: int) -> List[Dict[str, Any]]:
+    nodes = [node("start", "START", ["s0"])]
+    for i in range(length):
+        nexts = [f"s{i + 1}"] if i + 1 < length else []
+        nodes.append(node(f"s{i}", "STEP", nexts, description=f"Step {i} of a long chain"))
+    return [{"name": "root", "nodes": nodes}]
+
+def fanout_graph(width: int) -> List[Dict[str, Any]]:
+    branches = [f"b{i}" for i in range(width)]
+    nodes = [node("start", "START", ["split"]), node("split", "STEP", branches, description="Split the task")]
+    for branch in branches:
+        nodes.append(node(branch, "STEP", ["join"], description=f"Branch {branch}"))
+    nodes.append(node("join", "STEP", [], description="Join the branches"))
+    return [{"name": "root", "nodes": nodes}]
+
+def nested_graph(depth: int) -> List[Dict[str, Any]]:
+    graphs = []
+    for level in range(depth + 1):
+        name = "root" if level == 0 else f"level{level}"
+        nexts = [f"sg{level}"] if level < depth else []
+        nodes = [node("start", "START", ["work"]), node("work", "STEP", nexts, description=f"Work at level {level}")]
+        if level < depth:
+            nodes.append(node(f"sg{level}", "SUBGRAPH", [], name=f"level{level + 1}"))
+        graphs.append({"name": name, "nodes": nodes})
+    return graphs
+
+def loop_graph() -> List[Dict[str, Any]]:
+    # work -> tool -> check, check loops back to work while the fake LLM says True
+    nodes = [
+        node("start", "START", ["work"]),
+        node("tool", "TOOL", [], name="bench_tool", description=TOOL_CODE),
+        node("work", "STEP", ["use_tool"], description="Do one iteration"),
+        node("use_tool", "STEP", ["check"], description="Call the tool", tool="bench_tool"),
+        node("check", "CONDITION", [], description="Is another iteration needed?", true_next="work", false_next=None),
+    ]
+    return [{"name": "root", "nodes": nodes}]
+
+def history_graph(entries: int, entry_chars: int = 4000) -> List[Dict[str, Any]]:
+    ids = [f"i{i}" for i in range(entries)] + ["s0", "s1", "s2"]
+    nodes = [node("start", "START", [ids[0]])]
+    for i, uniq_id in enumerate(ids):
+        nexts = [ids[i + 1]] if i + 1 < len(ids) else []
+        if uniq_id.startswith("i"):
+            nodes.append(node(uniq_id, "INFO", nexts, description=f"Fact {i}: " + "lorem ipsum " * (entry_chars // 12)))
+        else:
+            nodes.append(node(uniq_id, "STEP", nexts, description="Use the facts"))
+    return [{"name": "root", "nodes": nodes}]
+
+# name: (graph, llm_model options, node executions of one run)
+def workloads(scale: int) -> Dict[str, Any]:
+    loops = 2 * scale
+    return {
+        "chain": (chain_graph(20 * scale), "", 20 * scale),
+        "fanout": (fanout_graph(16 * scale), "", 16 * scale + 2),
+        "nested": (nested_graph(4 * scale), "", 2 * (4 * scale) + 1),
+        "loop": (loop_graph(), f"loops={loops}", 3 * (loops + 1)),
+        "history": (history_graph(40 * scale), "", 40 * scale + 3),
+    }
+
+
+# ==========================
+# In-process measurements
+# ==========================
+
+def fake_model(options: str, latency: float, tps: float) -> str:
+    spec = f"fake:latency={latency},tps={tps}"
+    return f"{spec},{options}" if options else spec
+
+@contextlib.contextmanager
+def captured_output():
+    # The workflow prints every state and trace, keep it off the console
+    buffer = io.StringIO()
+    with contextlib.redirect_stdout(buffer):
+        yield buffer
+
+def count_node_traces(output: str) -> int:
+    count = 0
+    for line in output.splitlines():
+        event = parse_event(line)
+        if event and event[0] == "trace" and event[1].get("kind") == "node":
+            count += 1
+    return count
+
+def time_call(func: Callable, repeat: int) -> List[float]:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append((time.perf_counter() - start) * 1000)
+    return times
+
+def bench_build(graph, repeat: int) -> float:
+    llm = fake_llm_from_spec("fake")
+
+    def build():
+        with captured_output():
+            build_workflow(graph, llm)
+        reset_workflow_state()
+    return statistics.median(time_call(build, repeat))
+
+def bench_run(graph, model: str, repeat: int, use_async: bool):
+    workspace = tempfile.mkdtemp(prefix="bench-")
+    with open(os.path.join(workspace, "graph.json"), "w") as f:
+        json.dump(graph, f)
+
+    home = os.getcwd()
+    os.chdir(workspace)
+    nodes = 0
+    try:
+        def run():
+            nonlocal nodes
+            llm = fake_llm_from_spec(model)
+            with captured_output() as output:
+                if use_async:
+                    asyncio.run(arun_workflow_as_server(llm))
+                else:
+                    run_workflow_as_server(llm)
+            reset_workflow_state()
+            nodes = count_node_traces(output.getvalue())
+        times = time_call(run, repeat)
+    finally:
+        os.chdir(home)
+    return statistics.median(times), nodes
+
+
+# ==========================
+# /run SSE throughput
+# ==========================
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+async def wait_for_server(client, url: str, timeout: float = 60):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            await client.get(f"{url}/status/bench")
+            return
+        except Exception:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.2)
+
+async def run_user(client, url: str, username: str, graph, model: str) -> Dict[str, float]:
+    await client.post(f"{url}/upload/{username}", files=[("files", ("graph.json", json.dumps(graph).encode()))])
+    start = time.perf_counter()
+    first = None
+    events = 0
+    received = 0
+    async with client.stream("POST", f"{url}/run/{username}", json={"llm_model": model, "api_key": ""}) as response:
+        async for line in response.aiter_lines():
+            received += len(line) + 1
+            if line == "":
+                events += 1
+                if first is None:
+                    first = time.perf_counter() - start
+    return {"seconds": time.perf_counter() - start, "first_event": first or 0.0, "events": events, "bytes": received}
+
+async def bench_sse(users: int, graph, model: str, runs_per_user: int) -> Dict[str, float]:
+    import httpx
+
+    port = free_port()
+    url = f"http://127.0.0.1:{port}"
+    state_dir = tempfile.mkdtemp(prefix="bench-server-")
+    env = dict(
+        os.environ,
+        RUN_LOG_DIR=state_dir,
+        RUN_REGISTRY_PATH=os.path.join(state_dir, "registry.sqlite"),
+        MAX_CONCURRENT_RUNS=str(users),
+        WORKER_POOL_SIZE=str(users),
+    )
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "server:app", "--host", "127.0.0.1", "--port", str(port)],
+        cwd=SRC_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        async with httpx.AsyncClient(timeout=None) as client:
+            await wait_for_server(client, url)
+
+            async def user_loop(i):
+                results = []
+                for _ in range(runs_per_user):
+                    results.append(await run_user(client, url, f"bench_{i}", graph, model))
+                return results
+
+            start = time.perf_counter()
+            per_user = await asyncio.gather(*(user_loop(i) for i in range(users)))
+            elapsed = time.perf_counter() - start
+
+            for i in range(users):
+                await client.post(f"{url}/clean-cache/bench_{i}")
+    finally:
+        server.terminate()
+        server.wait()
+
+    results = [result for user_results in per_user for result in user_results]
+    latencies = sorted(result["seconds"] * 1000 for result in results)
+    return {
+        "users": users,
+        "runs_per_second": len(results) / elapsed,
+        "events_per_second": sum(result["events"] for result in results) / elapsed,
+        "bytes_per_second": sum(result["bytes"] for result in results) / elapsed,
+        "first_event_ms": statistics.median(result["first_event"] * 1000 for result in results),
+        "run_p50_ms": latencies[len(latencies) // 2],
+        "run_p95_ms": latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))],
+    }
+
+
+# ==========================
+# Baseline comparison
+# ==========================
+
+def flatten(results: Dict[str, Any], prefix: str = "") -> Dict[str, float]:
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)):
+            flat[f"{prefix}{key}"] = value
+    return flat
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any], tolerance: float) -> List[str]:
+    """
+    Prints every metric next to the baseline, returns the metrics more than
+    `tolerance` percent worse. Rates are better higher, everything else lower.
+    """
+    regressions = []
+    current, previous = flatten(results), flatten(baseline)
+    print(f"{'metric':45} {'baseline':>12} {'current':>12} {'change':>9}")
+    for key, value in current.items():
+        if key not in previous or key.endswith("users") or key.endswith("nodes"):
+            continue
+        before = previous[key]
+        change = (value - before) / before * 100 if before else 0.0
+        worse = -change if key.endswith("_per_second") else change
+        flag = "  <-- regression" if worse > tolerance else ""
+        print(f"{key:45} {before:12.2f} {value:12.2f} {change:+8.1f}%{flag}")
+        if flag:
+            regressions.append(key)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the workflow engine and the server with a fake LLM.")
+    parser.add_argument("--scale", type=int, default=1, help="Size multiplier of the generated workloads.")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per measurement, the median is reported.")
+    parser.add_argument("--latency", type=float, default=0.05, help="Fake LLM latency in seconds for run latency.")
+    parser.add_argument("--tps", type=float, default=200, help="Fake LLM tokens per second for run latency.")
+    parser.add_argument("--async", dest="use_async", action="store_true", help="Run workflows with ainvoke/astream.")
+    parser.add_argument("--users", type=int, default=0, help="Concurrent /run users for the SSE benchmark, 0 skips it.")
+    parser.add_argument("--runs-per-user", type=int, default=3, help="Runs every SSE benchmark user makes.")
+    parser.add_argument("--baseline", default="benchmark_baseline.json", help="Results to compare against.")
+    parser.add_argument("--save-baseline", action="store_true", help="Store these results as the new baseline.")
+    parser.add_argument("--tolerance", type=float, default=20, help="Percent a metric may get worse before it counts as a regression.")
+    args = parser.parse_args()
+
+    # The stream of "token" events is part of what a run costs
+    llm_module.stream_tokens = True
+
+    results: Dict[str, Any] = {"build_ms": {}, "node_overhead_ms": {}, "run_ms": {}}
+    for name, (graph, options, expected_nodes) in workloads(args.scale).items():
+        results["build_ms"][name] = bench_build(graph, args.repeat)
+
+        # Without latency all that is left is the engine
+        instant, nodes = bench_run(graph, fake_model(options, 0, 0), args.repeat, args.use_async)
+        results["node_overhead_ms"][name] = instant / max(nodes or expected_nodes, 1)
+
+        results["run_ms"][name], _ = bench_run(graph, fake_model(options, args.latency, args.tps), args.repeat, args.use_async)
+        print(f"{name}: build {results['build_ms'][name]:.1f} ms, "
+              f"{results['node_overhead_ms'][name]:.2f} ms per node ({nodes} nodes), "
+              f"run {results['run_ms'][name]:.1f} ms", file=sys.stderr)
+
+    if args.users:
+        graph, options, _ = workloads(args.scale)["chain"]
+        model = fake_model(options, args.latency, args.tps)
+        results["sse"] = asyncio.run(bench_sse(args.users, graph, model, args.runs_per_user))
+
+    print(json.dumps(results, indent=2))
+
+    regressions = []
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Saved baseline to {args.baseline}")
+
+    sys.exit(1 if regressions else 0)
+
+if __name__ == "__main__":
+    main()
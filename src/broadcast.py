@@ -0,0 +1,93 @@
+# broadcast.py
+
+import os
+import asyncio
+from typing import Any, List, Optional
+
+# Marks the end of a broadcast, subscribers stop reading when they get it
+END_OF_STREAM = object()
+
+DROP_OLDEST = "drop_oldest"
+BLOCK = "block"
+
+
+class Subscriber:
+    """
+    Bounded buffer of one reader of a Broadcaster.
+    """
+
+    def __init__(self, maxsize: int):
+        self.queue = asyncio.Queue(maxsize)
+        self._dropped = 0
+
+    async def get(self) -> Any:
+        return await self.queue.get()
+
+    def take_dropped(self) -> int:
+        """Number of items dropped for this reader since the last call."""
+        dropped, self._dropped = self._dropped, 0
+        return dropped
+
+    def put_dropping_oldest(self, item: Any):
+        while self.queue.full():
+            self.queue.get_nowait()
+            self._dropped += 1
+        self.queue.put_nowait(item)
+
+    def drain(self):
+        while not self.queue.empty():
+            self.queue.get_nowait()
+
+
+class Broadcaster:
+    """
+    Fans published items out to every subscriber, each with its own bounded buffer.
+
+    When a buffer is full the policy decides: DROP_OLDEST throws away the
+    reader's oldest item, BLOCK makes the publisher wait up to `block_timeout`
+    seconds for the reader (slowing the producer down) before dropping.
+    """
+
+    def __init__(self, maxsize: Optional[int] = None, policy: Optional[str] = None, block_timeout: Optional[float] = None):
+        self.maxsize = maxsize if maxsize is not None else int(os.environ.get("STREAM_BUFFER_SIZE", 1000))
+        self.policy = policy or os.environ.get("STREAM_OVERFLOW", DROP_OLDEST)
+        self.block_timeout = block_timeout if block_timeout is not None else float(os.environ.get("STREAM_BLOCK_TIMEOUT", 5))
+        self._subscribers: List[Subscriber] = []
+
+    def subscribe(self) -> Subscriber:
+        subscriber = Subscriber(self.maxsize)
+        self._subscribers.append(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber):
+        if subscriber in self._subscribers:
+            self._subscribers.remove(subscriber)
+        # Wake up a publisher blocked on this reader
+        subscriber.drain()
+
+    @property
+    def subscriber_count(self) -> int:
+        return len(self._subscribers)
+
+    async def publish(self, item: Any):
+        for subscriber in list(self._subscribers):
+            if not subscriber.queue.full():
+                subscriber.queue.put_nowait(item)
+            elif self.policy == BLOCK:
+                try:
+                    await asyncio.wait_for(subscriber.queue.put(item), timeout=self.block_timeout)
+                except asyncio.TimeoutError:
+                    subscriber.put_dropping_oldest(item)
+            else:
+                subscriber.put_dropping_oldest(item)
+
+    def publish_nowait(self, item: Any):
+        """Publishes without ever waiting, dropping the oldest items of full buffers."""
+        for subscriber in list(self._subscribers):
+            subscriber.put_dropping_oldest(item)
+
+    def close(self):
+        """Ends the broadcast for every current subscriber, they are removed."""
+        for subscriber in self._subscribers:
+            subscriber.put_dropping_oldest(END_OF_STREAM)
+        self._subscribers = []
@@ -0,0 +1,142 @@
+# cassette.py
+
+import os
+import re
+import gzip
+import json
+import hashlib
+from collections import deque
+from threading import Lock
+from typing import Any, Dict, Optional, Tuple
+
+# Cassettes of a workspace, named after the run that recorded them
+CASSETTE_DIR = "cassettes"
+CASSETTE_NAME_PATTERN = re.compile(r"^[0-9A-Za-z_-]{1,64}$")
+
+
+class CassetteMismatch(Exception):
+    """A strict replay was asked a prompt the cassette has no answer for."""
+
+
+def prompt_hash(prompt: str) -> str:
+    return hashlib.sha256(prompt.encode()).hexdigest()[:32]
+
+
+def cassette_path(workspace: str, name: str) -> str:
+    if not CASSETTE_NAME_PATTERN.match(name):
+        raise ValueError(f"Invalid cassette name {name}")
+    return os.path.join(workspace, CASSETTE_DIR, f"{name}.jsonl.gz")
+
+
+def check_cassette_options(options: Any):
+    """
+    Raises ValueError unless `options` are "cassette" options a request may send, or None.
+    """
+    if options is None:
+        return
+    if not isinstance(options, dict):
+        raise ValueError('cassette must be an object like {"record": true} or {"replay": "<name>"}')
+    for key in ("replay", "live_from"):
+        if options.get(key) is not None and not isinstance(options[key], str):
+            raise ValueError(f"cassette {key} must be a string")
+
+
+class Cassette:
+    """
+    Records the LLM answers of a run and replays them in a later run.
+
+    A cassette is a gzipped JSON line per call: {"node", "prompt" (sha256
+    prefix of the rendered prompt), "response"}. Replay answers a call with
+    the recorded response of the same node and prompt, in recording order when
+    the same prompt was asked more than once. An unknown prompt raises
+    CassetteMismatch when `strict`, otherwise the live LLM answers it.
+    From the first call of node `live_from` on, every call goes to the live LLM.
+    """
+
+    def __init__(
+        self,
+        record_path: Optional[str] = None,
+        replay_path: Optional[str] = None,
+        strict: bool = True,
+        live_from: Optional[str] = None
+    ):
+        self.replay_path = replay_path
+        self.strict = strict
+        self.live_from = live_from
+        self.live = replay_path is None
+        self._lock = Lock()
+        self._answers: Dict[Tuple[str, str], deque] = {}
+        self.replayed = 0
+        if replay_path is not None:
+            self._load(replay_path)
+
+        self._out = None
+        if record_path is not None:
+            os.makedirs(os.path.dirname(record_path), exist_ok=True)
+            # Appended, gzip members follow each other in one file
+            self._out = gzip.open(record_path, "at")
+
+    @classmethod
+    def from_options(cls, options: Optional[Dict[str, Any]], workspace: str, record_name: Optional[str]) -> Optional["Cassette"]:
+        """
+        Cassette asked for by the "cassette" options of a request:
+        {"record": bool, "replay": name, "strict": bool, "live_from": node name}.
+        Recording goes to the cassette `record_name` of `workspace`, e.g. the run id.
+        """
+        check_cassette_options(options)
+        options = options or {}
+        record = options.get("record") and record_name
+        replay = options.get("replay")
+        if not record and not replay:
+            return None
+        return cls(
+            record_path=cassette_path(workspace, record_name) if record else None,
+            replay_path=cassette_path(workspace, replay) if replay else None,
+            strict=options.get("strict", True),
+            live_from=options.get("live_from") or None,
+        )
+
+    def _load(self, path: str):
+        with gzip.open(path, "rt") as f:
+            try:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    entry = json.loads(line)
+                    self._answers.setdefault((entry["node"], entry["prompt"]), deque()).append(entry["response"])
+            except (EOFError, ValueError):
+                pass  # cut short by a crash while recording, keep what was written
+
+    def play(self, node: str, prompt: str) -> Optional[str]:
+        """
+        Recorded answer of `node` to `prompt`, None when the live LLM has to answer.
+        """
+        with self._lock:
+            if self.live_from is not None and node == self.live_from:
+                self.live = True
+            if self.live:
+                return None
+
+            answers = self._answers.get((node, prompt_hash(prompt)))
+            if not answers:
+                if self.strict:
+                    raise CassetteMismatch(f"{self.replay_path} has no answer of {node} to this prompt")
+                return None
+            # The last answer to a prompt stays for any further repeat of it
+            response = answers.popleft() if len(answers) > 1 else answers[0]
+            self.replayed += 1
+            return response
+
+    def record(self, node: str, prompt: str, response: str):
+        if self._out is None:
+            return
+        with self._lock:
+            self._out.write(json.dumps({"node": node, "prompt": prompt_hash(prompt), "response": response}) + "\n")
+            # Every answer reaches the file, a run that fails later still leaves its cassette
+            self._out.flush()
+
+    def close(self):
+        with self._lock:
+            if self._out is not None:
+                self._out.close()
+                self._out = None
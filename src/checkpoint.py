@@ -0,0 +1,177 @@
+# checkpoint.py
+
+import os
+import hashlib
+import sqlite3
+from contextlib import contextmanager, asynccontextmanager
+from threading import Lock
+from typing import Any, Dict, List, Optional
+
+from history import History
+from tokenizer import TokenCounter
+
+# Outside the workspaces, so /manifest, /sync and /download never carry them
+CHECKPOINT_DIR = os.environ.get(
+    "CHECKPOINT_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "state", "checkpoints")
+)
+
+# Marks a History replaced by references to its entries in the history_entries table
+HISTORY_MARKER = "__history__"
+
+try:
+    from langgraph.checkpoint.serde.jsonplus import JsonPlusSerializer
+    from langgraph.checkpoint.sqlite import SqliteSaver
+except ImportError:  # langgraph-checkpoint-sqlite is optional
+    SqliteSaver = None
+
+
+def checkpoints_enabled() -> bool:
+    """
+    WORKFLOW_CHECKPOINTS=0 turns checkpoints off, they also need langgraph-checkpoint-sqlite.
+    """
+    return os.environ.get("WORKFLOW_CHECKPOINTS", "1") == "1" and SqliteSaver is not None
+
+
+def checkpoint_thread_id(graph_hash: str, llm_config: Any) -> str:
+    # One thread per graph and model, a changed graph.json never resumes an old run
+    return hashlib.sha256(f"{graph_hash}:{llm_config!r}".encode()).hexdigest()[:32]
+
+
+def checkpoint_path(workspace: str) -> str:
+    """
+    The checkpoint database of the runs in `workspace`, one per workspace.
+    """
+    os.makedirs(CHECKPOINT_DIR, exist_ok=True)
+    key = hashlib.sha256(os.path.realpath(workspace).encode()).hexdigest()[:32]
+    return os.path.join(CHECKPOINT_DIR, f"{key}.sqlite")
+
+
+def entry_hash(entry: str) -> str:
+    return hashlib.sha256(entry.encode()).hexdigest()[:32]
+
+
+class HistorySerializer:
+    """
+    Checkpoint serializer that stores every History entry once, in the
+    history_entries table, and only their hashes in the checkpoints. Each
+    checkpoint of a run then adds the new entries instead of a copy of the
+    whole history.
+    """
+
+    def __init__(self, path: str, count_tokens: Optional[TokenCounter] = None):
+        self.inner = JsonPlusSerializer()
+        self.count_tokens = count_tokens
+        self._lock = Lock()
+        # Own connection, the checkpointer holds its lock while it serializes
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS history_entries (hash TEXT PRIMARY KEY, entry TEXT NOT NULL)")
+        # Entries known to be in the table, by entry string, so each is hashed once
+        self._hashes: Dict[str, str] = {}
+
+    def close(self):
+        self._conn.close()
+
+    def _store(self, entries: List[str]) -> List[str]:
+        new = [entry for entry in entries if entry not in self._hashes]
+        if new:
+            rows = [(entry_hash(entry), entry) for entry in new]
+            with self._lock:
+                self._conn.executemany("INSERT OR IGNORE INTO history_entries (hash, entry) VALUES (?, ?)", rows)
+            if len(self._hashes) > 100000:
+                self._hashes.clear()
+            self._hashes.update((entry, digest) for digest, entry in rows)
+        return [self._hashes[entry] for entry in entries]
+
+    def _load(self, hashes: List[str]) -> List[str]:
+        found: Dict[str, str] = {}
+        with self._lock:
+            for i in range(0, len(hashes), 500):
+                chunk = hashes[i:i + 500]
+                placeholders = ",".join("?" * len(chunk))
+                found.update(self._conn.execute(
+                    f"SELECT hash, entry FROM history_entries WHERE hash IN ({placeholders})", chunk
+                ).fetchall())
+        return [found[digest] for digest in hashes]
+
+    def _pack(self, value: Any) -> Any:
+        if isinstance(value, History):
+            snapshot = value.snapshot()
+            snapshot["entries"] = self._store(snapshot["entries"])
+            return {HISTORY_MARKER: snapshot}
+        if isinstance(value, dict):
+            return {key: self._pack(item) for key, item in value.items()}
+        if isinstance(value, list):
+            return [self._pack(item) for item in value]
+        if isinstance(value, tuple):
+            return tuple(self._pack(item) for item in value)
+        return value
+
+    def _unpack(self, value: Any) -> Any:
+        if isinstance(value, dict):
+            if HISTORY_MARKER in value and len(value) == 1:
+                snapshot = dict(value[HISTORY_MARKER])
+                snapshot["entries"] = self._load(snapshot["entries"])
+                return History.restored(snapshot, self.count_tokens)
+            return {key: self._unpack(item) for key, item in value.items()}
+        if isinstance(value, list):
+            return [self._unpack(item) for item in value]
+        if isinstance(value, tuple):
+            return tuple(self._unpack(item) for item in value)
+        return value
+
+    def dumps_typed(self, obj: Any):
+        return self.inner.dumps_typed(self._pack(obj))
+
+    def loads_typed(self, data) -> Any:
+        return self._unpack(self.inner.loads_typed(data))
+
+
+def clear_thread(path: str, thread_id: str):
+    """
+    Deletes the checkpoints of `thread_id`, the next run of the thread starts from START.
+    The history entries go with the last checkpoint of the workspace.
+    """
+    if not os.path.exists(path):
+        return
+    conn = sqlite3.connect(path, timeout=30)
+    try:
+        for table in ("checkpoints", "writes"):
+            try:
+                conn.execute(f"DELETE FROM {table} WHERE thread_id = ?", (thread_id,))
+            except sqlite3.OperationalError:
+                pass  # no checkpoint written yet
+        try:
+            if conn.execute("SELECT 1 FROM checkpoints LIMIT 1").fetchone() is None:
+                conn.execute("DELETE FROM history_entries")
+        except sqlite3.OperationalError:
+            pass
+        conn.commit()
+    finally:
+        conn.close()
+
+
+@contextmanager
+def open_checkpointer(path: str, count_tokens: Optional[TokenCounter] = None):
+    serde = HistorySerializer(path, count_tokens)
+    conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+    try:
+        conn.execute("PRAGMA journal_mode=WAL")
+        yield SqliteSaver(conn, serde=serde)
+    finally:
+        conn.close()
+        serde.close()
+
+
+@asynccontextmanager
+async def aopen_checkpointer(path: str, count_tokens: Optional[TokenCounter] = None):
+    import aiosqlite
+    from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
+
+    serde = HistorySerializer(path, count_tokens)
+    try:
+        async with aiosqlite.connect(path, timeout=30) as conn:
+            await conn.execute("PRAGMA journal_mode=WAL")
+            yield AsyncSqliteSaver(conn, serde=serde)
+    finally:
+        serde.close()
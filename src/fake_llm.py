@@ -0,0 +1,106 @@
+# fake_llm.py
+
+import re
+import json
+import time
+import asyncio
+from typing import Any, AsyncIterator, Iterator, List, Optional
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from pydantic import PrivateAttr
+
+# Characters per streamed token
+TOKEN_CHARS = 4
+
+
+class FakeLLM(BaseChatModel):
+    """
+    Local stand-in for ChatOpenAI/ChatOllama, for benchmarks. It waits `latency`
+    seconds, then produces its answer at `tokens_per_second` (0: all at once).
+
+    Answers are canned JSON picked from the prompts WorkFlow.py builds:
+    condition prompts get {"switch": ...}, True `loop_iterations` times and then
+    False once, so condition loops end; tool prompts call the offered tool
+    without arguments; any other prompt gets a reply of `completion_chars` characters.
+    """
+
+    latency: float = 0.0
+    tokens_per_second: float = 0.0
+    completion_chars: int = 200
+    loop_iterations: int = 0
+    temperature: float = 0.0
+    model_name: str = "fake"
+
+    _condition_calls: int = PrivateAttr(default=0)
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake"
+
+    def answer(self, messages: List[BaseMessage]) -> str:
+        prompt = "\n".join(str(message.content) for message in messages)
+        if '"switch"' in prompt:
+            self._condition_calls += 1
+            switch = self._condition_calls % (self.loop_iterations + 1) != 0
+            return json.dumps({"switch": switch})
+        if '"function"' in prompt:
+            match = re.search(r"Available tool: (\w+)\(", prompt)
+            return json.dumps({"function": match.group(1) if match else "", "args": []})
+        return json.dumps({"reply": "x" * self.completion_chars})
+
+    def _tokens(self, text: str) -> List[str]:
+        return [text[i:i + TOKEN_CHARS] for i in range(0, len(text), TOKEN_CHARS)]
+
+    def _token_delay(self) -> float:
+        return 1 / self.tokens_per_second if self.tokens_per_second > 0 else 0.0
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager=None, **kwargs: Any) -> ChatResult:
+        text = self.answer(messages)
+        time.sleep(self.latency + self._token_delay() * len(self._tokens(text)))
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=text))])
+
+    async def _agenerate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager=None, **kwargs: Any) -> ChatResult:
+        text = self.answer(messages)
+        await asyncio.sleep(self.latency + self._token_delay() * len(self._tokens(text)))
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=text))])
+
+    def _stream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager=None, **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        text = self.answer(messages)
+        time.sleep(self.latency)
+        for token in self._tokens(text):
+            if self._token_delay():
+                time.sleep(self._token_delay())
+            if run_manager:
+                run_manager.on_llm_new_token(token)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=token))
+
+    async def _astream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager=None, **kwargs: Any) -> AsyncIterator[ChatGenerationChunk]:
+        text = self.answer(messages)
+        await asyncio.sleep(self.latency)
+        for token in self._tokens(text):
+            if self._token_delay():
+                await asyncio.sleep(self._token_delay())
+            if run_manager:
+                await run_manager.on_llm_new_token(token)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=token))
+
+
+def fake_llm_from_spec(spec: str) -> FakeLLM:
+    """
+    FakeLLM for an llm_model like "fake" or "fake:latency=0.2,tps=50,chars=400,loops=3".
+    """
+    options = {}
+    _, _, params = spec.partition(":")
+    for pair in filter(None, params.split(",")):
+        key, _, value = pair.partition("=")
+        options[key.strip()] = value.strip()
+
+    return FakeLLM(
+        latency=float(options.get("latency", 0)),
+        tokens_per_second=float(options.get("tps", 0)),
+        completion_chars=int(options.get("chars", 200)),
+        loop_iterations=int(options.get("loops", 0)),
+        model_name=spec,
+    )
@@ -0,0 +1,54 @@
+# graph_cache.py
+
+import os
+import json
+import hashlib
+from collections import OrderedDict
+from threading import Lock
+from typing import Any, Optional
+
+
+def graph_cache_key(raw_graph: bytes, llm_config: Any) -> str:
+    """
+    Hashes the graph.json content together with the LLM configuration,
+    since the compiled graphs hold on to the LLM they were built with.
+    """
+    digest = hashlib.sha256()
+    digest.update(raw_graph)
+    digest.update(b"\0")
+    digest.update(json.dumps(llm_config, sort_keys=True, default=str).encode())
+    return digest.hexdigest()
+
+
+class GraphCache:
+    """
+    Least recently used cache of compiled workflows, holding at most `max_size` entries.
+    """
+
+    def __init__(self, max_size: Optional[int] = None):
+        self.max_size = max_size if max_size is not None else int(os.environ.get("GRAPH_CACHE_SIZE", 16))
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key: str) -> Any:
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def put(self, key: str, value: Any):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
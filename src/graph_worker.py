@@ -0,0 +1,89 @@
+# graph_worker.py
+
+import os
+import sys
+import json
+import asyncio
+import traceback
+
+# Heavy imports happen once here, when the pool starts the worker,
+# instead of once per run like run_graph.py
+import llm
+from llm import get_llm, get_response_cache
+from cassette import Cassette
+from util import flush_print
+from WorkFlow import run_workflow_as_server, arun_workflow_as_server, reset_workflow_state
+from worker_pool import JOB_DONE
+
+# Run workflows with ainvoke/astream instead of blocking invoke
+USE_ASYNC = os.environ.get("WORKFLOW_ASYNC", "0") == "1"
+
+# Server default, a job may turn token streaming on or off for its run
+STREAM_TOKENS = llm.stream_tokens
+
+# One loop for the worker's lifetime, async LLM clients stay bound to it between jobs
+event_loop = asyncio.new_event_loop() if USE_ASYNC else None
+
+
+def run_job(job: dict) -> int:
+    """
+    Runs one workflow job inside the job's workspace and returns an exit code
+    matching what `python run_graph.py` would have returned.
+    """
+    home = os.getcwd()
+    try:
+        os.chdir(job["cwd"])
+        response_cache = get_response_cache()
+        if response_cache is not None:
+            response_cache.bypass = bool(job.get("no_cache"))
+            response_cache.reset_stats()
+
+        llm.stream_tokens = bool(job.get("stream_tokens", STREAM_TOKENS))
+        llm.cassette = Cassette.from_options(job.get("cassette"), job["cwd"], job.get("run_id"))
+
+        llm_instance = get_llm(job.get("llm_model", ""), job.get("api_key", ""))
+        llm_config = [job.get("llm_model", ""), job.get("api_key", "")]
+        max_concurrency = job.get("max_concurrency")
+        resume = bool(job.get("resume"))
+        if USE_ASYNC:
+            event_loop.run_until_complete(arun_workflow_as_server(llm_instance, llm_config, max_concurrency, resume))
+        else:
+            run_workflow_as_server(llm_instance, llm_config, max_concurrency, resume)
+
+        if response_cache is not None and not response_cache.bypass:
+            stats = response_cache.stats()
+            flush_print(f"LLM cache: {stats['hits']} hits, {stats['misses']} misses")
+        if llm.cassette is not None and llm.cassette.replay_path is not None:
+            flush_print(f"Cassette: {llm.cassette.replayed} answers replayed")
+        return 0
+    except Exception:
+        traceback.print_exc()
+        return 1
+    finally:
+        # Forget tools and subgraphs of this job so the next one starts clean,
+        # the compiled graphs themselves stay in the graph cache
+        reset_workflow_state()
+        if llm.cassette is not None:
+            llm.cassette.close()
+            llm.cassette = None
+        os.chdir(home)
+
+
+def main():
+    while True:
+        line = sys.stdin.readline()
+        if not line:
+            break  # pool closed our stdin
+        if not line.strip():
+            continue
+
+        returncode = run_job(json.loads(line))
+
+        # Marks the end of the job's stderr for the pool, then of its stdout;
+        # start on fresh lines in case the job left partial ones behind
+        print(f"\n{JOB_DONE}", file=sys.stderr, flush=True)
+        print(f"\n{JOB_DONE} {returncode}", flush=True)
+
+
+if __name__ == "__main__":
+    main()
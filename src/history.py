@@ -0,0 +1,228 @@
+# history.py
+
+from collections import deque
+from typing import Callable, Iterable, List, Optional, Tuple, Union
+
+from tokenizer import TokenCounter, approximate_tokens
+
+# Same budget clip_history used to apply to the whole history string
+DEFAULT_MAX_CHARS = 16000
+
+
+class History:
+    """
+    Bounded ring of history entries shared by the nodes of a workflow.
+
+    A History is never changed in place: `appended` returns a new History
+    that shares the entry strings with this one, evicts whole entries from
+    the front once the rendered size passes `max_chars` or the entries pass
+    `max_tokens`, and derives its rendering from the cached rendering of this one.
+    Rendered, every entry is preceded by a newline, exactly like the old
+    `history += "\\n" + entry` strings, so `{history}` prompts look the same.
+    """
+
+    def __init__(
+        self,
+        entries: Iterable[str] = (),
+        max_chars: Optional[int] = DEFAULT_MAX_CHARS,
+        max_tokens: Optional[int] = None,
+        count_tokens: Optional[TokenCounter] = None
+    ):
+        self.max_chars = max_chars
+        self.max_tokens = max_tokens
+        self.count_tokens = count_tokens or approximate_tokens
+        self._entries = deque()
+        # Token count of every entry, counted once when it is appended
+        self._entry_tokens = deque()
+        self._size = 0
+        self._tokens = 0
+        # Entries ever appended, including evicted ones, to tell what a subgraph added
+        self._seq = 0
+        self._rendered: Optional[str] = None
+        # (seq, text): summary of every entry up to seq, see fit
+        self._summary: Optional[Tuple[int, str]] = None
+        self._push(entries)
+
+    @property
+    def seq(self) -> int:
+        return self._seq
+
+    @property
+    def size(self) -> int:
+        """Length of the rendered history."""
+        return self._size
+
+    @property
+    def tokens(self) -> int:
+        return self._tokens
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __iter__(self):
+        return iter(self._entries)
+
+    def __str__(self):
+        return self.render()
+
+    def __repr__(self):
+        return f"History(entries={len(self._entries)}, size={self._size}, tokens={self._tokens})"
+
+    def _over_budget(self) -> bool:
+        return ((self.max_chars is not None and self._size > self.max_chars)
+                or (self.max_tokens is not None and self._tokens > self.max_tokens))
+
+    def _push(self, entries: Iterable[str]) -> int:
+        """Appends entries and evicts old ones, returns how many rendered chars were evicted."""
+        for entry in entries:
+            entry = str(entry)
+            tokens = self.count_tokens(entry)
+            self._entries.append(entry)
+            self._entry_tokens.append(tokens)
+            self._size += len(entry) + 1
+            self._tokens += tokens
+            self._seq += 1
+
+        evicted = 0
+        while self._over_budget() and len(self._entries) > 1:
+            entry = self._entries.popleft()
+            self._tokens -= self._entry_tokens.popleft()
+            self._size -= len(entry) + 1
+            evicted += len(entry) + 1
+
+        if self._over_budget():
+            # A single entry bigger than the whole budget, keep its tail
+            entry = self._entries.pop()
+            tokens = self._entry_tokens.pop()
+            keep = len(entry)
+            if self.max_chars is not None:
+                keep = min(keep, self.max_chars - 1)
+            if self.max_tokens is not None and tokens > self.max_tokens:
+                keep = min(keep, len(entry) * self.max_tokens // tokens)
+            entry = entry[len(entry) - max(keep, 0):]
+            self._entries.append(entry)
+            self._entry_tokens.append(self.count_tokens(entry))
+            evicted += self._size - (len(entry) + 1)
+            self._size = len(entry) + 1
+            self._tokens = self._entry_tokens[0]
+        return evicted
+
+    def appended(self, entries: Union[str, Iterable[str]]) -> "History":
+        if isinstance(entries, str):
+            entries = [entries]
+        entries = list(entries)
+        if not entries:
+            return self
+
+        history = History.__new__(History)
+        history.max_chars = self.max_chars
+        history.max_tokens = self.max_tokens
+        history.count_tokens = self.count_tokens
+        history._entries = deque(self._entries)
+        history._entry_tokens = deque(self._entry_tokens)
+        history._size = self._size
+        history._tokens = self._tokens
+        history._seq = self._seq
+        history._summary = self._summary
+        evicted = history._push(entries)
+
+        if self._rendered is not None and len(entries) < len(history._entries):
+            # Reuse what is still visible of the old rendering
+            history._rendered = self._rendered[evicted:] + "".join("\n" + entry for entry in entries)
+        else:
+            history._rendered = None
+        return history
+
+    def snapshot(self) -> dict:
+        """Everything but the token counter, for restored."""
+        return {
+            "entries": list(self._entries),
+            "entry_tokens": list(self._entry_tokens),
+            "seq": self._seq,
+            "max_chars": self.max_chars,
+            "max_tokens": self.max_tokens,
+        }
+
+    @classmethod
+    def restored(cls, snapshot: dict, count_tokens: Optional[TokenCounter] = None) -> "History":
+        """History saved with snapshot, the entries are not counted or evicted again."""
+        history = cls.__new__(cls)
+        history.max_chars = snapshot["max_chars"]
+        history.max_tokens = snapshot["max_tokens"]
+        history.count_tokens = count_tokens or approximate_tokens
+        history._entries = deque(snapshot["entries"])
+        history._entry_tokens = deque(snapshot["entry_tokens"])
+        history._size = sum(len(entry) + 1 for entry in history._entries)
+        history._tokens = sum(history._entry_tokens)
+        history._seq = snapshot["seq"]
+        history._rendered = None
+        history._summary = None
+        return history
+
+    def entries_since(self, seq: int) -> List[str]:
+        """Entries appended after this history had `seq` entries, as far as they were not evicted."""
+        count = self._seq - seq
+        if count <= 0:
+            return []
+        return list(self._entries)[-count:]
+
+    def render(self) -> str:
+        if self._rendered is None:
+            self._rendered = "".join("\n" + entry for entry in self._entries)
+        return self._rendered
+
+    def fit(self, budget: Optional[int], summarize: Optional[Callable[[str], str]] = None) -> str:
+        """
+        Renders the history for a prompt of at most `budget` tokens.
+
+        Without `summarize` (or while the history fits) this is just render().
+        Otherwise the older entries are replaced by a summary and only the
+        newest entries, about half of the budget, are rendered as they are.
+        The summary is remembered and handed on to appended histories, so the
+        LLM is asked again only once the newer entries outgrow the budget.
+        """
+        if summarize is None or budget is None or self._tokens <= budget:
+            return self.render()
+
+        first_seq = self._seq - len(self._entries) + 1
+        entries = list(self._entries)
+        entry_tokens = list(self._entry_tokens)
+
+        def split(boundary_seq: int) -> int:
+            # Index of the first entry after boundary_seq
+            return max(0, min(len(entries), boundary_seq - first_seq + 1))
+
+        if self._summary is not None:
+            boundary, summary = self._summary
+            start = split(boundary)
+            tokens = self.count_tokens(summary) + sum(entry_tokens[start:])
+            if tokens <= budget:
+                return "\n" + summary + "".join("\n" + entry for entry in entries[start:])
+        else:
+            boundary, summary = first_seq - 1, ""
+
+        # Keep the newest entries that fit in half of the budget
+        start = len(entries)
+        kept = 0
+        while start > 0 and kept + entry_tokens[start - 1] <= budget // 2:
+            start -= 1
+            kept += entry_tokens[start]
+
+        older = entries[split(boundary):start]
+        summary = summarize("\n".join(([summary] if summary else []) + older))
+        self._summary = (first_seq + start - 1, summary)
+        return "\n" + summary + "".join("\n" + entry for entry in entries[start:])
+
+
+def merge_history(history: History, update: Union[History, str, List[str], None]) -> History:
+    """
+    Reducer of the history channel. A History replaces the current one,
+    a string or a list of strings is appended as entries.
+    """
+    if isinstance(update, History):
+        return update
+    if update is None:
+        return history
+    if history is None:
+        history = History()
+    return history.appended(update)
@@ -2,15 +2,40 @@
 
 import os
 import json
+import time
+import asyncio
+import hashlib
 import requests
-from typing import Optional
+from collections import OrderedDict
+from threading import Lock
+from typing import Any, Dict, Optional
 
 from pydantic import BaseModel, Field
 
 from langchain_core.prompts import PromptTemplate
 from langchain_core.output_parsers import StrOutputParser
 
-from util import flush_print
+from util import flush_print, emit_event
+from llm_cache import LLMResponseCache, llm_fingerprint, response_cache_key
+from tokenizer import TokenCounter, get_tokenizer
+from history import History
+from tracing import span
+from cassette import Cassette
+
+
+# Cache of temperature 0 generations, opened on first use
+_response_cache: Optional[LLMResponseCache] = None
+
+def get_response_cache() -> Optional[LLMResponseCache]:
+    """
+    Returns the shared LLM response cache, or None when LLM_CACHE=0.
+    """
+    global _response_cache
+    if os.environ.get("LLM_CACHE", "1") == "0":
+        return None
+    if _response_cache is None:
+        _response_cache = LLMResponseCache()
+    return _response_cache
 
 
 # Clip the history for limited token
@@ -19,25 +44,176 @@ def clip_history(history: str, max_chars: int = 16000) -> str:
         return history[-max_chars:]
     return history
 
+# Forward partial generations to the run stream as "token" events while the LLM generates
+stream_tokens = os.environ.get("LLM_STREAM_TOKENS", "1") == "1"
+
+# Cassette the LLM calls of the current run are recorded to and replayed from, if any
+cassette: Optional[Cassette] = None
+
+
+# Tokens of history a prompt may carry, by model name (HISTORY_TOKEN_BUDGET overrides)
+HISTORY_TOKEN_BUDGETS = {
+    "gpt-4o-mini": 16000,
+    "gemma2": 4000,
+}
+DEFAULT_HISTORY_TOKEN_BUDGET = 4000
+
+# With HISTORY_SUMMARIZE=1 the history keeps this many budgets worth of
+# entries, the prompt shows a summary of what does not fit in one budget
+SUMMARIZE_KEEP_FACTOR = 4
+
+
+def llm_model_name(llm) -> str:
+    # get_llm returns ChatOpenAI bound to a response format, look through the binding
+    model = getattr(llm, "bound", llm)
+    return getattr(model, "model_name", None) or getattr(model, "model", None) or ""
+
+def get_history_budget(llm) -> int:
+    if os.environ.get("HISTORY_TOKEN_BUDGET"):
+        return int(os.environ["HISTORY_TOKEN_BUDGET"])
+    model = llm_model_name(llm).lower()
+    for name, budget in HISTORY_TOKEN_BUDGETS.items():
+        if name in model:
+            return budget
+    return DEFAULT_HISTORY_TOKEN_BUDGET
+
+def get_history_tokenizer(llm) -> TokenCounter:
+    return get_tokenizer(llm_model_name(llm))
+
+def summarize_enabled() -> bool:
+    return os.environ.get("HISTORY_SUMMARIZE", "0") == "1"
+
+def new_history(llm) -> History:
+    """
+    Empty history clipped to the token budget of `llm`. In summarize mode it
+    keeps more than the budget, history_prompt summarizes what does not fit.
+    """
+    budget = get_history_budget(llm)
+    if summarize_enabled():
+        budget *= SUMMARIZE_KEEP_FACTOR
+    return History(max_chars=None, max_tokens=budget, count_tokens=get_history_tokenizer(llm))
+
+def summarize_history(text: str, llm) -> str:
+    template = """
+    history: {history}
+    Summarize the history above, keep every fact, decision and tool result later steps may need.
+    you reply in the json format: "summary": "<summary>"
+    """
+    generation = create_llm_chain(template, llm, text, "history summary")
+    try:
+        summary = json.loads(generation).get("summary", "")
+    except (ValueError, AttributeError):
+        summary = generation
+    return f"Summary of earlier history: {summary}"
+
+def history_prompt(history: History, llm) -> str:
+    """
+    Renders `history` for a prompt of `llm`, within its token budget.
+    """
+    summarize = (lambda text: summarize_history(text, llm)) if summarize_enabled() else None
+    return history.fit(get_history_budget(llm), summarize)
+
+async def ahistory_prompt(history: History, llm) -> str:
+    if summarize_enabled() and history.tokens > get_history_budget(llm):
+        # Summarizing calls the LLM, keep it off the event loop
+        return await asyncio.to_thread(history_prompt, history, llm)
+    return history_prompt(history, llm)
+
+
+# Clients built by get_llm, reused with their open connections (LLM_CLIENT_CACHE_SIZE)
+_llm_clients: "OrderedDict[tuple, Any]" = OrderedDict()
+_llm_clients_lock = Lock()
+
+def llm_client_key(model: str, base_url: str, api_key: Optional[str]) -> tuple:
+    # Only a digest of the key is kept around as a dict key
+    key_digest = hashlib.sha256(api_key.encode()).hexdigest() if api_key else ""
+    return (model, base_url, key_digest)
+
+def http_pool_limits():
+    import httpx
+    return httpx.Limits(
+        max_connections=int(os.environ.get("LLM_POOL_MAX_CONNECTIONS", 20)),
+        max_keepalive_connections=int(os.environ.get("LLM_POOL_MAX_KEEPALIVE", 10)),
+        keepalive_expiry=float(os.environ.get("LLM_POOL_KEEPALIVE_EXPIRY", 60)),
+    )
+
+def http_timeout():
+    import httpx
+    # Generations take long, connecting should not
+    return httpx.Timeout(
+        float(os.environ.get("LLM_TIMEOUT", 120)),
+        connect=float(os.environ.get("LLM_CONNECT_TIMEOUT", 10)),
+    )
+
+def create_openai_client(model: str, api_key: str):
+    import httpx
+    from langchain_openai import ChatOpenAI
+    limits, timeout = http_pool_limits(), http_timeout()
+    # The key belongs to this client, os.environ is shared by every run of the process;
+    # without one the client falls back to OPENAI_API_KEY
+    return ChatOpenAI(
+        temperature=0,
+        model=model,
+        api_key=api_key or None,
+        timeout=timeout,
+        max_retries=int(os.environ.get("LLM_MAX_RETRIES", 2)),
+        http_client=httpx.Client(limits=limits, timeout=timeout),
+        http_async_client=httpx.AsyncClient(limits=limits, timeout=timeout),
+    ).bind(response_format={"type": "json_object"})
+
+def create_ollama_client(model: str, base_url: str):
+    from langchain_ollama import ChatOllama
+    return ChatOllama(
+        model=model,
+        base_url=base_url,
+        format="json",
+        temperature=0,
+        # Handed on to the httpx clients of the ollama library
+        client_kwargs={"limits": http_pool_limits(), "timeout": http_timeout()},
+    )
+
+def cached_llm_client(key: tuple, create):
+    """
+    Returns the client cached under `key`, creating it with `create()` on a miss.
+    """
+    with _llm_clients_lock:
+        client = _llm_clients.get(key)
+        if client is not None:
+            _llm_clients.move_to_end(key)
+            return client
+
+    client = create()
+    with _llm_clients_lock:
+        # Another thread may have created it meanwhile, keep the first one
+        client = _llm_clients.setdefault(key, client)
+        _llm_clients.move_to_end(key)
+        while len(_llm_clients) > int(os.environ.get("LLM_CLIENT_CACHE_SIZE", 32)):
+            _llm_clients.popitem(last=False)
+    return client
+
 def get_llm(llm_model, api_key):
 
+    # Local stand-in for benchmarks, see fake_llm.py
+    if llm_model.lower().startswith("fake"):
+        from fake_llm import fake_llm_from_spec
+        key = llm_client_key(llm_model, "fake", None)
+        llm = cached_llm_client(key, lambda: fake_llm_from_spec(llm_model))
+        flush_print(f"Using {llm_model}")
+        return llm
+
     if "gpt" in llm_model.lower():  # If the llm contains 'gpt', use ChatOpenAI
-        from langchain_community.chat_models import ChatOpenAI
-        os.environ["OPENAI_API_KEY"] = api_key
-        llm = ChatOpenAI(temperature=0, model="gpt-4o-mini").bind(response_format={"type": "json_object"})
+        model = "gpt-4o-mini"
+        key = llm_client_key(model, "openai", api_key)
+        llm = cached_llm_client(key, lambda: create_openai_client(model, api_key))
         flush_print("Using gpt-4o-mini")
 
         return llm
 
 
     if "gemma2" in llm_model.lower():
-        from langchain_ollama import ChatOllama
         ollama_base_url = os.environ.get("OLLAMA_BASE_URL", "http://ollama:11434")  # Default value if envvar is not set
-        llm = ChatOllama(
-            model="gemma2",
-            base_url=ollama_base_url,
-            format="json",
-            temperature=0)
+        key = llm_client_key("gemma2", ollama_base_url, None)
+        llm = cached_llm_client(key, lambda: create_ollama_client("gemma2", ollama_base_url))
 
         flush_print("Using gemma2")
         return llm
@@ -50,14 +226,20 @@ def get_llm(llm_model, api_key):
     flush_print("no suport LLM")
 
 
-def ChatBot(llm, question):
-    # Define the prompt template
-    template = """
+CHATBOT_TEMPLATE = """
         {question}
         you reply json in {{ reply:"<content>" }}
     """
 
-    prompt = PromptTemplate.from_template(clip_history(template))
+def ChatBot(llm, question, cassette: Optional[Cassette] = None):
+    # A replayed cassette answers without the LLM
+    reply = cassette.play("chatbot", question) if cassette is not None else None
+    if reply is not None:
+        cassette.record("chatbot", question, reply)
+        return reply
+
+    # Define the prompt template
+    prompt = PromptTemplate.from_template(clip_history(CHATBOT_TEMPLATE))
 
     # Format the prompt with the input variable
     formatted_prompt = prompt.format(question=question)
@@ -68,18 +250,163 @@ def ChatBot(llm, question):
     data = json.loads(generation)
     reply = data.get("reply", "")
 
+    if cassette is not None:
+        cassette.record("chatbot", question, reply)
     return reply
 
 
-def create_llm_chain(prompt_template: str, llm, history: str) -> str:
+# Chatbot questions being answered, by (client, question), see AChatBot
+_chatbot_inflight: Dict[tuple, "asyncio.Task"] = {}
+# Bounds the chatbot calls per model (CHATBOT_MAX_CONCURRENCY)
+_chatbot_semaphores: Dict[str, asyncio.Semaphore] = {}
+
+def chatbot_semaphore(llm) -> asyncio.Semaphore:
+    model = llm_model_name(llm)
+    if model not in _chatbot_semaphores:
+        _chatbot_semaphores[model] = asyncio.Semaphore(int(os.environ.get("CHATBOT_MAX_CONCURRENCY", 4)))
+    return _chatbot_semaphores[model]
+
+async def _achatbot_call(llm, question):
+    prompt = PromptTemplate.from_template(clip_history(CHATBOT_TEMPLATE))
+    llm_chain = prompt | llm | StrOutputParser()
+    async with chatbot_semaphore(llm):
+        generation = await llm_chain.ainvoke({"question": question})
+
+    data = json.loads(generation)
+    return data.get("reply", "")
+
+async def AChatBot(llm, question, cassette: Optional[Cassette] = None):
+    """
+    Async ChatBot for the server. While a question is being answered, asking
+    the same client (same model, base URL and API key) the same question
+    waits for that answer instead of calling the LLM again.
+    """
+    if cassette is not None:
+        reply = cassette.play("chatbot", question)
+        if reply is None:
+            reply = await AChatBot(llm, question)
+        cassette.record("chatbot", question, reply)
+        return reply
+
+    key = (id(llm), question)
+    task = _chatbot_inflight.get(key)
+    if task is None:
+        task = asyncio.create_task(_achatbot_call(llm, question))
+        _chatbot_inflight[key] = task
+        task.add_done_callback(lambda _: _chatbot_inflight.pop(key, None))
+    # A client that goes away must not cancel the answer for the others waiting on it
+    return await asyncio.shield(task)
+
+
+def cached_generation_key(llm, rendered_prompt: str) -> Optional[str]:
+    fingerprint = llm_fingerprint(llm)
+    if fingerprint is None or get_response_cache() is None:
+        return None
+    return response_cache_key(fingerprint, rendered_prompt)
+
+
+def stored_generation(llm, name: str, rendered_prompt: str, trace: dict):
+    """
+    Answer to the prompt from the replayed cassette or the response cache, as
+    (generation, None). (None, cache key) when the LLM has to answer.
+    """
+    if cassette is not None:
+        generation = cassette.play(name, rendered_prompt)
+        if generation is not None:
+            trace.update(cached=True, source="cassette", completion_chars=len(generation))
+            cassette.record(name, rendered_prompt, generation)
+            return generation, None
+
+    cache_key = cached_generation_key(llm, rendered_prompt)
+    if cache_key:
+        generation = get_response_cache().get(cache_key)
+        if generation is not None:
+            trace.update(cached=True, source="cache", completion_chars=len(generation))
+            if cassette is not None:
+                cassette.record(name, rendered_prompt, generation)
+            return generation, None
+    return None, cache_key
+
+def store_generation(name: str, rendered_prompt: str, generation: str, cache_key: Optional[str]):
+    if cache_key:
+        get_response_cache().put(cache_key, generation)
+    if cassette is not None:
+        cassette.record(name, rendered_prompt, generation)
+
+
+def discard_generation(prompt_template: str, llm, history: str):
+    """
+    Drops the cached answer to the prompt, e.g. one the node could not use,
+    so it is asked again instead of answered from the cache next time.
+    """
+    rendered_prompt = PromptTemplate.from_template(prompt_template).invoke({"history": history}).to_string()
+    cache_key = cached_generation_key(llm, rendered_prompt)
+    if cache_key:
+        get_response_cache().discard(cache_key)
+
+
+def create_llm_chain(prompt_template: str, llm, history: str, name: str = "") -> str:
     """
     Creates and invokes an LLM chain using the prompt template and the history.
+    Deterministic LLMs answer from the response cache when they saw the same prompt before.
+    `name` is the node asking, it tags the streamed tokens.
+    """
+    prompt = PromptTemplate.from_template(prompt_template)
+    inputs = {"history": history}
+    prompt_value = prompt.invoke(inputs)
+
+    rendered_prompt = prompt_value.to_string()
+    with span("llm", name, model=llm_model_name(llm), prompt_chars=len(rendered_prompt)) as trace:
+        generation, cache_key = stored_generation(llm, name, rendered_prompt, trace)
+        if generation is not None:
+            return generation
+
+        start = time.perf_counter()
+        llm_chain = llm | StrOutputParser()
+        if stream_tokens:
+            chunks = []
+            for chunk in llm_chain.stream(prompt_value):
+                if not chunks:
+                    trace["first_token_ms"] = round((time.perf_counter() - start) * 1000, 3)
+                chunks.append(chunk)
+                emit_event("token", {"node": name, "text": chunk})
+            generation = "".join(chunks)
+        else:
+            generation = llm_chain.invoke(prompt_value)
+        trace.update(cached=False, completion_chars=len(generation))
+
+    store_generation(name, rendered_prompt, generation, cache_key)
+    return generation
+
+async def acreate_llm_chain(prompt_template: str, llm, history: str, name: str = "") -> str:
+    """
+    Same as create_llm_chain, but awaits the LLM with ainvoke/astream.
     """
     prompt = PromptTemplate.from_template(prompt_template)
-    llm_chain = prompt | llm | StrOutputParser()
     inputs = {"history": history}
-    generation = llm_chain.invoke(inputs)
+    prompt_value = prompt.invoke(inputs)
+
+    rendered_prompt = prompt_value.to_string()
+    with span("llm", name, model=llm_model_name(llm), prompt_chars=len(rendered_prompt)) as trace:
+        generation, cache_key = stored_generation(llm, name, rendered_prompt, trace)
+        if generation is not None:
+            return generation
+
+        start = time.perf_counter()
+        llm_chain = llm | StrOutputParser()
+        if stream_tokens:
+            chunks = []
+            async for chunk in llm_chain.astream(prompt_value):
+                if not chunks:
+                    trace["first_token_ms"] = round((time.perf_counter() - start) * 1000, 3)
+                chunks.append(chunk)
+                emit_event("token", {"node": name, "text": chunk})
+            generation = "".join(chunks)
+        else:
+            generation = await llm_chain.ainvoke(prompt_value)
+        trace.update(cached=False, completion_chars=len(generation))
 
+    store_generation(name, rendered_prompt, generation, cache_key)
     return generation
 
 def create_llm_chain_google(prompt_template: str, llm, history: Optional[str] = None) -> str:
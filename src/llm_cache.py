@@ -0,0 +1,131 @@
+# llm_cache.py
+
+import os
+import json
+import time
+import sqlite3
+import hashlib
+from threading import Lock
+from typing import Any, Dict, Optional
+
+# Next to the sources, graph workers chdir into workspaces between jobs
+DEFAULT_CACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache", "llm_cache.sqlite")
+
+# The cache may grow this many entries past max_entries before eviction runs
+EVICT_EVERY = 32
+
+
+def llm_fingerprint(llm) -> Optional[Dict[str, Any]]:
+    """
+    Describes everything about `llm` that changes its answer to a prompt.
+    Returns None when the LLM is not deterministic (temperature other than 0),
+    such answers must not be cached.
+    """
+    # get_llm returns ChatOpenAI bound to a response format, look through the binding
+    bound_kwargs = getattr(llm, "kwargs", None) or {}
+    model = getattr(llm, "bound", llm)
+
+    if getattr(model, "temperature", None) != 0:
+        return None
+
+    return {
+        "class": type(model).__name__,
+        "model": getattr(model, "model_name", None) or getattr(model, "model", None),
+        "base_url": getattr(model, "base_url", None) or getattr(model, "openai_api_base", None),
+        "format": getattr(model, "format", None),
+        "model_kwargs": getattr(model, "model_kwargs", None),
+        "bound_kwargs": bound_kwargs,
+    }
+
+
+def response_cache_key(fingerprint: Dict[str, Any], rendered_prompt: str) -> str:
+    payload = json.dumps([fingerprint, rendered_prompt], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class LLMResponseCache:
+    """
+    On-disk cache of LLM generations keyed by response_cache_key. Backed by
+    SQLite with memory-mapped reads; entries expire after `ttl` seconds and the
+    least recently used ones are evicted past `max_entries`.
+    """
+
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        ttl: Optional[float] = None,
+        max_entries: Optional[int] = None,
+        mmap_size: Optional[int] = None
+    ):
+        self.path = path or os.environ.get("LLM_CACHE_PATH", DEFAULT_CACHE_PATH)
+        self.ttl = ttl if ttl is not None else float(os.environ.get("LLM_CACHE_TTL", 7 * 24 * 3600))
+        self.max_entries = max_entries if max_entries is not None else int(os.environ.get("LLM_CACHE_MAX_ENTRIES", 10000))
+        mmap_size = mmap_size if mmap_size is not None else int(os.environ.get("LLM_CACHE_MMAP_MB", 64)) * 1024 * 1024
+
+        # Skip the cache for the current run, generations are neither read nor stored
+        self.bypass = False
+        self.hits = 0
+        self.misses = 0
+        self._puts = 0
+
+        if self.path != ":memory:":
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._lock = Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(f"PRAGMA mmap_size={mmap_size}")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, generation TEXT NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+
+    def get(self, key: str) -> Optional[str]:
+        if self.bypass:
+            return None
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT generation, created FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or (self.ttl > 0 and now - row[1] > self.ttl):
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+            self.hits += 1
+            return row[0]
+
+    def put(self, key: str, generation: str):
+        if self.bypass:
+            return
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, generation, created, accessed) VALUES (?, ?, ?, ?)",
+                (key, generation, now, now)
+            )
+            # Evicting scans the table, do it every few writes instead of every write
+            self._puts += 1
+            if self._puts % EVICT_EVERY == 0:
+                self._evict(now)
+
+    def discard(self, key: str):
+        with self._lock:
+            self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+
+    def _evict(self, now: float):
+        if self.ttl > 0:
+            self._conn.execute("DELETE FROM responses WHERE created < ?", (now - self.ttl,))
+        if self.max_entries > 0:
+            self._conn.execute(
+                "DELETE FROM responses WHERE key IN ("
+                "SELECT key FROM responses ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)
+            )
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses}
@@ -0,0 +1,166 @@
+# metrics.py
+
+import os
+import json
+import time
+import tempfile
+from bisect import bisect_left
+from typing import Any, Dict, List, Optional, Tuple
+
+from run_log import RUN_LOG_DIR
+from run_registry import pid_alive
+
+# Every server worker keeps its own histograms and saves them here, /metrics adds them up
+METRICS_DIR = os.environ.get("METRICS_DIR", os.path.join(RUN_LOG_DIR, "metrics"))
+
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+CHARS_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144)
+RETRY_BUCKETS = (0, 1, 2, 3, 5)
+
+# name: (help, buckets, label names)
+HISTOGRAMS = {
+    "langgraph_node_duration_seconds": ("Wall time of workflow nodes", SECONDS_BUCKETS, ("node_type",)),
+    "langgraph_node_retries": ("Re-prompts of workflow nodes whose LLM output was not usable", RETRY_BUCKETS, ("node_type",)),
+    "langgraph_llm_latency_seconds": ("Time of LLM calls, cache hits included", SECONDS_BUCKETS, ("model", "cached")),
+    "langgraph_llm_first_token_seconds": ("Time until an LLM call streamed its first token", SECONDS_BUCKETS, ("model",)),
+    "langgraph_llm_prompt_chars": ("Rendered prompt size of LLM calls", CHARS_BUCKETS, ("model",)),
+    "langgraph_llm_completion_chars": ("Completion size of LLM calls", CHARS_BUCKETS, ("model",)),
+    "langgraph_json_parse_seconds": ("Time spent parsing LLM output as JSON", SECONDS_BUCKETS, ()),
+    "langgraph_tool_duration_seconds": ("Time of tool calls", SECONDS_BUCKETS, ()),
+}
+
+# Histogram values: [count per bucket (+Inf last), sum]
+Series = Dict[Tuple[str, Tuple[str, ...]], List[Any]]
+
+
+class Metrics:
+    """
+    Histograms fed by the "trace" events of the runs of this server worker.
+    """
+
+    def __init__(self, directory: Optional[str] = None, save_interval: float = 1.0):
+        self.directory = directory or METRICS_DIR
+        self.path = os.path.join(self.directory, f"{os.getpid()}.json")
+        self.series: Series = {}
+        self.save_interval = save_interval
+        self._saved = 0.0
+        self._dirty = False
+
+    def observe(self, name: str, labels: Tuple[str, ...], value: float):
+        buckets = HISTOGRAMS[name][1]
+        key = (name, labels)
+        if key not in self.series:
+            self.series[key] = [[0] * (len(buckets) + 1), 0.0]
+        counts, total = self.series[key]
+        counts[bisect_left(buckets, value)] += 1
+        self.series[key][1] = total + value
+        self._dirty = True
+
+    def observe_trace(self, trace: Dict[str, Any]):
+        kind = trace.get("kind")
+        seconds = trace.get("duration_ms", 0) / 1000
+        if kind == "node":
+            self.observe("langgraph_node_duration_seconds", (str(trace.get("node_type")),), seconds)
+            if "retries" in trace:
+                self.observe("langgraph_node_retries", (str(trace.get("node_type")),), trace["retries"])
+        elif kind == "llm":
+            model = str(trace.get("model") or "unknown")
+            self.observe("langgraph_llm_latency_seconds", (model, str(bool(trace.get("cached"))).lower()), seconds)
+            if "first_token_ms" in trace:
+                self.observe("langgraph_llm_first_token_seconds", (model,), trace["first_token_ms"] / 1000)
+            self.observe("langgraph_llm_prompt_chars", (model,), trace.get("prompt_chars", 0))
+            if "completion_chars" in trace:
+                self.observe("langgraph_llm_completion_chars", (model,), trace["completion_chars"])
+        elif kind == "parse":
+            self.observe("langgraph_json_parse_seconds", (), seconds)
+        elif kind == "tool":
+            self.observe("langgraph_tool_duration_seconds", (), seconds)
+
+    def save(self, force: bool = False):
+        """
+        Writes the histograms of this worker for /metrics of the other workers,
+        at most every save_interval seconds.
+        """
+        now = time.monotonic()
+        if not self._dirty or (not force and now - self._saved < self.save_interval):
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        data = [[name, list(labels), counts, total] for (name, labels), (counts, total) in self.series.items()]
+        with tempfile.NamedTemporaryFile("w", dir=self.directory, delete=False, suffix=".tmp") as f:
+            json.dump(data, f)
+        os.replace(f.name, self.path)
+        self._saved = now
+        self._dirty = False
+
+
+def load_all(directory: Optional[str] = None) -> Series:
+    """
+    Sum of the histograms saved by the live server workers.
+    """
+    directory = directory or METRICS_DIR
+    merged: Series = {}
+    if not os.path.isdir(directory):
+        return merged
+    for file in os.listdir(directory):
+        if not file.endswith(".json"):
+            continue
+        path = os.path.join(directory, file)
+        pid = file[:-len(".json")]
+        if pid.isdigit() and not pid_alive(int(pid)):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            continue
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            continue
+        for name, labels, counts, total in data:
+            if name not in HISTOGRAMS:
+                continue
+            key = (name, tuple(labels))
+            if key not in merged:
+                merged[key] = [[0] * len(counts), 0.0]
+            merged[key][0] = [a + b for a, b in zip(merged[key][0], counts)]
+            merged[key][1] += total
+    return merged
+
+
+def escape_label_value(value: str) -> str:
+    # Label values may come from requests (e.g. the model name), the text format escapes \, " and newlines
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{escape_label_value(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def render_prometheus(series: Series, gauges: Dict[str, Tuple[str, float]]) -> str:
+    """
+    Prometheus text format of the histograms in `series` and of `gauges` (name: (help, value)).
+    """
+    lines = []
+    for name, (help_text, buckets, label_names) in HISTOGRAMS.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} histogram")
+        for (series_name, labels), (counts, total) in sorted(series.items()):
+            if series_name != name:
+                continue
+            cumulative = 0
+            for bound, count in zip(list(buckets) + ["+Inf"], counts):
+                cumulative += count
+                le = f'le="{bound}"'
+                lines.append(f"{name}_bucket{format_labels(label_names, labels, le)} {cumulative}")
+            lines.append(f"{name}_sum{format_labels(label_names, labels)} {total}")
+            lines.append(f"{name}_count{format_labels(label_names, labels)} {cumulative}")
+
+    for name, (help_text, value) in gauges.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} gauge")
+        lines.append(f"{name} {value}")
+    return "\n".join(lines) + "\n"
@@ -1,27 +1,127 @@
 # process_handler.py
 
 import asyncio
-from asyncio import Queue as AsyncQueue
 import sys
+from typing import Optional
+
+from util import StreamEvent, parse_event
+from broadcast import Broadcaster, Subscriber, END_OF_STREAM
+from run_log import RunLog, new_run_id, replay_run_log
+from ServerTee import log_context
+
 
 class ProcessHandler:
-    def __init__(self):
+    def __init__(self, username: str = "", registry=None, scheduler=None, metrics=None):
+        self.username = username
+        self._metrics = metrics  # Metrics fed by the trace events of the run, if any
+        self._registry = registry  # RunRegistry shared with the other server workers, if any
+        self._scheduler = scheduler  # RunScheduler deciding when queued jobs may start, if any
         self._process = None
-        self._output_queue = AsyncQueue()  # Use asyncio.Queue
+        self._output = Broadcaster()  # fans the run output out to every reader
         self._is_running = False
         self._is_starting = False
         self._stream_tasks = []  # Store stream tasks
+        self._task = None  # the running job, referenced so it is not garbage collected
+        self.run_id = None  # id of the current or last run
+        self._log = None  # RunLog of the current run
 
-    async def run(self, command: list, cwd: str):
-        if self._is_running or self._is_starting:
-            await self._output_queue.put({"status": "error", "message": "Process already running"})
-            return
+    def is_busy(self) -> bool:
+        return self._is_running or self._is_starting
+
+    async def _claim(self):
+        # Reserved before the first await, so two requests cannot both pass it
+        if self.is_busy():
+            raise RuntimeError("Process already running")
+        self._is_starting = True
+        run_id = new_run_id()
+        # The user may be running on another server worker
+        if self._registry is not None:
+            try:
+                if self._scheduler is not None:
+                    claimed = await asyncio.to_thread(
+                        self._registry.claim, self.username, run_id, "queued", self._scheduler.user_quota
+                    )
+                else:
+                    claimed = await asyncio.to_thread(self._registry.claim, self.username, run_id)
+            except BaseException:
+                self._is_starting = False
+                raise
+            if not claimed:
+                self._is_starting = False
+                raise RuntimeError("Process already running")
+        self.run_id = run_id
+        self._log = RunLog(self.run_id)
+        self._log.open_for_append()
+
+    async def _publish(self, output):
+        # Log first, the event id readers resume from is the position in the log
+        event_id = self._log.append(output)
+        await self._output.publish((event_id, output))
+
+    async def _publish_final(self, status: dict):
+        if self._registry is not None:
+            await asyncio.to_thread(self._registry.finish, self.run_id, status["status"], status["message"])
+        if self._scheduler is not None:
+            self._scheduler.notify()
+        if self._metrics is not None:
+            self._metrics.save(force=True)
+        event_id = self._log.append(status)
+        self._output.publish_nowait((event_id, status))
+        # Writes out the rest of the log, readers resuming later find all of it
+        await asyncio.to_thread(self._log.close)
+        self._output.close()
+
+    async def _forward_output(self, prefix: str, line: str):
+        # The stderr reader of a pooled worker is not our task, say whose line this is
+        context = log_context.set((self.username, self.run_id))
         try:
-            self._is_starting = True
-            # clear the queue before run
-            while not self._output_queue.empty():
-               self._output_queue.get_nowait()
+            event = parse_event(line) if prefix == "STDOUT: " else None
+            if event is not None:
+                if event[0] == "trace" and self._metrics is not None:
+                    self._metrics.observe_trace(event[1])
+                    self._metrics.save()
+                # tokens are repeated by the node output and traces are for /metrics, keep them out of the log
+                if event[0] not in ("token", "trace"):
+                    print(f"{prefix}{line}",flush=True)
+                await self._publish(StreamEvent(*event))
+                return
 
+            message = f"{prefix}{line}"
+            print(message,flush=True) #flush output immediately
+            if prefix == "STDOUT: ": # only add stdout
+                await self._publish(message)
+        finally:
+            log_context.reset(context)
+
+    async def _finish(self, returncode: int):
+        if returncode == 0:
+            await self._publish_final({"status": "success", "message": "Process completed successfully"})
+        else:
+            await self._publish_final({"status": "error", "message": f"Process exited with code {returncode}"})
+
+    async def start(self, command: list, cwd: str) -> asyncio.Task:
+        """
+        Starts `command` as a new process in the background.
+        Raises RuntimeError when a run is already going on.
+        """
+        await self._claim()
+        self._task = asyncio.create_task(self._run_command(command, cwd))
+        return self._task
+
+    async def start_in_pool(self, pool, job: dict) -> asyncio.Task:
+        """
+        Same as start, but hands the job to an already started graph worker
+        from `pool` instead of spawning a new python process.
+        """
+        await self._claim()
+        # The worker names what the run records (e.g. its cassette) after the run id
+        job = dict(job, run_id=self.run_id)
+        self._task = asyncio.create_task(self._run_job(pool, job))
+        return self._task
+
+    async def _run_command(self, command: list, cwd: str):
+        try:
+            await self._wait_for_turn()
             self._process = await asyncio.create_subprocess_exec(
                 *command,
                 cwd=cwd,
@@ -35,11 +135,7 @@ class ProcessHandler:
                  while True:
                      line = await stream.readline()
                      if line:
-                         message = f"{prefix}{line.decode().strip()}"
-                         print(message,flush=True) #flush output immediately
-                         if prefix == "STDOUT: ": # only add stdout
-                            await self._output_queue.put(message)
-                            
+                         await self._forward_output(prefix, line.decode().strip())
                      else:
                          break
 
@@ -48,15 +144,13 @@ class ProcessHandler:
             stderr_task = asyncio.create_task(stream_output(self._process.stderr, "STDERR: "))
             self._stream_tasks = [stdout_task, stderr_task]
             
-            # Don't wait, let tasks run
             await self._process.wait()
+            # Pipes reach EOF once the process is gone, let the readers catch up
+            await asyncio.gather(*self._stream_tasks, return_exceptions=True)
 
-            if self._process.returncode == 0:
-                 await self._output_queue.put({"status": "success", "message": "Process completed successfully"})
-            else:
-                await self._output_queue.put({"status": "error", "message": f"Process exited with code {self._process.returncode}"})
+            await self._finish(self._process.returncode)
         except Exception as e:
-            await self._output_queue.put({"status": "error", "message": str(e)})
+            await self._publish_final({"status": "error", "message": str(e)})
         finally:
              # Cancel the tasks and wait for cancellation to complete
              for task in self._stream_tasks:
@@ -70,20 +164,91 @@ class ProcessHandler:
              self._is_starting = False
              self._process = None
              self._is_running = False
+
+    async def _wait_for_turn(self, pool=None):
+        # Queued runs tell their readers where they stand in the queue
+        if self._scheduler is None:
+            return None
+
+        async def report_position(position: int):
+            await self._publish(StreamEvent("queue", {"position": position}))
+
+        return await self._scheduler.wait_turn(self.run_id, report_position, pool)
+
+    async def _run_job(self, pool, job: dict):
+        try:
+            # Admitted together with an idle graph worker of the pool, so the
+            # run does not sit in the pool as "running"
+            worker = await self._wait_for_turn(pool)
+            self._is_running = True
+            self._is_starting = False
+
+            returncode = await pool.run_job(job, self._forward_output, worker)
+            await self._finish(returncode)
+        except Exception as e:
+            await self._publish_final({"status": "error", "message": str(e)})
+        finally:
+            self._is_starting = False
+            self._is_running = False
+
     async def status(self):
         return {
-            "is_running": (self._is_running or self._is_starting) and self._process is not None,
+            "is_running": self.is_busy(),
         }
 
-    def subscribe(self):
-        return self._output_queue  # return the queue for external subscription
+    def subscribe(self) -> Subscriber:
+        """
+        Registers a new reader of the current run, it gets every output from now on.
+        """
+        return self._output.subscribe()
 
-    async def get_stream(self):
-      while True:
-            try:
-                output = await asyncio.wait_for(self._output_queue.get(),timeout=0.1)
+    def unsubscribe(self, subscriber: Subscriber):
+        self._output.unsubscribe(subscriber)
+
+    async def get_stream(self, subscriber: Optional[Subscriber] = None):
+        """
+        Yields (event id, output) pairs of the current run until its final status dict.
+        Readers subscribed before the run starts see all of it.
+        """
+        if subscriber is None:
+            if not self.is_busy():
+                return
+            subscriber = self.subscribe()
+        try:
+            while True:
+                output = await subscriber.get()
+                dropped = subscriber.take_dropped()
+                if dropped:
+                    # This reader was too slow, tell it what it missed
+                    yield None, StreamEvent("dropped", {"count": dropped})
+                if output is END_OF_STREAM:
+                    break
                 yield output
-            except asyncio.TimeoutError:
-               if not self._is_running and self._process is None:
-                    break #close if process is not running
-               continue
\ No newline at end of file
+        finally:
+            self._output.unsubscribe(subscriber)
+
+    async def stream_since(self, last_event_id: int):
+        """
+        Yields the output of the current run after `last_event_id`: first what
+        is already in its log, then the live output, without gaps or repeats.
+        """
+        # Subscribe before reading the log, so nothing falls in between
+        subscriber = self.subscribe() if self.is_busy() else None
+        try:
+            if subscriber is not None and self._log is not None:
+                # What was published before subscribing may still wait for the log writer
+                await asyncio.to_thread(self._log.sync)
+            async for event_id, output in replay_run_log(RunLog(self.run_id), last_event_id):
+                last_event_id = event_id
+                yield event_id, output
+        except BaseException:
+            if subscriber is not None:
+                self._output.unsubscribe(subscriber)
+            raise
+
+        if subscriber is None:
+            return
+        async for event_id, output in self.get_stream(subscriber):
+            if event_id is not None and event_id <= last_event_id:
+                continue
+            yield event_id, output
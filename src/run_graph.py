@@ -22,6 +22,11 @@ def main():
         required=True, 
         help="API key for authentication."
     )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Continue the last failed run from its last checkpoint."
+    )
     
     # Parse the arguments
     args = parser.parse_args()
@@ -32,7 +37,7 @@ def main():
     
     # Initialize the LLM using the provided model and API key
     llm_instance = get_llm(llm_model, api_key)
-    run_workflow_as_server(llm_instance)
+    run_workflow_as_server(llm_instance, resume=args.resume)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,228 @@
+# run_log.py
+
+import os
+import re
+import json
+import time
+import uuid
+import struct
+import asyncio
+from threading import Condition, Thread
+from typing import Any, AsyncIterator, Callable, List, Optional, Tuple
+
+from util import StreamEvent
+
+# Next to the sources, graph workers chdir into workspaces between jobs
+RUN_LOG_DIR = os.environ.get("RUN_LOG_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "runs"))
+
+# One little-endian uint64 byte offset into the log per event
+INDEX_ENTRY = struct.Struct("<Q")
+
+RUN_ID_PATTERN = re.compile(r"^[0-9a-f]{32}$")
+
+
+def new_run_id() -> str:
+    return uuid.uuid4().hex
+
+
+def encode_output(output: Any) -> dict:
+    if isinstance(output, StreamEvent):
+        return {"type": "event", "event": output.event, "data": output.data}
+    if isinstance(output, dict):
+        return {"type": "status", "data": output}
+    return {"type": "line", "data": output}
+
+
+def decode_output(record: dict) -> Any:
+    if record["type"] == "event":
+        return StreamEvent(record["event"], record["data"])
+    return record["data"]
+
+
+class RunLog:
+    """
+    Append-only log of everything a run streamed. Event ids are positions in
+    the log: `<run_id>.log` holds one JSON record per line and `<run_id>.idx`
+    the byte offset of every record, so a reader can seek straight to any id.
+
+    Appending only queues the record, a background thread writes the queued
+    records in batches with one flush per batch, like ServerTee does, so the
+    event loop never waits for the disk; close() writes out the rest.
+    """
+
+    def __init__(self, run_id: str, directory: Optional[str] = None):
+        if not RUN_ID_PATTERN.match(run_id):
+            raise ValueError(f"Invalid run id {run_id}")
+        self.run_id = run_id
+        directory = directory or RUN_LOG_DIR
+        self.log_path = os.path.join(directory, f"{run_id}.log")
+        self.index_path = os.path.join(directory, f"{run_id}.idx")
+        self._log = None
+        self._index = None
+        self.count = 0
+        self._condition = Condition()
+        self._pending: List[bytes] = []
+        self._written = 0  # records on disk
+        self._closed = False
+        self._writer = None
+
+    def exists(self) -> bool:
+        return os.path.exists(self.index_path)
+
+    def last_event_id(self) -> int:
+        """Id of the last record on disk, -1 while there is none."""
+        try:
+            return os.path.getsize(self.index_path) // INDEX_ENTRY.size - 1
+        except FileNotFoundError:
+            return -1
+
+    def open_for_append(self):
+        os.makedirs(os.path.dirname(self.log_path), exist_ok=True)
+        self._log = open(self.log_path, "ab")
+        self._index = open(self.index_path, "ab")
+        self.count = self._written = self._index.tell() // INDEX_ENTRY.size
+        self._offset = self._log.tell()
+        self._closed = False
+        self._writer = Thread(target=self._write_batches, name=f"RunLog {self.run_id}", daemon=True)
+        self._writer.start()
+
+    def append(self, output: Any) -> int:
+        """Queues `output` for the log and returns its event id."""
+        record = (json.dumps(encode_output(output)) + "\n").encode()
+        with self._condition:
+            self._pending.append(record)
+            event_id = self.count
+            self.count += 1
+            self._condition.notify_all()
+        return event_id
+
+    def _write_batches(self):
+        while True:
+            with self._condition:
+                while not self._pending and not self._closed:
+                    self._condition.wait()
+                records, self._pending = self._pending, []
+                if not records:
+                    return  # closed and written out
+
+            offsets = []
+            for record in records:
+                offsets.append(self._offset)
+                self._offset += len(record)
+            try:
+                self._log.write(b"".join(records))
+                self._log.flush()
+                # The index entries go last, readers only look at records they point to
+                self._index.write(b"".join(INDEX_ENTRY.pack(offset) for offset in offsets))
+                self._index.flush()
+            except Exception as e:
+                print(f"[RunLog] cannot write {self.log_path}: {e}")
+
+            with self._condition:
+                self._written += len(records)
+                self._condition.notify_all()
+
+    def sync(self):
+        """Blocks until every record appended so far is written."""
+        with self._condition:
+            target = self.count
+            while self._written < target and self._writer is not None and self._writer.is_alive():
+                self._condition.wait()
+
+    def close(self):
+        """Writes out the queued records and closes the files, blocks until done."""
+        if self._log is not None:
+            with self._condition:
+                self._closed = True
+                self._condition.notify_all()
+            self._writer.join()
+            self._log.close()
+            self._index.close()
+            self._log = None
+            self._index = None
+
+    def read_batch(self, after_id: int, limit: int = 500) -> List[Tuple[int, Any]]:
+        """
+        Returns up to `limit` (event id, output) pairs with ids after `after_id`.
+        """
+        first = max(after_id + 1, 0)
+        with open(self.index_path, "rb") as index:
+            index.seek(first * INDEX_ENTRY.size)
+            raw = index.read(limit * INDEX_ENTRY.size)
+        count = len(raw) // INDEX_ENTRY.size
+        if count == 0:
+            return []
+
+        offset = INDEX_ENTRY.unpack_from(raw, 0)[0]
+        outputs = []
+        with open(self.log_path, "rb") as log:
+            log.seek(offset)
+            for i in range(count):
+                outputs.append((first + i, decode_output(json.loads(log.readline()))))
+        return outputs
+
+
+async def replay_run_log(run_log: RunLog, after_id: int) -> AsyncIterator[Tuple[int, Any]]:
+    """
+    Yields the (event id, output) pairs of `run_log` after `after_id`, as far as they are written.
+    """
+    while True:
+        batch = await asyncio.to_thread(run_log.read_batch, after_id)
+        if not batch:
+            break
+        for event_id, output in batch:
+            yield event_id, output
+            after_id = event_id
+
+
+async def follow_run_log(
+    run_log: RunLog,
+    after_id: int,
+    is_active: Callable[[], bool],
+    poll_interval: float = 0.1
+) -> AsyncIterator[Tuple[int, Any]]:
+    """
+    Yields the output of a run written by another process: the log after
+    `after_id`, then new records as they appear, until the final status or
+    until `is_active` says the run is gone.
+    """
+    delay = poll_interval
+    while True:
+        caught_up = True
+        async for event_id, output in replay_run_log(run_log, after_id):
+            after_id = event_id
+            caught_up = False
+            yield event_id, output
+            if isinstance(output, dict):
+                return  # final status
+
+        if caught_up:
+            if not await asyncio.to_thread(is_active):
+                # One last look, the final record may have landed meanwhile
+                async for event_id, output in replay_run_log(run_log, after_id):
+                    yield event_id, output
+                return
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 1.0)
+        else:
+            delay = poll_interval
+
+
+def prune_run_logs(max_age: float, directory: Optional[str] = None):
+    """
+    Deletes the logs of runs that have not been written for `max_age` seconds.
+    Only run logs, anything else kept in the directory stays.
+    """
+    directory = directory or RUN_LOG_DIR
+    if not os.path.isdir(directory):
+        return
+    deadline = time.time() - max_age
+    for name in os.listdir(directory):
+        if not name.endswith((".log", ".idx")):
+            continue
+        path = os.path.join(directory, name)
+        try:
+            if os.path.getmtime(path) < deadline:
+                os.remove(path)
+        except OSError:
+            pass
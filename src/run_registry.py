@@ -0,0 +1,250 @@
+# run_registry.py
+
+import os
+import time
+import sqlite3
+from threading import Lock
+from typing import Any, Dict, List, Optional
+
+# Next to the sources, not in RUN_LOG_DIR whose old files get pruned
+DEFAULT_REGISTRY_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "state", "registry.sqlite")
+
+# Runs in these states hold their user's workspace
+ACTIVE_STATUSES = ("queued", "running")
+
+
+def pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _boot_id() -> str:
+    try:
+        with open("/proc/sys/kernel/random/boot_id") as f:
+            return f.read().strip()
+    except OSError:
+        return ""
+
+BOOT_ID = _boot_id()
+
+
+def process_token(pid: int) -> str:
+    """
+    Boot id and start time of process `pid`, "" where /proc cannot tell.
+    A pid reused after a restart gets another token.
+    """
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            stat = f.read()
+    except OSError:
+        return ""
+    # The command name may hold spaces, the fields after it do not
+    start_time = stat.rsplit(")", 1)[1].split()[19]
+    return f"{BOOT_ID}:{start_time}"
+
+OWN_TOKEN = process_token(os.getpid())
+
+
+def owner_alive(pid: int, token: Optional[str]) -> bool:
+    if token is None:
+        return False  # registered before tokens existed, by a server that is gone
+    return pid_alive(pid) and (not token or process_token(pid) == token)
+
+
+class RunRegistry:
+    """
+    Run ownership and status shared by every uvicorn worker of the machine,
+    kept in a SQLite file. A run belongs to the worker process that started it,
+    runs of a worker that died are marked as failed the next time anyone looks.
+
+    Every method blocks on SQLite, call them with asyncio.to_thread from the event loop.
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path or os.environ.get("RUN_REGISTRY_PATH", DEFAULT_REGISTRY_PATH)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._lock = Lock()
+        self._conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS runs ("
+            "run_id TEXT PRIMARY KEY, username TEXT NOT NULL, status TEXT NOT NULL, "
+            "owner_pid INTEGER NOT NULL, created REAL NOT NULL, started REAL, finished REAL, message TEXT, "
+            "owner_token TEXT)"
+        )
+        columns = [row["name"] for row in self._conn.execute("PRAGMA table_info(runs)")]
+        if "owner_token" not in columns:
+            try:
+                self._conn.execute("ALTER TABLE runs ADD COLUMN owner_token TEXT")
+            except sqlite3.OperationalError:
+                pass  # another worker added it meanwhile
+        self._conn.execute("CREATE INDEX IF NOT EXISTS runs_user_status ON runs (username, status)")
+
+    def _reap(self, run_id: str):
+        self._conn.execute(
+            f"UPDATE runs SET status = 'error', finished = ?, message = ? WHERE run_id = ? AND status IN {ACTIVE_STATUSES}",
+            (time.time(), "Server worker exited during the run", run_id)
+        )
+
+    def _dead_owner_runs(self) -> List[str]:
+        rows = self._conn.execute(
+            f"SELECT run_id, owner_pid, owner_token FROM runs WHERE status IN {ACTIVE_STATUSES}"
+        ).fetchall()
+        return [row["run_id"] for row in rows if not owner_alive(row["owner_pid"], row["owner_token"])]
+
+    def _reap_dead_owners(self):
+        for run_id in self._dead_owner_runs():
+            self._reap(run_id)
+
+    def _read(self, query: str, params: tuple) -> Optional[sqlite3.Row]:
+        """
+        One row in a plain read transaction, a run whose owner died is reaped first.
+        """
+        with self._lock:
+            row = self._conn.execute(query, params).fetchone()
+            if row is not None and row["status"] in ACTIVE_STATUSES and not owner_alive(row["owner_pid"], row["owner_token"]):
+                self._reap(row["run_id"])
+                row = self._conn.execute(query, params).fetchone()
+        return row
+
+    def claim(self, username: str, run_id: str, status: str = "running", quota: int = 1) -> bool:
+        """
+        Registers `run_id` as the run of `username` owned by this process.
+        Returns False when the user already has `quota` active runs on any worker.
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._reap_dead_owners()
+                active = self._conn.execute(
+                    f"SELECT COUNT(*) FROM runs WHERE username = ? AND status IN {ACTIVE_STATUSES}", (username,)
+                ).fetchone()[0]
+                if active >= quota:
+                    self._conn.execute("ROLLBACK")
+                    return False
+                self._conn.execute(
+                    "INSERT INTO runs (run_id, username, status, owner_pid, owner_token, created, started) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (run_id, username, status, os.getpid(), OWN_TOKEN, now, now if status == "running" else None)
+                )
+                self._conn.execute("COMMIT")
+                return True
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def finish(self, run_id: str, status: str, message: str = ""):
+        with self._lock:
+            self._conn.execute(
+                "UPDATE runs SET status = ?, finished = ?, message = ? WHERE run_id = ?",
+                (status, time.time(), message, run_id)
+            )
+
+    def get(self, run_id: str) -> Optional[Dict[str, Any]]:
+        row = self._read("SELECT * FROM runs WHERE run_id = ?", (run_id,))
+        return dict(row) if row is not None else None
+
+    def active_run(self, username: str) -> Optional[Dict[str, Any]]:
+        while True:
+            row = self._read(
+                f"SELECT * FROM runs WHERE username = ? AND status IN {ACTIVE_STATUSES} ORDER BY created DESC",
+                (username,)
+            )
+            # A reaped run is no longer active, look at the next one
+            if row is None or row["status"] in ACTIVE_STATUSES:
+                return dict(row) if row is not None else None
+
+    def is_active(self, run_id: str) -> bool:
+        run = self.get(run_id)
+        return run is not None and run["status"] in ACTIVE_STATUSES
+
+    def _queue_position(self, run_id: str, policy: str):
+        """
+        (status of `run_id`, its 1-based queue position, running runs).
+        """
+        run = self._conn.execute("SELECT status FROM runs WHERE run_id = ?", (run_id,)).fetchone()
+        if run is None or run["status"] != "queued":
+            return (run["status"] if run is not None else None), 0, 0
+
+        if policy == "fair":
+            order = (
+                "(SELECT COUNT(*) FROM runs AS r WHERE r.username = q.username AND r.status = 'running'), q.created"
+            )
+        else:
+            order = "q.created"
+        queue = [
+            row["run_id"] for row in self._conn.execute(
+                f"SELECT q.run_id FROM runs AS q WHERE q.status = 'queued' ORDER BY {order}"
+            )
+        ]
+        running = self._conn.execute("SELECT COUNT(*) FROM runs WHERE status = 'running'").fetchone()[0]
+        return "queued", queue.index(run_id) + 1, running
+
+    def queue_position(self, run_id: str, policy: str = "fifo") -> int:
+        """
+        1-based queue position of run `run_id`, 0 once it is no longer queued.
+        Reads only, the run is not admitted.
+        """
+        with self._lock:
+            return self._queue_position(run_id, policy)[1]
+
+    def try_admit(self, run_id: str, max_running: int, policy: str = "fifo") -> int:
+        """
+        Starts queued run `run_id` if it is its turn and fewer than `max_running`
+        runs are running. Returns 0 once the run is running, otherwise its
+        1-based position in the queue.
+
+        The "fifo" policy serves runs in the order they were queued, "fair"
+        serves first the users with the fewest running runs.
+        """
+        with self._lock:
+            # Queued runs poll this, only take the write lock when the run may start
+            # or a dead worker's runs hold slots
+            status, position, running = self._queue_position(run_id, policy)
+            if status != "queued":
+                return 0
+            if position > max_running - running and not self._dead_owner_runs():
+                return position
+
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._reap_dead_owners()
+                status, position, running = self._queue_position(run_id, policy)
+                if status == "queued" and position <= max_running - running:
+                    self._conn.execute(
+                        "UPDATE runs SET status = 'running', started = ? WHERE run_id = ?", (time.time(), run_id)
+                    )
+                    position = 0
+                self._conn.execute("COMMIT")
+                return position if status == "queued" else 0
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def queue_stats(self, window: float = 3600) -> Dict[str, Any]:
+        """
+        Queue depth, running runs and how long the runs started in the last
+        `window` seconds waited in the queue, over every server worker.
+        """
+        since = time.time() - window
+        with self._lock:
+            queued = self._conn.execute("SELECT COUNT(*) FROM runs WHERE status = 'queued'").fetchone()[0]
+            running = self._conn.execute("SELECT COUNT(*) FROM runs WHERE status = 'running'").fetchone()[0]
+            waits = self._conn.execute(
+                "SELECT COUNT(*), AVG(started - created), MAX(started - created) FROM runs "
+                "WHERE started IS NOT NULL AND started >= ?", (since,)
+            ).fetchone()
+        return {
+            "queued": queued,
+            "running": running,
+            "started": waits[0],
+            "wait_seconds_avg": waits[1] or 0.0,
+            "wait_seconds_max": waits[2] or 0.0,
+        }
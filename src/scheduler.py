@@ -0,0 +1,76 @@
+# scheduler.py
+
+import os
+import asyncio
+from typing import Awaitable, Callable, Optional
+
+from run_registry import RunRegistry
+
+
+class RunScheduler:
+    """
+    Admission control in front of the graph workers, shared by every server
+    worker through the run registry: at most `max_running` runs run at once
+    on the machine, each user has at most `user_quota` runs queued or running,
+    the rest wait in a "fifo" or "fair" queue.
+    """
+
+    def __init__(
+        self,
+        registry: RunRegistry,
+        max_running: Optional[int] = None,
+        user_quota: Optional[int] = None,
+        policy: Optional[str] = None,
+        poll_interval: float = 0.5
+    ):
+        self.registry = registry
+        self.max_running = max_running if max_running is not None else int(os.environ.get("MAX_CONCURRENT_RUNS", 8))
+        self.user_quota = user_quota if user_quota is not None else int(os.environ.get("RUN_QUOTA_PER_USER", 1))
+        self.policy = policy or os.environ.get("RUN_QUEUE_POLICY", "fifo")
+        # Other server workers cannot wake us up, so queued runs also look again every poll_interval
+        self.poll_interval = poll_interval
+        self._wakeup = asyncio.Event()
+
+    def notify(self):
+        """Wakes the queued runs of this process up, a run just finished here."""
+        self._wakeup.set()
+
+    async def wait_turn(self, run_id: str, on_position: Callable[[int], Awaitable[None]], pool=None):
+        """
+        Waits until queued run `run_id` may start, reporting each new queue position.
+        With a WorkerPool `pool` the run is only admitted once one of this server
+        worker's graph workers is idle; that worker is returned reserved for it.
+        """
+        last_position = None
+        while True:
+            # Cleared before looking, so a run finishing meanwhile still wakes us up
+            self._wakeup.clear()
+            worker = pool.try_reserve() if pool is not None else None
+            if pool is not None and worker is None:
+                # Every local graph worker is busy, the run keeps its place without being admitted
+                position = await asyncio.to_thread(self.registry.queue_position, run_id, self.policy)
+            else:
+                try:
+                    position = await asyncio.to_thread(self.registry.try_admit, run_id, self.max_running, self.policy)
+                except BaseException:
+                    if worker is not None:
+                        pool.unreserve(worker)
+                    raise
+                if position == 0:
+                    return worker
+                if worker is not None:
+                    pool.unreserve(worker)
+
+            if position != last_position:
+                await on_position(position)
+                last_position = position
+
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def stats(self) -> dict:
+        stats = self.registry.queue_stats()
+        stats["max_running"] = self.max_running
+        return stats
@@ -1,27 +1,34 @@
 # server.py
 
 import os
+import json
 from datetime import datetime
 import httpx
-from typing import Dict
+from typing import Dict, Optional
 import asyncio
 
 from fastapi import FastAPI, HTTPException, Request
-from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.responses import JSONResponse, StreamingResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
 
 from ServerTee import ServerTee
 from process_handler import ProcessHandler
+from llm import get_llm, AChatBot
+from cassette import Cassette, CassetteMismatch, check_cassette_options
+from util import StreamEvent, EVENT_PREFIX
+from run_log import RunLog, replay_run_log, follow_run_log, prune_run_logs
+from run_registry import RunRegistry
+from scheduler import RunScheduler
+from worker_pool import WorkerPool
+from metrics import Metrics, load_all, render_prometheus
 from FileTransmit import file_router
 
-# log name as today's date in YYYY-MM-DD format
-today_date = datetime.now().strftime("%Y-%m-%d")
-# Create log file path dynamically based on the date
-log_file_path = f"log/{today_date}.log"
-# Initialize ServerTee with the dynamically generated log file path
-tee = ServerTee(log_file_path)
+# log name as the date in YYYY-MM-DD format, ServerTee starts a new file every day
+log_file_pattern = "log/%Y-%m-%d.log"
+# Initialize ServerTee with the dated log file path
+tee = ServerTee(log_file_pattern)
 # Print the log file path for reference
-print(log_file_path)
+print(tee.path)
 
 # Initialize FastAPI app
 app = FastAPI()
@@ -39,8 +46,52 @@ app.add_middleware(
     allow_headers=["*"],  # Allows all headers
 )
 
-# Dictionary to store ProcessHandler instances per user
-handlers = {}
+# ProcessHandler of the runs started by this server worker, by run id;
+# finished runs are dropped once the next run starts, their logs stay
+runs: Dict[str, ProcessHandler] = {}
+
+# Runs of every uvicorn worker, so status and streams work whichever worker gets the request
+run_registry = RunRegistry()
+
+# Limits and queues /run jobs over all server workers
+# (MAX_CONCURRENT_RUNS, RUN_QUOTA_PER_USER, RUN_QUEUE_POLICY)
+run_scheduler = RunScheduler(run_registry)
+
+# Histograms of the trace events of the runs of this worker, served by /metrics
+metrics = Metrics()
+
+# Pre-started graph workers shared by every /run request
+# (size and recycling via WORKER_POOL_SIZE and WORKER_MAX_JOBS)
+worker_pool = WorkerPool()
+
+
+@app.on_event("startup")
+async def start_worker_pool():
+    # Forget the output of runs nobody resumed for a day (RUN_LOG_RETENTION_HOURS)
+    prune_run_logs(float(os.environ.get("RUN_LOG_RETENTION_HOURS", 24)) * 3600)
+    await worker_pool.start()
+
+
+@app.on_event("shutdown")
+async def close_worker_pool():
+    await worker_pool.close()
+
+
+def format_sse(output, event_id: Optional[int] = None) -> str:
+    # Clients send the last id back as Last-Event-ID to resume from /runs/{run_id}/stream
+    prefix = f"id: {event_id}\n" if event_id is not None else ""
+    if isinstance(output, StreamEvent):
+        return f"{prefix}event: {output.event}\ndata: {json.dumps(output.data)}\n\n"
+    return f"{prefix}data: {output}\n\n"
+
+
+async def stream_run_output(run_id: str, outputs):
+    # The run id comes first, a client needs it to resume a dropped stream
+    yield format_sse(StreamEvent("run", {"run_id": run_id}))
+    async for event_id, output in outputs:
+        yield format_sse(output, event_id)
+        if isinstance(output, dict):
+            break  # final status
 
 
 @app.post('/chatbot/{username}')
@@ -52,7 +103,24 @@ async def process_string(request: Request, username: str):
     api_key = data.get('api_key', '')
 
     # Process the string using the dynamically provided llm_model and api_key
-    result = await ChatBot(get_llm(llm_model, api_key), input_string)
+    llm = get_llm(llm_model, api_key)
+    if llm is None:
+        raise HTTPException(status_code=400, detail=f"Unsupported llm_model {llm_model}")
+
+    # Chatbot answers are recorded to the "chatbot" cassette of the user's workspace
+    try:
+        cassette = await asyncio.to_thread(
+            Cassette.from_options, data.get('cassette'), os.path.join("workspace", username), "chatbot"
+        )
+    except (ValueError, OSError) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid cassette: {e}")
+    try:
+        result = await AChatBot(llm, input_string, cassette)
+    except CassetteMismatch as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    finally:
+        if cassette is not None:
+            cassette.close()
 
     # Return the result as JSON
     return JSONResponse(content={'result': result})
@@ -66,34 +134,187 @@ async def run_script(request: Request, username: str):
     llm_model = data.get('llm_model', '')
     api_key = data.get('api_key', '')
 
-    command = [
-        "python", "../../run_graph.py",
-        "--llm", llm_model,
-        "--key", api_key
+    job = {
+        "cwd": os.path.abspath(user_workspace),
+        "llm_model": llm_model,
+        "api_key": api_key,
+        "max_concurrency": data.get('max_concurrency'),  # parallel nodes per fan-out, None for the server default
+        "no_cache": data.get('no_cache', False),  # ask the LLM again instead of reusing cached answers
+    }
+    if 'stream_tokens' in data:
+        job["stream_tokens"] = bool(data['stream_tokens'])  # send "token" events while the LLM generates
+    if 'cassette' in data:
+        try:
+            check_cassette_options(data['cassette'])
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=f"Invalid cassette: {e}")
+        job["cassette"] = data['cassette']  # record the LLM answers, or replay those of an earlier run
+    if data.get('resume'):
+        job["resume"] = True  # continue the last failed run of this graph from its last checkpoint
+
+    # One handler per run, how many runs a user may have is up to the registry (RUN_QUOTA_PER_USER)
+    handler = ProcessHandler(username, run_registry, run_scheduler, metrics)
+
+    async def error_response(message):
+        yield format_sse({"status": "error", "message": message})
+
+    # Subscribe before starting, so the reader sees the whole run
+    subscriber = handler.subscribe()
+    try:
+        await handler.start_in_pool(worker_pool, job) # start the job as a task
+    except RuntimeError as e:
+        handler.unsubscribe(subscriber)
+        return StreamingResponse(error_response(str(e)), media_type="text/event-stream")
+    for run_id in [run_id for run_id, run_handler in runs.items() if not run_handler.is_busy()]:
+        del runs[run_id]
+    runs[handler.run_id] = handler
+
+    return StreamingResponse(
+        stream_run_output(handler.run_id, handler.get_stream(subscriber)),
+        media_type="text/event-stream",
+        headers={"X-Run-ID": handler.run_id}
+    )
+
+@app.get('/runs/{run_id}/stream')
+async def resume_run_stream(request: Request, run_id: str, last_event_id: Optional[int] = None):
+    """
+    Streams a run from its log, after the Last-Event-ID header (or the
+    last_event_id query parameter), then follows it live if it still runs.
+    """
+    try:
+        header = request.headers.get("last-event-id")
+        after = int(header) if header else (last_event_id if last_event_id is not None else -1)
+        run_log = RunLog(run_id)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if not run_log.exists():
+        raise HTTPException(status_code=404, detail="Run not found")
+
+    handler = runs.get(run_id)
+    if handler is not None and handler.run_id == run_id:
+        outputs = handler.stream_since(after)
+    elif await asyncio.to_thread(run_registry.is_active, run_id):
+        # Running on another server worker, follow its log
+        outputs = follow_run_log(run_log, after, lambda: run_registry.is_active(run_id))
+    else:
+        outputs = replay_run_log(run_log, after)
+
+    return StreamingResponse(stream_run_output(run_id, outputs), media_type="text/event-stream")
+
+def tail_line(output) -> Optional[str]:
+    # A run log record as the server log line printed for it, None for what is not printed
+    if isinstance(output, StreamEvent):
+        if output.event in ("token", "trace"):
+            return None
+        output = "STDOUT: " + EVENT_PREFIX + json.dumps({"event": output.event, "data": output.data})
+    elif not isinstance(output, str):
+        return None  # final status
+    return f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')} - {output}\n"
+
+
+async def follow_other_workers(username: Optional[str], run_id: Optional[str], lines: asyncio.Queue):
+    """
+    Puts the lines of the runs of `username`, or of run `run_id`, that run on
+    other server workers into `lines`, read from their run logs. Those logs hold
+    what the run streams, so STDERR lines of such runs are not included.
+    """
+    tail_started = datetime.now().timestamp()
+    followed = set()
+    while True:
+        if run_id:
+            run = await asyncio.to_thread(run_registry.get, run_id)
+        else:
+            run = await asyncio.to_thread(run_registry.active_run, username)
+        active = run is not None and run["status"] in ("queued", "running")
+        if active and run["run_id"] not in runs and run["run_id"] not in followed:
+            followed.add(run["run_id"])
+            run_log = RunLog(run["run_id"])
+            # Like the lines of this worker, only what is printed from now on
+            after = run_log.last_event_id() if run["created"] < tail_started else -1
+            is_active = lambda followed_id=run["run_id"]: run_registry.is_active(followed_id)
+            async for _, output in follow_run_log(run_log, after, is_active):
+                line = tail_line(output)
+                if line is not None:
+                    await lines.put(line)
+            continue
+        if run_id and not active:
+            return
+        await asyncio.sleep(1)
+
+
+async def tail_all_workers(username: Optional[str], run_id: Optional[str]):
+    # Runs of this worker come from the tee as they are printed, runs of other workers from their logs
+    lines = asyncio.Queue(maxsize=tee.tail_buffer_size)
+
+    async def tail_this_worker():
+        async for line in tee.stream_to_frontend(username, run_id):
+            await lines.put(line)
+
+    tasks = [
+        asyncio.create_task(tail_this_worker()),
+        asyncio.create_task(follow_other_workers(username, run_id, lines)),
     ]
+    try:
+        while True:
+            yield await lines.get()
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+@app.get('/logs/tail')
+async def tail_logs(username: Optional[str] = None, run_id: Optional[str] = None):
+    """
+    Server log lines of one user's runs, or of one run, as they are printed,
+    whichever server worker runs them. Runs on other workers are followed
+    through their run logs, without their STDERR lines.
+    """
+    if not username and not run_id:
+        raise HTTPException(status_code=400, detail="username or run_id is required")
+    if run_id:
+        try:
+            RunLog(run_id)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    return StreamingResponse(tail_all_workers(username, run_id), media_type="text/plain")
+
+@app.get('/metrics')
+async def prometheus_metrics():
+    # Saved on the event loop, which is where the histograms change
+    metrics.save(force=True)
+
+    def collect():
+        stats = run_scheduler.stats()
+        gauges = {
+            "langgraph_runs_queued": ("Runs waiting for the scheduler", stats["queued"]),
+            "langgraph_runs_running": ("Runs running", stats["running"]),
+            "langgraph_runs_max_running": ("Runs allowed to run at once", stats["max_running"]),
+            "langgraph_run_wait_seconds_avg": ("Average queue wait of the runs started in the last hour", stats["wait_seconds_avg"]),
+            "langgraph_run_wait_seconds_max": ("Longest queue wait of the runs started in the last hour", stats["wait_seconds_max"]),
+        }
+        return render_prometheus(load_all(), gauges)
+
+    return Response(await asyncio.to_thread(collect), media_type="text/plain; version=0.0.4")
+
+@app.get('/queue')
+async def queue_metrics():
+    # Queue depth and how long runs waited, over every server worker
+    return await asyncio.to_thread(run_scheduler.stats)
 
-    # Get or create a handler for the user
-    if username not in handlers:
-        handlers[username] = ProcessHandler()
-    
-    handler = handlers[username]
-    # start process in background
-    async def stream_response():
-        asyncio.create_task(handler.run(command, user_workspace)) # start the process as a task
-        async for output in handler.get_stream():
-            if isinstance(output, dict):
-                yield f"data: {output}\n\n"  # Send final status
-                break
-            yield f"data: {output}\n\n"
-
-    return StreamingResponse(stream_response(), media_type="text/event-stream")
+@app.get('/runs/{run_id}')
+async def run_info(run_id: str):
+    run = await asyncio.to_thread(run_registry.get, run_id)
+    if run is None:
+        raise HTTPException(status_code=404, detail="Run not found")
+    return {key: run[key] for key in ("run_id", "username", "status", "created", "started", "finished", "message")}
 
 @app.get('/status/{username}')
 async def check_status(username: str):
-    # Check if the handler exists and retrieve its status
-    if username in handlers:
-        status = await handlers[username].status()  # Note: status() is an async function
-        return {"running": status["is_running"]}  # Make sure to return running status
+    # The run may belong to any server worker, ask the shared registry
+    run = await asyncio.to_thread(run_registry.active_run, username)
+    if run is not None:
+        return {"running": True, "run_id": run["run_id"]}
     return {"running": False}
 
 
@@ -0,0 +1,160 @@
+# structured_output.py
+
+import re
+import json
+import inspect
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+# Bare words of Python-style output and their JSON spelling
+LITERALS = {"true": "true", "false": "false", "null": "null", "True": "true", "False": "false", "None": "null"}
+
+# A number as a model may write it, sign, fraction and exponent included
+NUMBER = re.compile(r"[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?")
+
+CODE_FENCE = re.compile(r"```(?:json)?\s*(.*?)\s*(?:```|$)", re.DOTALL)
+
+
+class OutputError(ValueError):
+    """LLM output a node cannot use, the message tells the LLM what was wrong."""
+
+
+def repair_json(text: str) -> str:
+    """
+    Rewrites almost-JSON the way small models write it into JSON: single
+    quoted strings, unquoted keys, True/False/None, trailing commas and
+    brackets left open by a cut off answer.
+    """
+    out: List[str] = []
+    closers: List[str] = []
+    i, n = 0, len(text)
+    while i < n:
+        c = text[i]
+        if c in "\"'":
+            j = i + 1
+            while j < n and text[j] != c:
+                j += 2 if text[j] == "\\" else 1
+            body = text[i + 1:min(j, n)]
+            if c == "'":
+                body = body.replace("\\'", "'").replace('"', '\\"')
+            # An unterminated string ends with the text
+            out.append('"' + body + '"')
+            i = j + 1
+        elif c in "{[":
+            closers.append("}" if c == "{" else "]")
+            out.append(c)
+            i += 1
+        elif c in "}]":
+            if closers and closers[-1] == c:
+                closers.pop()
+            out.append(c)
+            i += 1
+        elif c == ",":
+            j = i + 1
+            while j < n and text[j].isspace():
+                j += 1
+            if j < n and text[j] not in "}]":
+                out.append(c)
+            i = j
+        elif (c.isdigit() or c in "-+.") and NUMBER.match(text, i):
+            # One token, or the exponent would be quoted as a bare word
+            number = NUMBER.match(text, i).group()
+            try:
+                json.loads(number.lstrip("+"))
+                out.append(number.lstrip("+"))
+            except ValueError:
+                out.append(json.dumps(float(number)))  # .5, 1.
+            i += len(number)
+        elif c.isalpha() or c == "_":
+            j = i
+            while j < n and (text[j].isalnum() or text[j] == "_"):
+                j += 1
+            word = text[i:j]
+            out.append(LITERALS.get(word) or json.dumps(word))
+            i = j
+        else:
+            out.append(c)
+            i += 1
+    out.extend(reversed(closers))
+    return "".join(out)
+
+
+def json_candidate(text: str) -> Optional[str]:
+    """
+    The object or array inside a code fence or surrounding prose, None without one.
+    """
+    fence = CODE_FENCE.search(text)
+    if fence:
+        text = fence.group(1)
+    text = text.strip()
+    starts = [i for i in (text.find("{"), text.find("[")) if i != -1]
+    if text.startswith('"') and ":" in text and (not starts or text.index(":") < min(starts)):
+        # "key": value pairs without the braces, as the node prompts show them
+        return "{" + text.rstrip(",") + "}"
+    if not starts:
+        return None
+    start = min(starts)
+    end = max(text.rfind("}"), text.rfind("]"))
+    return text[start:end + 1] if end > start else text[start:]
+
+
+def parse_json(text: str) -> Any:
+    """
+    Parses LLM output as JSON. Valid JSON takes the json.loads fast path,
+    anything else is cut out of its surroundings and repaired first.
+    """
+    try:
+        return json.loads(text)
+    except ValueError:
+        pass
+
+    candidate = json_candidate(text)
+    if candidate is None:
+        raise OutputError("the reply has no JSON object")
+    try:
+        return json.loads(candidate, strict=False)
+    except ValueError:
+        pass
+    try:
+        return json.loads(repair_json(candidate), strict=False)
+    except ValueError as e:
+        raise OutputError(f"the reply is not valid JSON ({e})") from None
+
+
+def parse_tool_call(text: str, tools: Dict[str, Callable]) -> Tuple[str, List[Any]]:
+    """
+    (tool name, args) of a {"function": name, "args": [...]} reply, checked
+    against the tools in `tools` and their signatures.
+    """
+    data = parse_json(text)
+    if not isinstance(data, dict):
+        raise OutputError('the reply must be a JSON object with "function" and "args"')
+
+    tool_name = data.get("function")
+    if not isinstance(tool_name, str) or not tool_name:
+        raise OutputError('"function" must be the name of the tool')
+    if tool_name not in tools:
+        raise OutputError(f"there is no tool {tool_name}, available: {', '.join(tools)}")
+
+    args = data.get("args", [])
+    if not isinstance(args, list):
+        raise OutputError('"args" must be a list of the arguments')
+    try:
+        inspect.signature(tools[tool_name]).bind(*args)
+    except TypeError as e:
+        raise OutputError(f"wrong arguments for {tool_name}: {e}") from None
+    except ValueError:
+        pass  # no signature to check against
+    return tool_name, args
+
+
+def parse_switch(text: str) -> bool:
+    """
+    The boolean of a {"switch": true/false} reply.
+    """
+    data = parse_json(text)
+    switch = data.get("switch") if isinstance(data, dict) else None
+    if isinstance(switch, bool):
+        return switch
+    if isinstance(switch, str) and switch.strip().lower() in ("true", "false"):
+        return switch.strip().lower() == "true"
+    raise OutputError('the reply must be a JSON object with "switch": true or false')
@@ -0,0 +1,53 @@
+# tokenizer.py
+
+from functools import lru_cache
+from typing import Callable, Dict
+
+TokenCounter = Callable[[str], int]
+
+# Tokenizer factories by model name prefix, a factory gets the model name
+# and returns a function counting the tokens of a text
+_tokenizer_factories: Dict[str, Callable[[str], TokenCounter]] = {}
+
+
+def register_tokenizer(model_prefix: str, factory: Callable[[str], TokenCounter]):
+    """
+    Registers the tokenizer used for every model whose name starts with `model_prefix`.
+    """
+    _tokenizer_factories[model_prefix.lower()] = factory
+    get_tokenizer.cache_clear()
+
+
+def approximate_tokens(text: str) -> int:
+    # Roughly 4 characters per token for English text and JSON
+    return (len(text) + 3) // 4
+
+
+def tiktoken_tokenizer(model: str) -> TokenCounter:
+    try:
+        import tiktoken
+    except ImportError:
+        return approximate_tokens
+
+    try:
+        encoding = tiktoken.encoding_for_model(model)
+    except KeyError:
+        encoding = tiktoken.get_encoding("o200k_base")
+    return lambda text: len(encoding.encode(text, disallowed_special=()))
+
+
+@lru_cache(maxsize=None)
+def get_tokenizer(model: str) -> TokenCounter:
+    """
+    Returns the token counter of `model`, built once per model.
+    Models without a registered tokenizer are approximated.
+    """
+    model = (model or "").lower()
+    # Longest matching prefix wins
+    for prefix in sorted(_tokenizer_factories, key=len, reverse=True):
+        if model.startswith(prefix):
+            return _tokenizer_factories[prefix](model)
+    return approximate_tokens
+
+
+register_tokenizer("gpt", tiktoken_tokenizer)
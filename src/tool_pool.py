@@ -0,0 +1,255 @@
+# tool_pool.py
+
+import os
+import sys
+import json
+import time
+import select
+import inspect
+import hashlib
+import subprocess
+import threading
+from queue import Queue, Empty
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+# Absolute path, graph workers chdir into workspaces between jobs
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+TOOL_WORKER_SCRIPT = os.path.join(SRC_DIR, "tool_worker.py")
+
+# (TOOL node name, its code)
+ToolSources = List[Tuple[str, str]]
+
+
+class ToolError(RuntimeError):
+    """A tool raised, or its worker died, while running in the tool pool."""
+
+
+class ToolTimeout(ToolError, TimeoutError):
+    """A tool did not finish within the pool's timeout, its worker was killed."""
+
+
+def tool_sandbox_enabled() -> bool:
+    return os.environ.get("TOOL_SANDBOX", "1") == "1"
+
+
+def sources_key(sources: ToolSources) -> str:
+    return hashlib.sha256(json.dumps(sources).encode()).hexdigest()
+
+
+def tool_stub(name: str, params: Optional[List[List[Any]]]) -> Callable:
+    """
+    Stand-in for a tool that runs in the tool pool, with the tool's signature
+    (defaults replaced by None) so calls can be checked against it.
+    """
+    def stub(*args, **kwargs):
+        raise ToolError(f"Tool {name} runs in the tool pool, call it through the pool")
+
+    stub.__name__ = name
+    if params is not None:
+        stub.__signature__ = inspect.Signature([
+            inspect.Parameter(param, getattr(inspect.Parameter, kind), default=None if has_default else inspect.Parameter.empty)
+            for param, kind, has_default in params
+        ])
+    return stub
+
+
+class ToolWorker:
+    """
+    A tool_worker.py process. It keeps the tools of the last code it loaded,
+    so code is only sent again when the graph's tools changed.
+    """
+
+    def __init__(self, memory_mb: int):
+        self.process = subprocess.Popen(
+            [sys.executable, "-u", TOOL_WORKER_SCRIPT],
+            cwd=SRC_DIR,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            env=dict(os.environ, TOOL_MEMORY_LIMIT_MB=str(memory_mb)),
+        )
+        self.loaded: Optional[str] = None
+        # Answers not read yet, in the order of the requests
+        self._expected: List[str] = []
+        self._buffer = b""
+
+    @property
+    def alive(self) -> bool:
+        return self.process.poll() is None
+
+    def kill(self):
+        if self.alive:
+            self.process.kill()
+        self.process.wait()
+
+    def _send(self, message: Dict[str, Any], kind: str):
+        self.process.stdin.write((json.dumps(message) + "\n").encode())
+        self.process.stdin.flush()
+        self._expected.append(kind)
+
+    def _receive(self, deadline: float) -> Dict[str, Any]:
+        fd = self.process.stdout.fileno()
+        while b"\n" not in self._buffer:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not select.select([fd], [], [], remaining)[0]:
+                raise TimeoutError
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                raise EOFError
+            self._buffer += chunk
+        line, self._buffer = self._buffer.split(b"\n", 1)
+        return json.loads(line)
+
+    def load(self, sources: ToolSources, key: str):
+        """
+        Sends the tool code without waiting, the worker runs it while the caller goes on.
+        """
+        if self.loaded != key:
+            self._send({"load": sources}, "load")
+            self.loaded = key
+
+    def describe(self, sources: ToolSources, key: str, timeout: float) -> Dict[str, Dict[str, Any]]:
+        """
+        Loads `sources` and waits for the description of the tools they registered.
+        """
+        deadline = time.monotonic() + timeout
+        try:
+            # Sent even when the code is loaded already, the answer describes the tools
+            self._send({"load": sources}, "load")
+            self.loaded = key
+            while self._expected:
+                self._expected.pop(0)
+                response = self._receive(deadline)
+        except TimeoutError:
+            self.kill()
+            raise ToolTimeout(f"Loading the tool code did not finish within {timeout:g}s") from None
+        except (EOFError, BrokenPipeError):
+            self.kill()
+            raise ToolError(f"Loading the tool code ended its worker with exit code {self.process.returncode}") from None
+
+        if "error" in response:
+            self.loaded = None
+            raise ToolError(f"Loading the tool code failed: {response['error']}\n{response.get('traceback', '')}")
+        return response["tools"]
+
+    def call(self, sources: ToolSources, tool_name: str, args: List[Any], cwd: str, timeout: float) -> Any:
+        deadline = time.monotonic() + timeout
+        load_error = None
+        try:
+            self.load(sources, sources_key(sources))
+            self._send({"call": tool_name, "args": args, "cwd": cwd}, "call")
+            while True:
+                kind = self._expected.pop(0)
+                response = self._receive(deadline)
+                if kind == "load" and "error" in response:
+                    self.loaded = None
+                    load_error = response
+                if kind == "call":
+                    break
+        except TimeoutError:
+            self.kill()
+            raise ToolTimeout(f"Tool {tool_name} did not finish within {timeout:g}s") from None
+        except (EOFError, BrokenPipeError):
+            self.kill()
+            raise ToolError(f"Tool {tool_name} ended its worker with exit code {self.process.returncode}") from None
+
+        if response.get("exit"):
+            self.kill()  # the worker is on its way out, the pool starts another
+        if response.get("output"):
+            print(response["output"], end="", flush=True)
+        if load_error is not None:
+            raise ToolError(f"Loading the tool code failed: {load_error['error']}\n{load_error.get('traceback', '')}")
+        if "error" in response:
+            raise ToolError(f"Tool {tool_name} raised {response['error']}\n{response.get('traceback', '')}")
+        return response["result"]
+
+
+class ToolPool:
+    """
+    Runs TOOL node functions in up to `size` worker processes, outside the
+    graph's thread and event loop. A call that takes longer than `timeout`
+    seconds kills its worker, a new one takes its place; each worker may use
+    `memory_mb` MiB on top of its startup size (0: unlimited).
+    """
+
+    def __init__(self, size: Optional[int] = None, timeout: Optional[float] = None, memory_mb: Optional[int] = None):
+        self.size = size if size is not None else int(os.environ.get("TOOL_POOL_SIZE", 2))
+        self.timeout = timeout if timeout is not None else float(os.environ.get("TOOL_TIMEOUT", 60))
+        self.memory_mb = memory_mb if memory_mb is not None else int(os.environ.get("TOOL_MEMORY_LIMIT_MB", 1024))
+        self._idle: "Queue[ToolWorker]" = Queue()
+        # One slot per worker, callers beyond `size` wait for a free one
+        self._slots = threading.BoundedSemaphore(self.size)
+        # Tool descriptions by sources_key, the code is only run again when it changed
+        self._descriptions: Dict[str, Dict[str, Dict[str, Any]]] = {}
+
+    def _take(self) -> ToolWorker:
+        try:
+            worker = self._idle.get_nowait()
+        except Empty:
+            return ToolWorker(self.memory_mb)
+        if not worker.alive:
+            worker.kill()
+            return ToolWorker(self.memory_mb)
+        return worker
+
+    def _release(self, worker: ToolWorker):
+        if worker.alive:
+            self._idle.put(worker)
+        self._slots.release()
+
+    def preload(self, sources: ToolSources):
+        """
+        Starts the workers and loads `sources` into them ahead of the first call.
+        """
+        key = sources_key(sources)
+        workers = []
+        while len(workers) < self.size and self._slots.acquire(blocking=False):
+            workers.append(self._take())
+        for worker in workers:
+            worker.load(sources, key)
+            self._release(worker)
+
+    def describe(self, sources: ToolSources) -> Dict[str, Dict[str, Any]]:
+        """
+        Runs the code in `sources` in a tool worker, within the pool's timeout
+        and memory limit, and returns the tools it registered by name, each as
+        {"info": tool info, "params": parameters for tool_stub}.
+        """
+        key = sources_key(sources)
+        described = self._descriptions.get(key)
+        if described is not None:
+            return described
+
+        self._slots.acquire()
+        worker = self._take()
+        try:
+            described = worker.describe(sources, key, self.timeout)
+        finally:
+            self._release(worker)
+        if len(self._descriptions) >= 64:
+            self._descriptions.clear()
+        self._descriptions[key] = described
+        return described
+
+    def call(self, sources: ToolSources, tool_name: str, args: List[Any], cwd: str) -> Any:
+        """
+        Runs tool `tool_name` of the code in `sources` with `args` in directory `cwd`
+        and returns str() of its result. Blocks the calling thread only.
+        """
+        self._slots.acquire()
+        worker = self._take()
+        try:
+            return worker.call(sources, tool_name, args, cwd, self.timeout)
+        finally:
+            self._release(worker)
+
+
+# Workers exit when their stdin closes, together with the process that started them
+_tool_pool: Optional[ToolPool] = None
+_tool_pool_lock = threading.Lock()
+
+def get_tool_pool() -> ToolPool:
+    global _tool_pool
+    with _tool_pool_lock:
+        if _tool_pool is None:
+            _tool_pool = ToolPool()
+        return _tool_pool
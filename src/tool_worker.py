@@ -0,0 +1,113 @@
+# tool_worker.py
+
+import io
+import os
+import inspect
+import sys
+import json
+import traceback
+from contextlib import redirect_stdout
+from typing import Any, Callable, Dict, List
+
+
+def limit_memory(megabytes: int):
+    """
+    Caps the address space of this worker at its size after startup plus `megabytes`.
+    """
+    if megabytes <= 0:
+        return
+    try:
+        import resource
+    except ImportError:
+        return  # not on this platform
+
+    current = 0
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmSize:"):
+                    current = int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    limit = current + megabytes * 1024 * 1024
+    resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+def load_tools(sources: List[List[str]]) -> Dict[str, Callable]:
+    """
+    Runs the code of the TOOL nodes, (name, source) pairs, in WorkFlow.py's
+    globals as the graph worker does, and returns the tools it registered.
+    """
+    import WorkFlow
+
+    WorkFlow.reset_workflow_state()
+    for name, source in sources:
+        exec(compile(source, f"<tool {name}>", "exec"), vars(WorkFlow))
+    return dict(WorkFlow.tool_registry)
+
+
+def describe_tools(tools: Dict[str, Callable]) -> Dict[str, Dict[str, Any]]:
+    """
+    What the graph worker needs to prompt for and check a tool call: the tool
+    info of the @tool decorator and the parameters as (name, kind, has default).
+    """
+    import WorkFlow
+
+    described = {}
+    for name, func in tools.items():
+        try:
+            params = [
+                [param.name, param.kind.name, param.default is not param.empty]
+                for param in inspect.signature(func).parameters.values()
+            ]
+        except (TypeError, ValueError):
+            params = None  # no signature to check against
+        described[name] = {"info": WorkFlow.tool_info_registry.get(name, name), "params": params}
+    return described
+
+
+def call_tool(tools: Dict[str, Callable], message: Dict[str, Any]) -> Dict[str, Any]:
+    output = io.StringIO()
+    try:
+        os.chdir(message["cwd"])
+        with redirect_stdout(output):
+            result = tools[message["call"]](*message["args"])
+        return {"result": str(result), "output": output.getvalue()}
+    except MemoryError:
+        # Exit after answering, the pool starts a fresh worker
+        return {"error": "MemoryError: the tool ran out of memory", "output": output.getvalue(), "exit": True}
+    except Exception as e:
+        return {"error": f"{type(e).__name__}: {e}", "traceback": traceback.format_exc(), "output": output.getvalue()}
+
+
+def main():
+    # Answers go to the real stdout, anything else written to it ends up on stderr
+    channel = os.fdopen(os.dup(sys.stdout.fileno()), "w")
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+
+    # Tool code sees the globals it would see in the graph worker
+    import WorkFlow  # noqa: F401
+    limit_memory(int(os.environ.get("TOOL_MEMORY_LIMIT_MB", 0)))
+
+    tools: Dict[str, Callable] = {}
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        message = json.loads(line)
+        if "load" in message:
+            try:
+                tools = load_tools(message["load"])
+                response = {"loaded": len(tools), "tools": describe_tools(tools)}
+            except Exception as e:
+                response = {"error": f"{type(e).__name__}: {e}", "traceback": traceback.format_exc()}
+        else:
+            response = call_tool(tools, message)
+
+        channel.write(json.dumps(response) + "\n")
+        channel.flush()
+        if response.get("exit"):
+            break
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+# tracing.py
+
+import os
+import time
+import inspect
+import itertools
+import functools
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, Optional
+
+from util import emit_event
+
+# TRACING=0 turns the "trace" events of the run stream off
+TRACING = os.environ.get("TRACING", "1") == "1"
+
+# Span the running code belongs to, spans started inside it become its children
+_current_span: ContextVar[Optional[Dict[str, Any]]] = ContextVar("current_span", default=None)
+_span_ids = itertools.count(1)
+
+
+@contextmanager
+def span(kind: str, name: str, **attributes):
+    """
+    Times the block and emits it as a "trace" event when it ends:
+    {"id", "parent", "depth", "kind", "name", "duration_ms", "status", **attributes}.
+    The yielded dict takes more attributes while the block runs.
+    """
+    if not TRACING:
+        yield attributes
+        return
+
+    parent = _current_span.get()
+    record = {
+        "id": next(_span_ids),
+        "parent": parent["id"] if parent else None,
+        "depth": parent["depth"] + 1 if parent else 0,
+        "kind": kind,
+        "name": name,
+    }
+    token = _current_span.set(record)
+    start = time.perf_counter()
+    status = "ok"
+    try:
+        yield attributes
+    except BaseException:
+        status = "error"
+        raise
+    finally:
+        _current_span.reset(token)
+        record["duration_ms"] = round((time.perf_counter() - start) * 1000, 3)
+        record["status"] = status
+        record.update(attributes)
+        emit_event("trace", record)
+
+
+def annotate(**attributes):
+    """
+    Adds attributes to the span the running code belongs to.
+    """
+    record = _current_span.get()
+    if record is not None:
+        record.update(attributes)
+
+
+def traced_node(node_type: str) -> Callable:
+    """
+    Decorator for the node functions of WorkFlow.py, whose first argument is
+    the node name: every call becomes a "node" span of type `node_type`.
+    """
+    def decorator(func: Callable) -> Callable:
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(name, *args, **kwargs):
+                with span("node", name, node_type=node_type):
+                    return await func(name, *args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(name, *args, **kwargs):
+            with span("node", name, node_type=node_type):
+                return func(name, *args, **kwargs)
+        return wrapper
+    return decorator
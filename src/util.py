@@ -1,5 +1,19 @@
 import sys
 import os
+import json
+from typing import Any, NamedTuple
+
+# Lines starting with this marker carry a structured event instead of plain output,
+# ProcessHandler turns them into their own SSE event type
+EVENT_PREFIX = "@@EVENT "
+
+
+class StreamEvent(NamedTuple):
+    """
+    Structured output of a run, such as streamed LLM tokens, sent as its own SSE event type.
+    """
+    event: str
+    data: Any
 
 def flush_print(*args, **kwargs):
     output = ""
@@ -8,4 +22,22 @@ def flush_print(*args, **kwargs):
     
     output = output.replace("\n", "\\n")
     print(output, **kwargs)
-    sys.stdout.flush()
\ No newline at end of file
+    sys.stdout.flush()
+
+
+def emit_event(event: str, data) -> None:
+    print(EVENT_PREFIX + json.dumps({"event": event, "data": data}))
+    sys.stdout.flush()
+
+
+def parse_event(line: str):
+    """
+    Returns (event, data) of a line written by emit_event, None for plain output.
+    """
+    if not line.startswith(EVENT_PREFIX):
+        return None
+    try:
+        payload = json.loads(line[len(EVENT_PREFIX):])
+    except ValueError:
+        return None
+    return payload.get("event"), payload.get("data")
@@ -0,0 +1,197 @@
+# worker_pool.py
+
+import os
+import sys
+import json
+import asyncio
+from typing import Awaitable, Callable, Optional
+
+# Absolute path, workers may chdir into workspaces between jobs
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+WORKER_SCRIPT = os.path.join(SRC_DIR, "graph_worker.py")
+
+# Lines of a run can hold a whole clipped history, allow more than asyncio's 64 KiB
+STREAM_LIMIT = 1024 * 1024
+
+# Marker graph_worker.py prints on stdout when a job finishes, followed by its exit code
+JOB_DONE = "__LANGGRAPH_GUI_JOB_DONE__"
+
+OutputCallback = Callable[[str, str], Awaitable[None]]
+
+
+async def read_line(stream: asyncio.StreamReader) -> bytes:
+    """
+    Next line of `stream`, b"" at the end. A line longer than STREAM_LIMIT is
+    cut off there instead of failing the read, the rest of it is skipped.
+    """
+    try:
+        return await stream.readuntil(b"\n")
+    except asyncio.IncompleteReadError as e:
+        return e.partial
+    except asyncio.LimitOverrunError as e:
+        head = await stream.readexactly(e.consumed)
+
+    while True:
+        try:
+            await stream.readuntil(b"\n")
+            break
+        except asyncio.IncompleteReadError:
+            break
+        except asyncio.LimitOverrunError as e:
+            await stream.readexactly(e.consumed)
+    return head + b" [line truncated]\n"
+
+
+class PoolWorker:
+    def __init__(self, process):
+        self.process = process
+        self.jobs = 0
+        self.on_output: Optional[OutputCallback] = None
+        self.stderr_task = None
+        # Set when the stderr pump read the JOB_DONE graph_worker.py writes to stderr after a job
+        self.stderr_done = asyncio.Event()
+
+    @property
+    def alive(self) -> bool:
+        return self.process.returncode is None
+
+    async def pump_stderr(self):
+        while True:
+            line = await read_line(self.process.stderr)
+            if not line:
+                break
+            text = line.decode(errors="replace").strip()
+            if text == JOB_DONE:
+                self.stderr_done.set()
+                continue
+            if not text:
+                continue
+            if self.on_output is not None:
+                try:
+                    await self.on_output("STDERR: ", text)
+                except Exception as e:
+                    print(f"STDERR: {text} (not forwarded: {e})", flush=True)
+            else:
+                print(f"STDERR: {text}", flush=True)
+
+
+class WorkerPool:
+    """
+    Keeps `size` pre-started graph_worker.py processes with langchain and
+    langgraph already imported. Each job runs in one idle worker, which is
+    recycled after `max_jobs` jobs or as soon as it dies.
+    """
+
+    def __init__(self, size: Optional[int] = None, max_jobs: Optional[int] = None):
+        self.size = size if size is not None else int(os.environ.get("WORKER_POOL_SIZE", 2))
+        self.max_jobs = max_jobs if max_jobs is not None else int(os.environ.get("WORKER_MAX_JOBS", 50))
+        self._idle = asyncio.Queue()
+        self._workers = set()
+        self._closed = False
+
+    async def start(self):
+        for _ in range(self.size):
+            await self._idle.put(await self._spawn())
+
+    async def close(self):
+        self._closed = True
+        for worker in list(self._workers):
+            await self._retire(worker)
+
+    async def _spawn(self) -> PoolWorker:
+        process = await asyncio.create_subprocess_exec(
+            sys.executable, "-u", WORKER_SCRIPT,
+            cwd=SRC_DIR,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            limit=STREAM_LIMIT
+        )
+        worker = PoolWorker(process)
+        worker.stderr_task = asyncio.create_task(worker.pump_stderr())
+        self._workers.add(worker)
+        return worker
+
+    async def _retire(self, worker: PoolWorker):
+        self._workers.discard(worker)
+        if worker.alive:
+            worker.process.stdin.close()
+            try:
+                await asyncio.wait_for(worker.process.wait(), timeout=5)
+            except asyncio.TimeoutError:
+                worker.process.kill()
+                await worker.process.wait()
+        await asyncio.gather(worker.stderr_task, return_exceptions=True)
+
+    async def _replace(self, worker: PoolWorker):
+        await self._retire(worker)
+        if not self._closed:
+            await self._idle.put(await self._spawn())
+
+    async def _release(self, worker: PoolWorker, finished: bool):
+        worker.on_output = None
+        if self._closed or not finished or not worker.alive or worker.jobs >= self.max_jobs:
+            # Recycle in the background so the caller gets its result right away
+            asyncio.create_task(self._replace(worker))
+        else:
+            await self._idle.put(worker)
+
+    def try_reserve(self) -> Optional[PoolWorker]:
+        """
+        Takes an idle worker out of the pool without waiting, None if all are busy.
+        Pass it to run_job, or give it back with unreserve.
+        """
+        try:
+            return self._idle.get_nowait()
+        except asyncio.QueueEmpty:
+            return None
+
+    def unreserve(self, worker: PoolWorker):
+        self._idle.put_nowait(worker)
+
+    async def run_job(self, job: dict, on_output: OutputCallback, worker: Optional[PoolWorker] = None) -> int:
+        """
+        Sends a job to `worker`, reserved by try_reserve, or else to the next idle
+        worker, and forwards its output lines to `on_output(prefix, line)` until
+        the job finishes. Returns the exit code.
+        A worker whose job ended in any other way is killed and replaced, it
+        must not hand what is left of this job to the next one.
+        """
+        if worker is None:
+            worker = await self._idle.get()
+        worker.on_output = on_output
+        worker.stderr_done.clear()
+        finished = False
+        try:
+            worker.process.stdin.write((json.dumps(job) + "\n").encode())
+            await worker.process.stdin.drain()
+
+            held_blank = False
+            while True:
+                line = await read_line(worker.process.stdout)
+                if not line:
+                    # Worker died in the middle of the job
+                    return await worker.process.wait()
+
+                text = line.decode(errors="replace").strip()
+                if text.startswith(JOB_DONE):
+                    # Forward the rest of the job's stderr before the worker takes the next job
+                    try:
+                        await asyncio.wait_for(worker.stderr_done.wait(), timeout=5)
+                        finished = True
+                    except asyncio.TimeoutError:
+                        pass
+                    return int(text[len(JOB_DONE):])
+
+                # The worker writes a blank line right before JOB_DONE, only
+                # forward blank lines once we know they are real output
+                if held_blank:
+                    await on_output("STDOUT: ", "")
+                held_blank = not text
+                if text:
+                    await on_output("STDOUT: ", text)
+        finally:
+            worker.jobs += 1
+            if not finished and worker.alive:
+                worker.process.kill()
+            await self._release(worker, finished)
@@ -0,0 +1,124 @@
+# workspace_index.py
+
+import os
+import json
+import hashlib
+import tempfile
+from threading import Lock
+from typing import Dict, List, Optional
+
+from zip_stream import list_files
+
+# Outside the workspaces, so an index never lists or downloads itself;
+# next to the sources, whatever directory the server was started from
+WORKSPACE_INDEX_DIR = os.environ.get(
+    "WORKSPACE_INDEX_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "workspace_index")
+)
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# One lock per user, two requests must not rewrite the same index at once
+_index_locks: Dict[str, Lock] = {}
+_index_locks_lock = Lock()
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(HASH_CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def index_lock(username: str) -> Lock:
+    with _index_locks_lock:
+        if username not in _index_locks:
+            _index_locks[username] = Lock()
+        return _index_locks[username]
+
+
+class WorkspaceIndex:
+    """
+    Manifest of a workspace (path, size, mtime and sha256 of every file) kept
+    in `<WORKSPACE_INDEX_DIR>/<username>.json`. A file is hashed again only when
+    its size or mtime changed since the index saw it.
+    """
+
+    def __init__(self, username: str, workspace: str, directory: Optional[str] = None):
+        self.username = username
+        self.workspace = workspace
+        self.path = os.path.join(directory or WORKSPACE_INDEX_DIR, f"{username}.json")
+
+    def _load(self) -> Dict[str, dict]:
+        try:
+            with open(self.path, "r") as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def _save(self, files: Dict[str, dict]):
+        directory = os.path.dirname(self.path)
+        os.makedirs(directory, exist_ok=True)
+        with tempfile.NamedTemporaryFile("w", dir=directory, delete=False, suffix=".tmp") as f:
+            json.dump(files, f)
+        os.replace(f.name, self.path)
+
+    def manifest(self) -> List[dict]:
+        """
+        Up to date manifest of the workspace, sorted by path. Blocking, hashes changed files.
+        """
+        with index_lock(self.username):
+            known = self._load()
+            files = {}
+            for path, size, mtime in list_files(self.workspace):
+                entry = known.get(path)
+                if entry is None or entry["size"] != size or entry["mtime_ns"] != mtime:
+                    try:
+                        sha256 = file_sha256(os.path.join(self.workspace, path))
+                    except FileNotFoundError:
+                        continue  # deleted meanwhile
+                    entry = {"size": size, "mtime_ns": mtime, "sha256": sha256}
+                files[path] = entry
+
+            if files != known:
+                self._save(files)
+        return [{"path": path, "size": entry["size"], "mtime": entry["mtime_ns"] / 1e9, "sha256": entry["sha256"]}
+                for path, entry in sorted(files.items())]
+
+    def record(self, path: str, sha256: str):
+        """
+        Adds a file whose hash is already known, e.g. from an upload, without reading it again.
+        """
+        stat = os.stat(os.path.join(self.workspace, path))
+        with index_lock(self.username):
+            files = self._load()
+            files[path] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": sha256}
+            self._save(files)
+
+
+def plan_sync(server_files: List[dict], client_files: List[dict]) -> Dict[str, List[str]]:
+    """
+    Compares the server manifest with the manifest a client sent and tells
+    which paths the client should download and which it should upload.
+    A path that differs goes from the side that changed it last,
+    the client when it sent no mtime.
+    """
+    server = {entry["path"]: entry for entry in server_files}
+    client = {entry["path"]: entry for entry in client_files}
+    download, upload = [], []
+
+    for path, entry in server.items():
+        theirs = client.get(path)
+        if theirs is None:
+            download.append(path)
+        elif theirs.get("sha256") != entry["sha256"]:
+            if theirs.get("mtime") is not None and theirs["mtime"] < entry["mtime"]:
+                download.append(path)
+            else:
+                upload.append(path)
+
+    upload.extend(path for path in client if path not in server)
+    return {"download": sorted(download), "upload": sorted(upload)}
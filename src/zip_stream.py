@@ -0,0 +1,119 @@
+# zip_stream.py
+
+import os
+import io
+import hashlib
+import zipfile
+from typing import Iterator, List, Tuple
+
+# Read size of the files going into an archive, also about the size of the chunks it is sent in
+ZIP_CHUNK_SIZE = 64 * 1024
+
+# Compressing these again costs CPU and saves next to nothing, they are stored as they are
+COMPRESSED_EXTENSIONS = {
+    ".zip", ".gz", ".tgz", ".bz2", ".xz", ".7z", ".rar", ".zst",
+    ".png", ".jpg", ".jpeg", ".gif", ".webp",
+    ".mp3", ".mp4", ".ogg", ".webm", ".mkv",
+    ".docx", ".xlsx", ".pptx", ".whl", ".jar",
+}
+
+# Files of an upload still in progress, FileTransmit moves them into place once complete
+UPLOAD_TEMP_PREFIX = ".upload-"
+
+# (path relative to the root, size, mtime in ns) of every file of a directory
+FileEntry = Tuple[str, int, int]
+
+
+class ZipChunkBuffer(io.RawIOBase):
+    """
+    Write-only, unseekable file zipfile writes into. The archive is handed on
+    chunk by chunk with `take`, so only the latest chunk is ever in memory.
+    """
+
+    def __init__(self):
+        self._chunks: List[bytes] = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def take(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def list_files(root: str) -> List[FileEntry]:
+    entries = []
+    for dirpath, dirs, files in os.walk(root):
+        for file in files:
+            if file.startswith(UPLOAD_TEMP_PREFIX):
+                continue  # not a workspace file yet
+            path = os.path.join(dirpath, file)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue  # deleted meanwhile
+            entries.append((os.path.relpath(path, root), stat.st_size, stat.st_mtime_ns))
+    entries.sort()
+    return entries
+
+
+def files_etag(entries: List[FileEntry]) -> str:
+    """
+    Weak ETag of a directory listing, it changes whenever a file is added,
+    removed, resized or touched.
+    """
+    digest = hashlib.sha256()
+    for path, size, mtime in entries:
+        digest.update(f"{path}\0{size}\0{mtime}\n".encode())
+    return f'W/"{digest.hexdigest()[:32]}"'
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    # Weak comparison, the W/ prefix does not count
+    tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return etag.removeprefix("W/") in tags
+
+
+def iter_zip(root: str, entries: List[FileEntry], store_compressed: bool = True) -> Iterator[bytes]:
+    """
+    Yields a zip archive of the `entries` files under `root` while it is being written.
+    With `store_compressed` files that are compressed already are stored, not deflated.
+    """
+    buffer = ZipChunkBuffer()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as zip_file:
+        for arcname, size, mtime in entries:
+            path = os.path.join(root, arcname)
+            try:
+                source = open(path, "rb")
+            except FileNotFoundError:
+                continue  # deleted since the listing
+
+            with source:
+                info = zipfile.ZipInfo.from_file(path, arcname)
+                stored = store_compressed and os.path.splitext(arcname)[1].lower() in COMPRESSED_EXTENSIONS
+                info.compress_type = zipfile.ZIP_STORED if stored else zipfile.ZIP_DEFLATED
+                with zip_file.open(info, "w") as target:
+                    while True:
+                        data = source.read(ZIP_CHUNK_SIZE)
+                        if not data:
+                            break
+                        target.write(data)
+                        chunk = buffer.take()
+                        if chunk:
+                            yield chunk
+            chunk = buffer.take()
+            if chunk:
+                yield chunk
+    # Central directory, written when the archive is closed
+    chunk = buffer.take()
+    if chunk:
+        yield chunk
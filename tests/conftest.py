@@ -0,0 +1,7 @@
+# conftest.py
+
+import os
+import sys
+
+# The server modules import each other by name from src/, as when run from there
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
@@ -0,0 +1,92 @@
+# test_broadcast.py
+
+import asyncio
+
+from broadcast import BLOCK, END_OF_STREAM, Broadcaster
+
+
+def drain(subscriber):
+    items = []
+    while not subscriber.queue.empty():
+        items.append(subscriber.queue.get_nowait())
+    return items
+
+
+def test_drop_oldest_counts_dropped_items():
+    async def main():
+        broadcaster = Broadcaster(maxsize=3)
+        slow = broadcaster.subscribe()
+        for i in range(5):
+            await broadcaster.publish(i)
+        assert drain(slow) == [2, 3, 4]
+        assert slow.take_dropped() == 2
+        assert slow.take_dropped() == 0
+
+    asyncio.run(main())
+
+
+def test_each_subscriber_has_its_own_buffer():
+    async def main():
+        broadcaster = Broadcaster(maxsize=2)
+        fast, slow = broadcaster.subscribe(), broadcaster.subscribe()
+        await broadcaster.publish(1)
+        assert await fast.get() == 1
+        await broadcaster.publish(2)
+        await broadcaster.publish(3)
+        assert drain(fast) == [2, 3]
+        assert fast.take_dropped() == 0
+        assert drain(slow) == [2, 3]
+        assert slow.take_dropped() == 1
+
+    asyncio.run(main())
+
+
+def test_block_waits_for_the_reader_then_drops():
+    async def main():
+        broadcaster = Broadcaster(maxsize=1, policy=BLOCK, block_timeout=0.05)
+        subscriber = broadcaster.subscribe()
+        await broadcaster.publish(1)
+
+        # The reader catches up within the timeout, nothing is lost
+        publish = asyncio.create_task(broadcaster.publish(2))
+        await asyncio.sleep(0.01)
+        assert await subscriber.get() == 1
+        await publish
+        assert drain(subscriber) == [2]
+
+        # The reader does not, the oldest item goes
+        await broadcaster.publish(3)
+        await broadcaster.publish(4)
+        assert drain(subscriber) == [4]
+        assert subscriber.take_dropped() == 1
+
+    asyncio.run(main())
+
+
+def test_publish_nowait_and_close():
+    async def main():
+        broadcaster = Broadcaster(maxsize=2)
+        subscriber = broadcaster.subscribe()
+        for i in range(3):
+            broadcaster.publish_nowait(i)
+        broadcaster.close()
+        # The end of the stream always gets through, at the cost of old items
+        assert drain(subscriber) == [2, END_OF_STREAM]
+        assert subscriber.take_dropped() == 2
+        assert broadcaster.subscriber_count == 0
+
+    asyncio.run(main())
+
+
+def test_unsubscribe_wakes_a_blocked_publisher():
+    async def main():
+        broadcaster = Broadcaster(maxsize=1, policy=BLOCK, block_timeout=5)
+        subscriber = broadcaster.subscribe()
+        await broadcaster.publish(1)
+        publish = asyncio.create_task(broadcaster.publish(2))
+        await asyncio.sleep(0.01)
+        broadcaster.unsubscribe(subscriber)
+        await asyncio.wait_for(publish, 1)
+        assert broadcaster.subscriber_count == 0
+
+    asyncio.run(main())
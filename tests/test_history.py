@@ -0,0 +1,96 @@
+# test_history.py
+
+from history import History, merge_history
+
+
+def words(text: str) -> int:
+    return len(text.split())
+
+
+def test_render_matches_appended_strings():
+    history = History(["a", "b"]).appended("c").appended(["d", "e"])
+    assert history.render() == "\na\nb\nc\nd\ne"
+    assert str(history) == history.render()
+    assert len(history) == 5
+    assert history.size == len(history.render())
+
+
+def test_appended_leaves_the_original_alone():
+    first = History(["a"])
+    second = first.appended("b")
+    assert list(first) == ["a"]
+    assert list(second) == ["a", "b"]
+    assert first.appended([]) is first
+
+
+def test_evicts_whole_entries_past_max_chars():
+    history = History(max_chars=10)
+    for entry in ["aaa", "bbb", "ccc", "ddd"]:
+        history = history.appended(entry)
+    # Every entry renders as 4 chars, two fit in 10
+    assert list(history) == ["ccc", "ddd"]
+    assert history.size <= 10
+    assert history.render() == "\nccc\nddd"
+    assert history.seq == 4
+
+
+def test_evicts_past_max_tokens():
+    history = History(["one two", "three four", "five six"], max_chars=None, max_tokens=4, count_tokens=words)
+    assert list(history) == ["three four", "five six"]
+    assert history.tokens == 4
+
+
+def test_oversized_entry_keeps_its_tail():
+    history = History(["x" * 5 + "tail"], max_chars=5)
+    assert list(history) == ["tail"]
+    assert history.size == 5
+
+
+def test_cached_rendering_after_eviction():
+    history = History(["aaa", "bbb"], max_chars=8)
+    history.render()
+    history = history.appended("ccc")
+    assert history.render() == "\nbbb\nccc"
+
+
+def test_entries_since():
+    history = History(["a", "b"])
+    seq = history.seq
+    history = history.appended(["c", "d"])
+    assert history.entries_since(seq) == ["c", "d"]
+    assert history.entries_since(history.seq) == []
+
+
+def test_snapshot_and_restored():
+    history = History(["one", "two three"], max_chars=100, max_tokens=50, count_tokens=words)
+    restored = History.restored(history.snapshot(), words)
+    assert list(restored) == list(history)
+    assert restored.tokens == history.tokens
+    assert restored.seq == history.seq
+    assert restored.render() == history.render()
+
+
+def test_fit_summarizes_older_entries_once():
+    calls = []
+
+    def summarize(text: str) -> str:
+        calls.append(text)
+        return "summary"
+
+    history = History(["a b", "c d", "e f", "g h"], max_chars=None, count_tokens=words)
+    assert history.fit(100, summarize) == history.render()
+    assert history.fit(4, summarize) == "\nsummary\ng h"
+    assert calls == ["a b\nc d\ne f"]
+    # The summary is handed on, a small addition does not ask again
+    assert history.appended("i").fit(5, summarize) == "\nsummary\ng h\ni"
+    assert len(calls) == 1
+
+
+def test_merge_history():
+    history = History(["a"])
+    assert merge_history(history, None) is history
+    assert list(merge_history(history, "b")) == ["a", "b"]
+    assert list(merge_history(history, ["b", "c"])) == ["a", "b", "c"]
+    replacement = History(["z"])
+    assert merge_history(history, replacement) is replacement
+    assert list(merge_history(None, "a")) == ["a"]
@@ -0,0 +1,30 @@
+# test_metrics.py
+
+from metrics import Metrics, escape_label_value, format_labels, render_prometheus
+
+
+def test_escape_label_value():
+    assert escape_label_value('a"b') == 'a\\"b'
+    assert escape_label_value("a\\b") == "a\\\\b"
+    assert escape_label_value("a\nb") == "a\\nb"
+    assert escape_label_value('\\"\n') == '\\\\\\"\\n'
+    assert escape_label_value("gpt-4o-mini") == "gpt-4o-mini"
+
+
+def test_format_labels():
+    assert format_labels(("model", "cached"), ('fake:"x"', "true")) == '{model="fake:\\"x\\"",cached="true"}'
+    assert format_labels(("model",), ("m",), 'le="+Inf"') == '{model="m",le="+Inf"}'
+    assert format_labels((), ()) == ""
+
+
+def test_render_prometheus_escapes_user_supplied_model(tmp_path):
+    metrics = Metrics(directory=str(tmp_path))
+    model = 'fake:"evil"\\\n} 1\nlanggraph_injected 2'
+    metrics.observe("langgraph_llm_prompt_chars", (model,), 100)
+
+    text = render_prometheus(metrics.series, {"langgraph_runs_running": ("Runs running", 1)})
+    lines = text.splitlines()
+    assert not any(line.startswith("langgraph_injected") for line in lines)
+    count = [line for line in lines if line.startswith("langgraph_llm_prompt_chars_count")]
+    assert count == ['langgraph_llm_prompt_chars_count{model="fake:\\"evil\\"\\\\\\n} 1\\nlanggraph_injected 2"} 1']
+    assert "langgraph_runs_running 1" in lines
@@ -0,0 +1,112 @@
+# test_run_log.py
+
+import asyncio
+import os
+import time
+
+import pytest
+
+from run_log import RunLog, follow_run_log, new_run_id, prune_run_logs, replay_run_log
+from util import StreamEvent
+
+
+def collect(outputs):
+    async def main():
+        return [item async for item in outputs]
+    return asyncio.run(main())
+
+
+@pytest.fixture
+def run_log(tmp_path):
+    log = RunLog(new_run_id(), str(tmp_path))
+    log.open_for_append()
+    yield log
+    log.close()
+
+
+def test_rejects_invalid_run_ids(tmp_path):
+    with pytest.raises(ValueError):
+        RunLog("../etc/passwd", str(tmp_path))
+
+
+def test_append_and_read_batch(run_log):
+    outputs = ["STDOUT: a", StreamEvent("node", {"name": "x"}), "STDOUT: b", {"status": "success", "message": ""}]
+    assert [run_log.append(output) for output in outputs] == [0, 1, 2, 3]
+    run_log.sync()
+
+    assert run_log.read_batch(-1) == list(enumerate(outputs))
+    assert run_log.read_batch(1) == [(2, "STDOUT: b"), (3, outputs[3])]
+    assert run_log.read_batch(0, limit=2) == [(1, outputs[1]), (2, "STDOUT: b")]
+    assert run_log.read_batch(3) == []
+    assert run_log.last_event_id() == 3
+
+
+def test_reopened_log_continues_the_ids(tmp_path, run_log):
+    run_log.append("first")
+    run_log.close()
+    again = RunLog(run_log.run_id, str(tmp_path))
+    again.open_for_append()
+    assert again.append("second") == 1
+    again.close()
+    assert again.read_batch(-1) == [(0, "first"), (1, "second")]
+
+
+def test_close_writes_out_queued_records(tmp_path, run_log):
+    for i in range(1000):
+        run_log.append(f"line {i}")
+    run_log.close()
+    reader = RunLog(run_log.run_id, str(tmp_path))
+    assert reader.exists()
+    assert reader.last_event_id() == 999
+    assert reader.read_batch(997) == [(998, "line 998"), (999, "line 999")]
+
+
+def test_replay_run_log_reads_past_one_batch(run_log):
+    for i in range(1200):
+        run_log.append(i)
+    run_log.sync()
+    replayed = collect(replay_run_log(run_log, 99))
+    assert [event_id for event_id, _ in replayed] == list(range(100, 1200))
+    assert replayed[-1] == (1199, 1199)
+
+
+def test_follow_run_log_stops_at_the_final_status(tmp_path, run_log):
+    run_log.append("before")
+    run_log.sync()
+
+    async def main():
+        async def write_later():
+            await asyncio.sleep(0.05)
+            run_log.append("after")
+            run_log.append({"status": "success", "message": ""})
+            await asyncio.to_thread(run_log.sync)
+
+        writer = asyncio.create_task(write_later())
+        reader = RunLog(run_log.run_id, str(tmp_path))
+        followed = [item async for item in follow_run_log(reader, 0, lambda: True, poll_interval=0.01)]
+        await writer
+        return followed
+
+    assert asyncio.run(main()) == [(1, "after"), (2, {"status": "success", "message": ""})]
+
+
+def test_follow_run_log_stops_when_the_run_is_gone(tmp_path, run_log):
+    run_log.append("only")
+    run_log.sync()
+    reader = RunLog(run_log.run_id, str(tmp_path))
+    assert collect(follow_run_log(reader, -1, lambda: False)) == [(0, "only")]
+
+
+def test_prune_run_logs(tmp_path, run_log):
+    run_log.append("x")
+    run_log.close()
+    other = tmp_path / "registry.sqlite"
+    other.write_text("")
+    old = time.time() - 7200
+    for path in (run_log.log_path, run_log.index_path, str(other)):
+        os.utime(path, (old, old))
+
+    prune_run_logs(3600, str(tmp_path))
+    assert not run_log.exists()
+    assert not os.path.exists(run_log.log_path)
+    assert other.exists()
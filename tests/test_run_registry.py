@@ -0,0 +1,91 @@
+# test_run_registry.py
+
+import pytest
+
+from run_registry import RunRegistry
+
+
+def run_id(n: int) -> str:
+    return f"{n:032x}"
+
+
+@pytest.fixture
+def registry(tmp_path):
+    return RunRegistry(str(tmp_path / "registry.sqlite"))
+
+
+def queue(registry, *users):
+    # Queued in this order, one second apart
+    for n, username in enumerate(users, 1):
+        assert registry.claim(username, run_id(n), "queued", quota=10)
+        registry._conn.execute("UPDATE runs SET created = ? WHERE run_id = ?", (1000.0 + n, run_id(n)))
+
+
+def test_claim_applies_the_user_quota(registry):
+    assert registry.claim("alice", run_id(1))
+    assert not registry.claim("alice", run_id(2))
+    assert registry.claim("bob", run_id(3))
+    assert registry.claim("alice", run_id(4), "queued", quota=2)
+
+    assert registry.active_run("alice")["run_id"] == run_id(4)
+    assert registry.is_active(run_id(1))
+
+    registry.finish(run_id(1), "success", "done")
+    run = registry.get(run_id(1))
+    assert (run["status"], run["message"]) == ("success", "done")
+    assert not registry.is_active(run_id(1))
+    # Run 4 still counts against the quota
+    assert not registry.claim("alice", run_id(5))
+    assert registry.claim("alice", run_id(5), quota=2)
+
+
+def test_try_admit_fifo(registry):
+    queue(registry, "a", "b", "c")
+    assert registry.queue_position(run_id(2)) == 2
+    # Only one slot: the head of the queue starts, the others keep their places
+    assert registry.try_admit(run_id(2), max_running=1) == 2
+    assert registry.try_admit(run_id(1), max_running=1) == 0
+    assert registry.get(run_id(1))["started"] is not None
+    assert registry.try_admit(run_id(2), max_running=1) == 1
+    assert registry.queue_position(run_id(1)) == 0
+
+    registry.finish(run_id(1), "success")
+    assert registry.try_admit(run_id(3), max_running=1) == 2
+    assert registry.try_admit(run_id(2), max_running=1) == 0
+
+
+def test_try_admit_with_free_slots_skips_ahead(registry):
+    queue(registry, "a", "b")
+    # Position 2 fits in 2 free slots even though 1 has not started yet
+    assert registry.try_admit(run_id(2), max_running=2) == 0
+    assert registry.queue_position(run_id(1)) == 1
+
+
+def test_fair_policy_prefers_users_without_running_runs(registry):
+    queue(registry, "a", "a", "b")
+    assert registry.try_admit(run_id(1), max_running=3, policy="fair") == 0
+    # a already runs one, b's later run goes first
+    assert registry.queue_position(run_id(3), "fair") == 1
+    assert registry.queue_position(run_id(2), "fair") == 2
+    assert registry.queue_position(run_id(2), "fifo") == 1
+
+
+def test_runs_of_dead_workers_are_reaped(registry):
+    queue(registry, "a", "b")
+    assert registry.try_admit(run_id(1), max_running=1) == 0
+    # The owner of run 1 went away, its pid taken by another process
+    registry._conn.execute("UPDATE runs SET owner_token = 'other boot:1' WHERE run_id = ?", (run_id(1),))
+
+    assert registry.try_admit(run_id(2), max_running=1) == 0
+    run = registry.get(run_id(1))
+    assert run["status"] == "error"
+    assert "exited" in run["message"]
+    assert registry.active_run("a") is None
+
+
+def test_queue_stats(registry):
+    queue(registry, "a", "b")
+    registry.try_admit(run_id(1), max_running=1)
+    stats = registry.queue_stats()
+    assert (stats["queued"], stats["running"], stats["started"]) == (1, 1, 1)
+    assert stats["wait_seconds_max"] > 0
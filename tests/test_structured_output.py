@@ -0,0 +1,74 @@
+# test_structured_output.py
+
+import json
+
+import pytest
+
+from structured_output import OutputError, json_candidate, parse_json, parse_switch, parse_tool_call, repair_json
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("{'a': 'b'}", {"a": "b"}),
+    ("{a: 1, b: 'x'}", {"a": 1, "b": "x"}),
+    ("{'a': True, 'b': False, 'c': None}", {"a": True, "b": False, "c": None}),
+    ("{'a': [1, 2,],}", {"a": [1, 2]}),
+    ('{"a": {"b": [1, 2', {"a": {"b": [1, 2]}}),
+    ("{'it\\'s': 'say \"hi\"'}", {"it's": 'say "hi"'}),
+    ('{"a": "cut off', {"a": "cut off"}),
+])
+def test_repair_json(text, expected):
+    assert parse_json(text) == expected
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("{'a': 1e5}", {"a": 1e5}),
+    ('{"a": -1.5E-3, b: None}', {"a": -1.5e-3, "b": None}),
+    ("{a: +2, b: .5, c: 1., d: -7}", {"a": 2, "b": 0.5, "c": 1.0, "d": -7}),
+    ("{a: x1e5, b: e5}", {"a": "x1e5", "b": "e5"}),
+    ("{'a': [1e3, 2E+2]}", {"a": [1000.0, 200.0]}),
+])
+def test_repair_json_numbers(text, expected):
+    assert parse_json(text) == expected
+
+
+def test_repair_json_keeps_valid_json():
+    text = '{"a": [1, 2.5, -3e2], "b": {"c": null}, "d": "x, y"}'
+    assert json.loads(repair_json(text)) == json.loads(text)
+
+
+def test_json_candidate():
+    assert json_candidate('Sure!\n```json\n{"a": 1}\n```\nDone.') == '{"a": 1}'
+    assert json_candidate('The answer is {"a": 1} as asked') == '{"a": 1}'
+    assert json_candidate('"function": "add", "args": [1, 2],') == '{"function": "add", "args": [1, 2]}'
+    assert json_candidate("no structure at all") is None
+
+
+def test_parse_json_without_json():
+    with pytest.raises(OutputError):
+        parse_json("I cannot help with that")
+
+
+def test_parse_tool_call():
+    def add(a, b):
+        return a + b
+
+    tools = {"add": add}
+    assert parse_tool_call("{'function': 'add', 'args': [1, 2]}", tools) == ("add", [1, 2])
+    with pytest.raises(OutputError, match="no tool"):
+        parse_tool_call('{"function": "sub", "args": []}', tools)
+    with pytest.raises(OutputError, match="wrong arguments"):
+        parse_tool_call('{"function": "add", "args": [1]}', tools)
+
+
+@pytest.mark.parametrize("text, expected", [
+    ('{"switch": true}', True),
+    ("{switch: False}", False),
+    ('{"switch": "True"}', True),
+])
+def test_parse_switch(text, expected):
+    assert parse_switch(text) is expected
+
+
+def test_parse_switch_rejects_other_values():
+    with pytest.raises(OutputError):
+        parse_switch('{"switch": "maybe"}')
@@ -0,0 +1,94 @@
+# test_workspace_sync.py
+
+import io
+import os
+import zipfile
+
+from workspace_index import WorkspaceIndex, file_sha256, plan_sync
+from zip_stream import etag_matches, files_etag, iter_zip, list_files
+
+
+def entry(path: str, sha256: str, mtime: float = 100.0) -> dict:
+    return {"path": path, "size": 1, "mtime": mtime, "sha256": sha256}
+
+
+def test_plan_sync_missing_files():
+    plan = plan_sync([entry("server_only", "a"), entry("both", "b")], [entry("both", "b"), entry("client_only", "c")])
+    assert plan == {"download": ["server_only"], "upload": ["client_only"]}
+
+
+def test_plan_sync_changed_file_goes_from_the_newer_side():
+    server = [entry("older_on_client", "s1", mtime=200), entry("newer_on_client", "s2", mtime=200)]
+    client = [entry("older_on_client", "c1", mtime=100), entry("newer_on_client", "c2", mtime=300)]
+    assert plan_sync(server, client) == {"download": ["older_on_client"], "upload": ["newer_on_client"]}
+
+
+def test_plan_sync_without_client_mtime_uploads():
+    client = [{"path": "f", "sha256": "c"}]
+    assert plan_sync([entry("f", "s")], client) == {"download": [], "upload": ["f"]}
+
+
+def make_tree(root):
+    os.makedirs(os.path.join(root, "sub"))
+    with open(os.path.join(root, "a.txt"), "w") as f:
+        f.write("hello " * 1000)
+    with open(os.path.join(root, "sub", "b.png"), "wb") as f:
+        f.write(b"\x89PNG" + bytes(range(256)))
+    with open(os.path.join(root, "sub", ".upload-1234"), "wb") as f:
+        f.write(b"partial")
+
+
+def test_list_files_skips_uploads_in_progress(tmp_path):
+    make_tree(tmp_path)
+    assert [path for path, _, _ in list_files(str(tmp_path))] == ["a.txt", os.path.join("sub", "b.png")]
+
+
+def test_files_etag_changes_with_the_files(tmp_path):
+    make_tree(tmp_path)
+    entries = list_files(str(tmp_path))
+    etag = files_etag(entries)
+    assert etag.startswith('W/"') and etag == files_etag(list_files(str(tmp_path)))
+
+    with open(tmp_path / "a.txt", "a") as f:
+        f.write("more")
+    assert files_etag(list_files(str(tmp_path))) != etag
+    assert files_etag(entries[:1]) != etag
+
+
+def test_etag_matches():
+    etag = 'W/"abc"'
+    assert etag_matches('W/"abc"', etag)
+    assert etag_matches('"abc"', etag)
+    assert etag_matches('"x", W/"abc"', etag)
+    assert etag_matches("*", etag)
+    assert not etag_matches('"x"', etag)
+    assert not etag_matches(None, etag)
+
+
+def test_iter_zip(tmp_path):
+    make_tree(tmp_path)
+    entries = list_files(str(tmp_path))
+    # A file deleted after the listing is left out
+    entries.append(("gone.txt", 1, 0))
+    archive = zipfile.ZipFile(io.BytesIO(b"".join(iter_zip(str(tmp_path), entries))))
+
+    assert archive.namelist() == ["a.txt", "sub/b.png"]
+    assert archive.read("a.txt") == b"hello " * 1000
+    assert archive.getinfo("a.txt").compress_type == zipfile.ZIP_DEFLATED
+    # Already compressed formats are stored
+    assert archive.getinfo("sub/b.png").compress_type == zipfile.ZIP_STORED
+
+    archive = zipfile.ZipFile(io.BytesIO(b"".join(iter_zip(str(tmp_path), entries, store_compressed=False))))
+    assert archive.getinfo("sub/b.png").compress_type == zipfile.ZIP_DEFLATED
+
+
+def test_workspace_index_manifest(tmp_path):
+    workspace = tmp_path / "workspace"
+    workspace.mkdir()
+    make_tree(str(workspace))
+    index = WorkspaceIndex("u", str(workspace), directory=str(tmp_path / "index"))
+
+    manifest = index.manifest()
+    assert [item["path"] for item in manifest] == ["a.txt", os.path.join("sub", "b.png")]
+    assert manifest[0]["sha256"] == file_sha256(str(workspace / "a.txt"))
+    assert os.path.exists(tmp_path / "index" / "u.json")